@@ -0,0 +1,251 @@
+''' Runs the analysis chain on several runs at once.
+
+The stages of all runs are scheduled on a number of processes. A stage is
+started as soon as the stages it depends on are finished, thus independent
+stages (e.g. the clustering of each DUT or the merging and the prealignment)
+run concurrently. Stages with up to date output files are skipped.
+'''
+from __future__ import division
+
+import os
+import logging
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing import Process, Queue, cpu_count
+try:
+    from queue import Empty
+except ImportError:  # Python 2
+    from Queue import Empty
+
+from testbeam_analysis import hit_analysis
+from testbeam_analysis import dut_alignment
+from testbeam_analysis import track_analysis
+from testbeam_analysis import result_analysis
+from testbeam_analysis.tools import storage
+
+# All stages in the order of their dependencies
+STAGES = ('mask', 'cluster', 'correlate', 'prealign', 'merge', 'apply_alignment', 'find', 'fit', 'residuals', 'efficiency')
+
+
+class _Task(object):
+    ''' One stage of one run (and one DUT for the per DUT stages) '''
+
+    def __init__(self, run_name, stage, func, kwargs, input_files, output_files, depends, dut_index=None):
+        self.run_name = run_name
+        self.stage = stage
+        self.func = func
+        self.kwargs = kwargs
+        self.input_files = input_files
+        self.output_files = output_files
+        self.depends = depends  # Indices of the tasks that have to be finished before
+        self.dut_index = dut_index
+
+    def __str__(self):
+        if self.dut_index is None:
+            return '%s: %s' % (self.run_name, self.stage)
+        return '%s: %s DUT%d' % (self.run_name, self.stage, self.dut_index)
+
+    def is_up_to_date(self):
+        ''' True if all output files exist and are newer than the input files '''
+        if not all(os.path.isfile(output_file) for output_file in self.output_files):
+            return False
+        last_input = max([os.path.getmtime(input_file) for input_file in self.input_files if os.path.isfile(input_file)] or [0.])
+        return min(os.path.getmtime(output_file) for output_file in self.output_files) >= last_input
+
+
+def run_batch_analysis(runs, setup, output_folder=None, stages=None, n_cores=None, force=False, storage_policy=None):
+    '''Runs the analysis chain from the hit files to the residuals and efficiencies for several runs.
+
+    The stages are mask, cluster, correlate, prealign, merge, apply_alignment, find, fit, residuals and efficiency.
+    Tracks are fitted and results are calculated with the prealignment.
+
+    Parameters
+    ----------
+    runs : iterable of iterables of strings, dict
+        The hit files of each run, one file per DUT. If a dict is given, the keys are used as run names.
+    setup : dict
+        Description of the setup with the keys n_pixels, pixel_size, z_positions and (optional) dut_names,
+        e.g. for two FE-I4 DUTs: {'n_pixels': [(80, 336)] * 2, 'pixel_size': [(250, 50)] * 2, 'z_positions': [0., 19500]}.
+        Additional keyword arguments for a stage can be given with the stage name as key,
+        e.g. setup['cluster'] = {'min_hit_charge': 0, 'max_hit_charge': 13}.
+    output_folder : string
+        Folder where a sub folder with the output files is created for each run.
+        If None, the sub folders are created next to the first hit file of each run.
+    stages : iterable of strings
+        The stages to run. If None, all stages are run. The output files of
+        stages that are not run have to exist from an earlier call.
+    n_cores : integer, None
+        How many stages run at once. If None use all available cores.
+    force : bool
+        If True, the stages are run even if their output files are up to date.
+    storage_policy : testbeam_analysis.tools.storage.StoragePolicy
+        The compression settings of the created files, e.g. fast compression for the intermediate files.
+        If None, the active storage policy is used.
+
+    Returns
+    -------
+    list of tuples
+        The run name, the stage, the DUT index (None if the stage is not per DUT) and the wall time in seconds
+        for each stage in the order of execution. The wall time is None for skipped stages.
+    '''
+    logging.info('=== Batch analysis of %d runs ===', len(runs))
+
+    if not isinstance(runs, dict):
+        runs = OrderedDict(('run_%d' % index, hit_files) for index, hit_files in enumerate(runs))
+    if stages is None:
+        stages = STAGES
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError('Stage "%s" not recognized!' % stage)
+    if not n_cores:
+        n_cores = cpu_count()
+    if storage_policy is None:
+        storage_policy = storage.get_storage_policy()
+
+    tasks = []
+    for run_name, hit_files in runs.items():
+        run_output_folder = os.path.join(output_folder if output_folder else os.path.dirname(os.path.abspath(hit_files[0])), run_name)
+        if not os.path.exists(run_output_folder):
+            os.makedirs(run_output_folder)
+        tasks.extend(_create_run_tasks(run_name, hit_files, setup, run_output_folder, stages, index_offset=len(tasks)))
+
+    report = []
+    finished, failed, running = set(), set(), {}
+    result_queue = Queue()
+    while len(finished) + len(failed) < len(tasks):
+        for index, task in enumerate(tasks):  # Start all tasks that are ready
+            if index in finished or index in failed or index in running:
+                continue
+            if any(depend in failed for depend in task.depends):
+                logging.error('Skip %s, since a stage it depends on failed', task)
+                failed.add(index)
+                continue
+            if not all(depend in finished for depend in task.depends):
+                continue
+            if not force and task.is_up_to_date():
+                logging.info('Skip %s, output is up to date', task)
+                report.append((task.run_name, task.stage, task.dut_index, None))
+                finished.add(index)
+                continue
+            if len(running) < n_cores:
+                logging.info('Start %s', task)
+                running[index] = Process(target=_run_task, args=(index, task.func, task.kwargs, storage_policy, result_queue))
+                running[index].start()
+
+        if not running:
+            continue
+
+        try:  # Wait for the next finished task
+            index, wall_time, error = result_queue.get(timeout=1.)
+        except Empty:  # Check for processes that died without sending a result
+            for index, process in list(running.items()):
+                if not process.is_alive() and result_queue.empty():
+                    logging.error('%s failed with exit code %s', tasks[index], process.exitcode)
+                    failed.add(index)
+                    del running[index]
+            continue
+        running.pop(index).join()
+        if error:
+            logging.error('%s failed after %.1f s:\n%s', tasks[index], wall_time, error)
+            failed.add(index)
+        else:
+            logging.info('Finished %s in %.1f s', tasks[index], wall_time)
+            report.append((tasks[index].run_name, tasks[index].stage, tasks[index].dut_index, wall_time))
+            finished.add(index)
+
+    # Wall time report
+    for run_name, stage, dut_index, wall_time in report:
+        logging.info('%-20s %-16s %-6s %s', run_name, stage, '' if dut_index is None else 'DUT%d' % dut_index, 'up to date' if wall_time is None else '%.1f s' % wall_time)
+
+    if failed:
+        raise RuntimeError('Batch analysis failed for %s' % ', '.join(str(tasks[index]) for index in sorted(failed)))
+
+    return report
+
+
+def _create_run_tasks(run_name, hit_files, setup, output_folder, stages, index_offset=0):
+    ''' Creates the tasks of all stages of one run.
+
+    The dependencies are given as indices of the task list of all runs, thus the index offset of the run is needed.
+    '''
+    n_pixels, pixel_size, z_positions = setup['n_pixels'], setup['pixel_size'], setup['z_positions']
+    n_duts = len(hit_files)
+    dut_names = setup.get('dut_names', None)
+
+    tasks = []
+    stage_tasks = {}  # Task indices per stage
+
+    def add_task(stage, func, kwargs, input_files, output_files, depends=(), dut_index=None):
+        depends = [index for depend in depends for index in stage_tasks.get(depend, [])]
+        if dut_index is not None:  # Per DUT stages only depend on the same DUT of the preceding per DUT stage
+            depends = [index for index in depends if tasks[index - index_offset].dut_index in (None, dut_index)]
+        if stage in stages:
+            kwargs.update(setup.get(stage, {}))
+            stage_tasks.setdefault(stage, []).append(index_offset + len(tasks))
+            tasks.append(_Task(run_name, stage, func, kwargs, input_files, output_files, depends, dut_index))
+
+    # Per DUT stages
+    cluster_files = []
+    for dut_index, hit_file in enumerate(hit_files):
+        file_name = os.path.join(output_folder, os.path.splitext(os.path.basename(hit_file))[0])
+        mask_file = file_name + '_noisy_pixel_mask.h5'
+        cluster_files.append(file_name + '_clustered.h5')
+        add_task('mask', hit_analysis.generate_pixel_mask,
+                 dict(input_hits_file=hit_file, n_pixel=n_pixels[dut_index], pixel_size=pixel_size[dut_index], output_mask_file=mask_file, dut_name=dut_names[dut_index] if dut_names else None),
+                 [hit_file], [mask_file], dut_index=dut_index)
+        use_mask = 'mask' in stages or os.path.isfile(mask_file)
+        add_task('cluster', hit_analysis.cluster_hits,
+                 dict(input_hits_file=hit_file, output_cluster_file=cluster_files[-1], input_noisy_pixel_mask_file=mask_file if use_mask else None, dut_name=dut_names[dut_index] if dut_names else None),
+                 [hit_file, mask_file] if use_mask else [hit_file], [cluster_files[-1]], depends=['mask'], dut_index=dut_index)
+
+    # Stages of all DUTs
+    correlation_file = os.path.join(output_folder, 'Correlation.h5')
+    alignment_file = os.path.join(output_folder, 'Alignment.h5')
+    merged_file = os.path.join(output_folder, 'Merged.h5')
+    tracklets_file = os.path.join(output_folder, 'Tracklets_prealigned.h5')
+    track_candidates_file = os.path.join(output_folder, 'TrackCandidates_prealigned.h5')
+    tracks_file = os.path.join(output_folder, 'Tracks_prealigned.h5')
+    residuals_file = os.path.join(output_folder, 'Residuals_prealigned.h5')
+    efficiency_file = os.path.join(output_folder, 'Efficiency.h5')
+    add_task('correlate', dut_alignment.correlate_cluster,
+             dict(input_cluster_files=cluster_files, output_correlation_file=correlation_file, n_pixels=n_pixels, pixel_size=pixel_size, dut_names=dut_names),
+             cluster_files, [correlation_file], depends=['cluster'])
+    add_task('prealign', dut_alignment.prealignment,
+             dict(input_correlation_file=correlation_file, output_alignment_file=alignment_file, z_positions=z_positions, pixel_size=pixel_size, dut_names=dut_names, non_interactive=True),
+             [correlation_file], [alignment_file], depends=['correlate'])
+    add_task('merge', dut_alignment.merge_cluster_data,
+             dict(input_cluster_files=cluster_files, output_merged_file=merged_file, n_pixels=n_pixels, pixel_size=pixel_size),
+             cluster_files, [merged_file], depends=['cluster'])
+    add_task('apply_alignment', dut_alignment.apply_alignment,
+             dict(input_hit_file=merged_file, input_alignment_file=alignment_file, output_hit_file=tracklets_file, force_prealignment=True),
+             [merged_file, alignment_file], [tracklets_file], depends=['merge', 'prealign'])
+    add_task('find', track_analysis.find_tracks,
+             dict(input_tracklets_file=tracklets_file, input_alignment_file=alignment_file, output_track_candidates_file=track_candidates_file),
+             [tracklets_file, alignment_file], [track_candidates_file], depends=['apply_alignment', 'prealign'])
+    add_task('fit', track_analysis.fit_tracks,
+             dict(input_track_candidates_file=track_candidates_file, input_alignment_file=alignment_file, output_tracks_file=tracks_file, force_prealignment=True),
+             [track_candidates_file, alignment_file], [tracks_file], depends=['find'])
+    add_task('residuals', result_analysis.calculate_residuals,
+             dict(input_tracks_file=tracks_file, input_alignment_file=alignment_file, output_residuals_file=residuals_file, n_pixels=n_pixels, pixel_size=pixel_size, dut_names=dut_names, force_prealignment=True),
+             [tracks_file, alignment_file], [residuals_file], depends=['fit'])
+    add_task('efficiency', result_analysis.calculate_efficiency,
+             dict(input_tracks_file=tracks_file, input_alignment_file=alignment_file, output_efficiency_file=efficiency_file, bin_size=pixel_size, sensor_size=[(pixel_size[i][0] * n_pixels[i][0], pixel_size[i][1] * n_pixels[i][1]) for i in range(n_duts)], pixel_size=pixel_size, n_pixels=n_pixels, force_prealignment=True),
+             [tracks_file, alignment_file], [efficiency_file], depends=['fit'])
+
+    return tasks
+
+
+def _run_task(index, func, kwargs, storage_policy, result_queue):
+    ''' Runs one stage in its own process and sends the wall time and the traceback of an exception to the result queue.
+
+    The stages use process pools themselves, thus they cannot run in the (daemonic) workers of a pool.
+    '''
+    storage.set_storage_policy(storage_policy)
+    start_time = time.time()
+    try:
+        func(**kwargs)
+    except Exception:
+        result_queue.put((index, time.time() - start_time, traceback.format_exc()))
+    else:
+        result_queue.put((index, time.time() - start_time, None))
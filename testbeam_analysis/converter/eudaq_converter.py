@@ -4,8 +4,9 @@
 import logging
 import numpy as np
 import tables as tb
+from numba import njit
 
-from eudaq2np import data_np
+from testbeam_analysis.tools import storage
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
 
@@ -18,12 +19,13 @@ def process_dut(raw_data_file):
 
 
 def convert_eudaq_raw_data(input_file):
+    from eudaq2np import data_np  # Only needed to read the raw data
     logging.info('Convert EUDAQ raw data using eudaq2np')
     eudaq_data = data_np(input_file)
     with tb.open_file(input_file[:-4] + '.h5', 'w') as out_file_h5:
         for readout_type, hit_data in eudaq_data.iteritems():
             logging.info('Create hit table for %s' % readout_type)
-            hit_table_out = out_file_h5.create_table(out_file_h5.root, name=readout_type, description=hit_data.dtype, title='Hits for %s readout from EUDAQ raw data' % readout_type, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            hit_table_out = out_file_h5.create_table(out_file_h5.root, name=readout_type, description=hit_data.dtype, title='Hits for %s readout from EUDAQ raw data' % readout_type, filters=storage.get_filters('hits'), chunkshape=storage.get_chunkshape('hits'))
             hit_table_out.append(hit_data)
 
 
@@ -39,30 +41,82 @@ def align_events(input_file, output_file, chunk_size=10000000):
     logging.warning('Aligning events and correcting timestamp / tlu trigger number is not implemented. We trust the EUDAQ event building now.')
 
 
-def format_hit_table(input_file):
-    ''' Selects and renames important columns for test beam analysis and stores them into a new file.
+def format_hit_table(input_file, chunk_size=10000000):
+    ''' Selects and renames important columns for test beam analysis and stores them into a new file per DUT.
+
+    The readout nodes are read in chunks and the hits of each chunk are split by plane in one pass.
+    Hits of the same plane from several readout nodes are appended to the same output file
+    and the hit table is sorted by event number afterwards, if needed.
 
     Parameters
     ----------
     input_file : pytables file
-    output_file : pytables file
+    chunk_size :  int
+        How many hits are read at once into RAM.
+    '''
+
+    hit_files, hit_tables = {}, {}  # Output files and hit tables per DUT, created when the first hit of the DUT occurs
+    last_event_numbers, unsorted_duts = {}, set()  # Last stored event number per DUT and DUTs with hits not ordered by event number
+    try:
+        with tb.open_file(input_file, 'r') as in_file_h5:
+            min_timestamp = min([node[0]['timestamp'] for node in in_file_h5.root])
+            for node in in_file_h5.root:
+                for start_index in range(0, node.nrows, chunk_size):
+                    hits = node.read(start=start_index, stop=start_index + chunk_size)
+                    sort_index, plane_index = _get_plane_sort_index(hits['plane'].astype(np.int64), np.max(hits['plane']) + 1)
+                    hits = hits[sort_index]
+                    for dut_index in np.where(plane_index[1:] > plane_index[:-1])[0]:
+                        if dut_index not in hit_tables:
+                            hit_files[dut_index] = tb.open_file(input_file[:-3] + '_DUT%d.h5' % dut_index, 'w')
+                            hit_tables[dut_index] = hit_files[dut_index].create_table(hit_files[dut_index].root, name='Hits', description=np.dtype([('event_number', np.int64), ('frame', np.uint8), ('column', np.uint16), ('row', np.uint16), ('charge', np.uint16)]), title='Selected FE-I4 hits for test beam analysis', filters=storage.get_filters('hits'), chunkshape=storage.get_chunkshape('hits'))
+                        hits_actual_dut = hits[plane_index[dut_index]:plane_index[dut_index + 1]]
+                        hits_formatted = np.zeros((hits_actual_dut.shape[0], ), dtype=hit_tables[dut_index].dtype)
+                        hits_formatted['event_number'] = hits_actual_dut['timestamp'] - min_timestamp  # we take the time stamp as a event number, this uses the EUDAQ event building wich was most reliable so far
+                        hits_formatted['frame'] = hits_actual_dut['frame']
+                        hits_formatted['column'] = hits_actual_dut['x'] + 1
+                        hits_formatted['row'] = hits_actual_dut['y'] + 1
+                        hits_formatted['charge'] = hits_actual_dut['val']
+                        if (dut_index in last_event_numbers and hits_formatted['event_number'][0] < last_event_numbers[dut_index]) or np.any(np.diff(hits_formatted['event_number']) < 0):
+                            unsorted_duts.add(dut_index)
+                        last_event_numbers[dut_index] = hits_formatted['event_number'][-1]
+                        hit_tables[dut_index].append(hits_formatted)
+            for dut_index in sorted(unsorted_duts):  # E.g. a plane read out by several readout nodes
+                logging.info('Sort hits of DUT%d by event number', dut_index)
+                _sort_hit_table(hit_tables[dut_index])
+    finally:
+        for hit_file in hit_files.values():
+            hit_file.close()
+
+
+def _sort_hit_table(hit_table):
+    ''' Sorts the hit table by event number. Uses a completely sorted index, thus the table is not loaded into RAM. '''
+    hit_table.flush()
+    hit_table.cols.event_number.create_csindex()
+    sorted_hit_table = hit_table.copy(newname=hit_table.name + '_sorted', sortby='event_number', propindexes=False, chunkshape=storage.get_chunkshape('hits'))
+    name = hit_table.name
+    hit_table.remove()
+    sorted_hit_table.move(newname=name)
+
+
+@njit
+def _get_plane_sort_index(plane, n_planes):
+    ''' Counting sort of the hits by plane. The hit order within a plane is kept.
+
+    Returns the indices that sort the hits and the start index of each plane in the sorted hits
+    (the hits of plane i are at [plane_index[i]:plane_index[i + 1]]).
     '''
+    plane_index = np.zeros(n_planes + 1, dtype=np.int64)
+    for actual_plane in plane:  # Count the hits per plane
+        plane_index[actual_plane + 1] += 1
+    for index in range(n_planes):  # Start index of each plane
+        plane_index[index + 1] += plane_index[index]
+    position = plane_index[:-1].copy()
+    sort_index = np.empty(plane.shape[0], dtype=np.int64)
+    for index in range(plane.shape[0]):
+        sort_index[position[plane[index]]] = index
+        position[plane[index]] += 1
+    return sort_index, plane_index
 
-    with tb.open_file(input_file, 'r') as in_file_h5:
-        min_timestamp = min([node[0]['timestamp'] for node in in_file_h5.root])
-        for node in in_file_h5.root:
-            hits = node[:]
-            for dut_index in np.unique(hits['plane']):
-                with tb.open_file(input_file[:-3] + '_DUT%d.h5' % dut_index, 'w') as out_file_h5:
-                    hits_actual_dut = hits[hits['plane'] == dut_index]
-                    hits_formatted = np.zeros((hits_actual_dut.shape[0], ), dtype=[('event_number', np.int64), ('frame', np.uint8), ('column', np.uint16), ('row', np.uint16), ('charge', np.uint16)])
-                    hit_table_out = out_file_h5.create_table(out_file_h5.root, name='Hits', description=hits_formatted.dtype, title='Selected FE-I4 hits for test beam analysis', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-                    hits_formatted['event_number'] = hits_actual_dut['timestamp'] - min_timestamp  # we take the time stamp as a event number, this uses the EUDAQ event building wich was most reliable so far
-                    hits_formatted['frame'] = hits_actual_dut['frame']
-                    hits_formatted['column'] = hits_actual_dut['x'] + 1
-                    hits_formatted['row'] = hits_actual_dut['y'] + 1
-                    hits_formatted['charge'] = hits_actual_dut['val']
-                    hit_table_out.append(hits_formatted)
 
 if __name__ == "__main__":
     # Input raw data file names
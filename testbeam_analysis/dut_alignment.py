@@ -19,10 +19,11 @@ from testbeam_analysis.tools import analysis_utils
 from testbeam_analysis.tools import plot_utils
 from testbeam_analysis.tools import geometry_utils
 from testbeam_analysis.tools import data_selection
+from testbeam_analysis.tools import storage
 
 # Imports for track based alignment
-from testbeam_analysis.track_analysis import fit_tracks
-from testbeam_analysis.result_analysis import calculate_residuals
+from testbeam_analysis.track_analysis import _fit_tracks_loop
+from testbeam_analysis.result_analysis import _get_residual_binning, _get_position_binning, _fill_residual_histograms
 
 warnings.simplefilter("ignore", OptimizeWarning)  # Fit errors are handled internally, turn of warnings
 
@@ -57,53 +58,37 @@ def correlate_cluster(input_cluster_files, output_correlation_file, n_pixels, pi
     with tb.open_file(output_correlation_file, mode="w") as out_file_h5:
         n_duts = len(input_cluster_files)
 
-        # Result arrays to be filled
+        # Create correlation histograms to the reference device for all other devices
+        # Each worker streams through the cluster file of one device and returns the histograms when finished
+        progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=n_duts - 1, term_width=80)
+        progress_bar.start()
+
+        pool = Pool()  # Provide worker pool
+        dut_results = []
+        for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
+            dut_results.append(pool.apply_async(_correlate_cluster, kwds={'reference_cluster_file': input_cluster_files[0],
+                                                                          'cluster_file': cluster_file,
+                                                                          'shape_column': (n_pixels[dut_index][0], n_pixels[0][0]),
+                                                                          'shape_row': (n_pixels[dut_index][1], n_pixels[0][1]),
+                                                                          'chunk_size': chunk_size
+                                                                          }
+                                                ))
+        pool.close()
+
+        # Collect results when available
         column_correlations = []
         row_correlations = []
-        for dut_index in range(1, n_duts):
-            shape_column = (n_pixels[dut_index][0], n_pixels[0][0])
-            shape_row = (n_pixels[dut_index][1], n_pixels[0][1])
-            column_correlations.append(np.zeros(shape_column, dtype=np.int32))
-            row_correlations.append(np.zeros(shape_row, dtype=np.int32))
-
-        start_indices = [None] * n_duts  # Store the loop indices for speed up
-
-        with tb.open_file(input_cluster_files[0], mode='r') as in_file_h5:  # Open DUT0 cluster file
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=in_file_h5.root.Cluster.shape[0], term_width=80)
-            progress_bar.start()
-
-            pool = Pool()  # Provide worker pool
-            for cluster_dut_0, start_indices[0] in analysis_utils.data_aligned_at_events(in_file_h5.root.Cluster, start_index=start_indices[0], chunk_size=chunk_size):  # Loop over the cluster of DUT0 in chunks
-                actual_event_numbers = cluster_dut_0[:]['event_number']
-
-                # Create correlation histograms to the reference device for all other devices
-                # Do this in parallel to safe time
-
-                dut_results = []
-                for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
-                    dut_results.append(pool.apply_async(_correlate_cluster, kwds={'cluster_dut_0': cluster_dut_0,
-                                                                                  'cluster_file': cluster_file,
-                                                                                  'start_index': start_indices[dut_index],
-                                                                                  'start_event_number': actual_event_numbers[0],
-                                                                                  'stop_event_number': actual_event_numbers[-1] + 1,
-                                                                                  'column_correlation': column_correlations[dut_index - 1],
-                                                                                  'row_correlation': row_correlations[dut_index - 1],
-                                                                                  'chunk_size': chunk_size
-                                                                                  }
-                                                        ))
-                # Collect results when available
-                for dut_index, dut_result in enumerate(dut_results, start=1):
-                    (start_indices[dut_index], column_correlations[dut_index - 1], row_correlations[dut_index - 1]) = dut_result.get()
-
-                progress_bar.update(start_indices[0])
-
-            pool.close()
-            pool.join()
+        for dut_index, dut_result in enumerate(dut_results, start=1):
+            column_correlation, row_correlation = dut_result.get()
+            column_correlations.append(column_correlation)
+            row_correlations.append(row_correlation)
+            progress_bar.update(dut_index)
+        pool.join()
 
         # Store the correlation histograms
         for dut_index in range(n_duts - 1):
-            out_col = out_file_h5.create_carray(out_file_h5.root, name='CorrelationColumn_%d_0' % (dut_index + 1), title='Column Correlation between DUT%d and DUT%d' % (dut_index + 1, 0), atom=tb.Atom.from_dtype(column_correlations[dut_index].dtype), shape=column_correlations[dut_index].shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-            out_row = out_file_h5.create_carray(out_file_h5.root, name='CorrelationRow_%d_0' % (dut_index + 1), title='Row Correlation between DUT%d and DUT%d' % (dut_index + 1, 0), atom=tb.Atom.from_dtype(row_correlations[dut_index].dtype), shape=row_correlations[dut_index].shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            out_col = out_file_h5.create_carray(out_file_h5.root, name='CorrelationColumn_%d_0' % (dut_index + 1), title='Column Correlation between DUT%d and DUT%d' % (dut_index + 1, 0), atom=tb.Atom.from_dtype(column_correlations[dut_index].dtype), shape=column_correlations[dut_index].shape, filters=storage.get_filters('histogram'))
+            out_row = out_file_h5.create_carray(out_file_h5.root, name='CorrelationRow_%d_0' % (dut_index + 1), title='Row Correlation between DUT%d and DUT%d' % (dut_index + 1, 0), atom=tb.Atom.from_dtype(row_correlations[dut_index].dtype), shape=row_correlations[dut_index].shape, filters=storage.get_filters('histogram'))
             out_col.attrs.filenames = [str(input_cluster_files[0]), str(input_cluster_files[dut_index])]
             out_row.attrs.filenames = [str(input_cluster_files[0]), str(input_cluster_files[dut_index])]
             out_col[:] = column_correlations[dut_index]
@@ -114,12 +99,13 @@ def correlate_cluster(input_cluster_files, output_correlation_file, n_pixels, pi
         plot_utils.plot_correlations(input_correlation_file=output_correlation_file, pixel_size=pixel_size, dut_names=dut_names)
 
 
-def merge_cluster_data(input_cluster_files, output_merged_file, n_pixels, pixel_size, chunk_size=4999999):
+def merge_cluster_data(input_cluster_files, output_merged_file, n_pixels, pixel_size, dut_arrays=False, reduced_precision=False, chunk_size=4999999):
     '''Takes the cluster from all cluster files and merges them into one big table aligned at a common event number.
 
     Empty entries are signaled with column = row = charge = nan. Position is translated from indices to um. The
     local coordinate system origin (0, 0) is defined in the sensor center, to decouple translation and rotation.
-    Cluster position errors are calculated from cluster dimensions.
+    Cluster position errors are calculated from cluster dimensions. If the cluster table has a position_error_lookup
+    attribute (see hit_analysis.cluster_hits()), the position errors of small clusters are taken from the lookup table.
 
     Parameters
     ----------
@@ -133,110 +119,80 @@ def merge_cluster_data(input_cluster_files, output_merged_file, n_pixels, pixel_
     pixel_size : iterable of tuples
         One tuple per DUT describing the pixel dimension (column/row),
         e.g. for two FE-I4 DUTs [(250, 50), (250, 50)].
+    dut_arrays : bool
+        If True, the hits of all DUTs are stored in one column with shape (n_duts,) per quantity instead of
+        one column per DUT and quantity (see analysis_utils.get_merged_description()).
+        The tracklets and track candidates created from the merged hits keep this layout.
+    reduced_precision : bool
+        If True, positions, position errors and charges are stored as float32 (see analysis_utils.get_merged_description()).
+        The tracklets, track candidates and the hits of the fitted tracks keep this precision, calculations are done with float64.
     chunk_size : uint
         Chunk size of the data when reading from file.
     '''
     logging.info('=== Merge cluster files from %d DUTs to merged hit file ===', len(input_cluster_files))
 
     # Create result array description, depends on the number of DUTs
-    description = [('event_number', np.int64)]
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('x_dut_%d' % index, np.float))
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('y_dut_%d' % index, np.float))
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('z_dut_%d' % index, np.float))
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('charge_dut_%d' % index, np.float))
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('n_hits_dut_%d' % index, np.int8))
-    description.extend([('track_quality', np.uint32), ('n_tracks', np.int8)])
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('xerr_dut_%d' % index, np.float))
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('yerr_dut_%d' % index, np.float))
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('zerr_dut_%d' % index, np.float))
-
-    start_indices_merging_loop = [None] * len(input_cluster_files)  # Store the merging loop indices for speed up
-    start_indices_data_loop = [None] * len(input_cluster_files)  # Additional store indices for the data loop
-    actual_start_event_number = None  # Defines the first event number of the actual chunk for speed up. Cannot be deduced from DUT0, since this DUT could have missing event numbers.
+    description = analysis_utils.get_merged_description(n_duts=len(input_cluster_files), dut_arrays=dut_arrays, reduced_precision=reduced_precision)
 
     # Merge the cluster data from different DUTs into one table
-    with tb.open_file(output_merged_file, mode='w') as out_file_h5:
-        merged_cluster_table = out_file_h5.create_table(out_file_h5.root, name='MergedCluster', description=np.zeros((1,), dtype=description).dtype, title='Merged cluster on event number', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-        with tb.open_file(input_cluster_files[0], mode='r') as in_file_h5:  # Open DUT0 cluster file
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=in_file_h5.root.Cluster.shape[0], term_width=80)
+    # All cluster files are opened once and read in lockstep, each cluster file is read exactly once
+    in_files_h5 = []
+    try:
+        for cluster_file in input_cluster_files:
+            in_files_h5.append(tb.open_file(cluster_file, mode='r'))
+        cluster_tables = [in_file_h5.root.Cluster for in_file_h5 in in_files_h5]
+        # Position errors of small clusters are not stored in cluster files from fused clustering, get lookup tables
+        position_error_lookups = [getattr(cluster_table.attrs, 'position_error_lookup', None) for cluster_table in cluster_tables]
+
+        with tb.open_file(output_merged_file, mode='w') as out_file_h5:
+            merged_cluster_table = out_file_h5.create_table(out_file_h5.root, name='MergedCluster', description=np.zeros((1,), dtype=description).dtype, title='Merged cluster on event number', filters=storage.get_filters('merged'), chunkshape=storage.get_chunkshape('merged'))
+            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=cluster_tables[0].shape[0], term_width=80)
             progress_bar.start()
-            for actual_cluster_dut_0, start_indices_data_loop[0] in analysis_utils.data_aligned_at_events(in_file_h5.root.Cluster, start_index=start_indices_data_loop[0], start_event_number=actual_start_event_number, stop_event_number=None, chunk_size=chunk_size):  # Loop over the cluster of DUT0 in chunks
-                actual_event_numbers = actual_cluster_dut_0[:]['event_number']
-
-                # First loop: calculate the minimum event number indices needed to merge all cluster from all files to this event number index
-                common_event_numbers = actual_event_numbers
-                for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
-                    with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open DUT0 cluster file
-                        for actual_cluster, start_indices_merging_loop[dut_index] in analysis_utils.data_aligned_at_events(actual_in_file_h5.root.Cluster, start_index=start_indices_merging_loop[dut_index], start_event_number=actual_start_event_number, stop_event_number=actual_event_numbers[-1] + 1, chunk_size=chunk_size, fail_on_missing_events=False):  # Loop over the cluster in the actual cluster file in chunks
-                            common_event_numbers = analysis_utils.get_max_events_in_both_arrays(common_event_numbers, actual_cluster[:]['event_number'])
+            for actual_clusters, index_dut_0 in analysis_utils.data_aligned_at_events_in_tables(cluster_tables, chunk_size=chunk_size):  # Loop over the cluster of DUT0 in chunks, other DUTs are read up to the last event number of the DUT0 chunk
+                # Calculate the event numbers needed to merge all cluster from all DUTs
+                common_event_numbers = actual_clusters[0]['event_number']
+                for actual_cluster_dut in actual_clusters[1:]:
+                    if actual_cluster_dut.shape[0] != 0:
+                        common_event_numbers = analysis_utils.get_max_events_in_both_arrays(common_event_numbers, actual_cluster_dut['event_number'])
                 merged_cluster_array = np.zeros(shape=(common_event_numbers.shape[0],), dtype=description)  # resulting array to be filled
                 for index, _ in enumerate(input_cluster_files):
                     # for no hit: column = row = charge = nan
-                    merged_cluster_array['x_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['y_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['z_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['charge_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['xerr_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['yerr_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['zerr_dut_%d' % (index)] = np.nan
+                    for field in ('x', 'y', 'z', 'charge', 'xerr', 'yerr', 'zerr'):
+                        analysis_utils.set_dut_data(merged_cluster_array, field, np.nan, dut_index=index)
 
                 # Set the event number
                 merged_cluster_array['event_number'] = common_event_numbers[:]
 
-                # Fill result array with DUT 0 data
-                actual_cluster_dut_0 = analysis_utils.map_cluster(common_event_numbers, actual_cluster_dut_0)
-                # Select real hits, values with nan are virtual hits
-                selection = ~np.isnan(actual_cluster_dut_0['mean_column'])
-                # Convert indices to positions, origin defined in the center of the sensor
-                merged_cluster_array['x_dut_0'][selection] = pixel_size[0][0] * (actual_cluster_dut_0['mean_column'][selection] - 0.5 - (0.5 * n_pixels[0][0]))
-                merged_cluster_array['y_dut_0'][selection] = pixel_size[0][1] * (actual_cluster_dut_0['mean_row'][selection] - 0.5 - (0.5 * n_pixels[0][1]))
-                merged_cluster_array['z_dut_0'][selection] = 0.0
-                xerr = np.zeros(selection.shape)
-                yerr = np.zeros(selection.shape)
-                zerr = np.zeros(selection.shape)
-                xerr[selection] = actual_cluster_dut_0['err_column'][selection] * pixel_size[0][0]
-                yerr[selection] = actual_cluster_dut_0['err_row'][selection] * pixel_size[0][1]
-                merged_cluster_array['xerr_dut_0'][selection] = xerr[selection]
-                merged_cluster_array['yerr_dut_0'][selection] = yerr[selection]
-                merged_cluster_array['zerr_dut_0'][selection] = zerr[selection]
-                merged_cluster_array['charge_dut_0'][selection] = actual_cluster_dut_0['charge'][selection]
-                merged_cluster_array['n_hits_dut_0'][selection] = actual_cluster_dut_0['n_hits'][selection]
-
-                # Fill result array with other DUT data
-                # Second loop: get the cluster from all files and merge them to the common event number
-                for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
-                    with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open other DUT cluster file
-                        for actual_cluster_dut, start_indices_data_loop[dut_index] in analysis_utils.data_aligned_at_events(actual_in_file_h5.root.Cluster, start_index=start_indices_data_loop[dut_index], start_event_number=common_event_numbers[0], stop_event_number=common_event_numbers[-1] + 1, chunk_size=chunk_size, fail_on_missing_events=False):  # Loop over the cluster in the actual cluster file in chunks
-                            actual_cluster_dut = analysis_utils.map_cluster(common_event_numbers, actual_cluster_dut)
-                            # Select real hits, values with nan are virtual hits
-                            selection = ~np.isnan(actual_cluster_dut['mean_column'])
-                            # Convert indices to positions, origin in the center of the sensor, remaining DUTs
-                            merged_cluster_array['x_dut_%d' % (dut_index)][selection] = pixel_size[dut_index][0] * (actual_cluster_dut['mean_column'][selection] - 0.5 - (0.5 * n_pixels[dut_index][0]))
-                            merged_cluster_array['y_dut_%d' % (dut_index)][selection] = pixel_size[dut_index][1] * (actual_cluster_dut['mean_row'][selection] - 0.5 - (0.5 * n_pixels[dut_index][1]))
-                            merged_cluster_array['z_dut_%d' % (dut_index)][selection] = 0.0
-                            xerr = np.zeros(selection.shape)
-                            yerr = np.zeros(selection.shape)
-                            zerr = np.zeros(selection.shape)
-                            xerr[selection] = actual_cluster_dut['err_column'][selection] * pixel_size[dut_index][0]
-                            yerr[selection] = actual_cluster_dut['err_row'][selection] * pixel_size[dut_index][1]
-                            merged_cluster_array['xerr_dut_%d' % (dut_index)][selection] = xerr[selection]
-                            merged_cluster_array['yerr_dut_%d' % (dut_index)][selection] = yerr[selection]
-                            merged_cluster_array['zerr_dut_%d' % (dut_index)][selection] = zerr[selection]
-                            merged_cluster_array['charge_dut_%d' % (dut_index)][selection] = actual_cluster_dut['charge'][selection]
-                            merged_cluster_array['n_hits_dut_%d' % (dut_index)][selection] = actual_cluster_dut['n_hits'][selection]
+                # Fill result array with the data of all DUTs
+                for dut_index, actual_cluster_dut in enumerate(actual_clusters):
+                    if actual_cluster_dut.shape[0] == 0:
+                        continue
+                    actual_cluster_dut = analysis_utils.map_cluster(common_event_numbers, actual_cluster_dut)
+                    if position_error_lookups[dut_index] is not None:
+                        analysis_utils.apply_position_error_lookup(actual_cluster_dut['err_column'], actual_cluster_dut['err_row'], position_error_lookups[dut_index])
+                    # Select real hits, values with nan are virtual hits
+                    selection = ~np.isnan(actual_cluster_dut['mean_column'])
+                    # Convert indices to positions, origin defined in the center of the sensor
+                    analysis_utils.get_dut_data(merged_cluster_array, 'x', dut_index)[selection] = pixel_size[dut_index][0] * (actual_cluster_dut['mean_column'][selection] - 0.5 - (0.5 * n_pixels[dut_index][0]))
+                    analysis_utils.get_dut_data(merged_cluster_array, 'y', dut_index)[selection] = pixel_size[dut_index][1] * (actual_cluster_dut['mean_row'][selection] - 0.5 - (0.5 * n_pixels[dut_index][1]))
+                    analysis_utils.get_dut_data(merged_cluster_array, 'z', dut_index)[selection] = 0.0
+                    xerr = np.zeros(selection.shape)
+                    yerr = np.zeros(selection.shape)
+                    zerr = np.zeros(selection.shape)
+                    xerr[selection] = actual_cluster_dut['err_column'][selection] * pixel_size[dut_index][0]
+                    yerr[selection] = actual_cluster_dut['err_row'][selection] * pixel_size[dut_index][1]
+                    analysis_utils.get_dut_data(merged_cluster_array, 'xerr', dut_index)[selection] = xerr[selection]
+                    analysis_utils.get_dut_data(merged_cluster_array, 'yerr', dut_index)[selection] = yerr[selection]
+                    analysis_utils.get_dut_data(merged_cluster_array, 'zerr', dut_index)[selection] = zerr[selection]
+                    analysis_utils.get_dut_data(merged_cluster_array, 'charge', dut_index)[selection] = actual_cluster_dut['charge'][selection]
+                    analysis_utils.get_dut_data(merged_cluster_array, 'n_hits', dut_index)[selection] = actual_cluster_dut['n_hits'][selection]
 
                 merged_cluster_table.append(merged_cluster_array)
-                actual_start_event_number = common_event_numbers[-1] + 1  # Set the starting event number for the next chunked read
-                progress_bar.update(start_indices_data_loop[0])
+                progress_bar.update(index_dut_0)
             progress_bar.finish()
+    finally:
+        for in_file_h5 in in_files_h5:
+            in_file_h5.close()
 
 
 def prealignment(input_correlation_file, output_alignment_file, z_positions, pixel_size, s_n=0.1, fit_background=False, reduce_background=False, dut_names=None, no_fit=False, non_interactive=True, iterations=3, plot=True, gui=False, queue=False):
@@ -307,228 +263,237 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
         result[0]['row_c0'], result[0]['row_c0_error'] = 0.0, 0.0
         result[0]['row_c1'], result[0]['row_c1_error'] = 1.0, 0.0
         result[0]['z'] = z_positions[0]
-        for node in in_file_h5.root:
-            table_prefix = 'column' if 'column' in node.name.lower() else 'row'
-            indices = re.findall(r'\d+', node.name)
-            dut_idx = int(indices[0])
-            ref_idx = int(indices[1])
-            result[dut_idx]['DUT'] = dut_idx
-            dut_name = dut_names[dut_idx] if dut_names else ("DUT" + str(dut_idx))
-            ref_name = dut_names[ref_idx] if dut_names else ("DUT" + str(ref_idx))
-            logging.info('Aligning data from %s', node.name)
-
-            if "column" in node.name.lower():
-                pixel_size_dut, pixel_size_ref = pixel_size[dut_idx][0], pixel_size[ref_idx][0]
-            else:
-                pixel_size_dut, pixel_size_ref = pixel_size[dut_idx][1], pixel_size[ref_idx][1]
-
-            data = node[:]
-
-            n_pixel_dut, n_pixel_ref = data.shape[0], data.shape[1]
-
-            # Initialize arrays with np.nan (invalid), adding 0.5 to change from index to position
-            # matrix index 0 is cluster index 1 ranging from 0.5 to 1.4999, which becomes position 0.0 to 0.999 with center at 0.5, etc.
-            x_ref = (np.linspace(0.0, n_pixel_ref, num=n_pixel_ref, endpoint=False, dtype=np.float) + 0.5)
-            x_dut = (np.linspace(0.0, n_pixel_dut, num=n_pixel_dut, endpoint=False, dtype=np.float) + 0.5)
-            coeff_fitted = [None] * n_pixel_dut
-            mean_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Peak of the Gauss fit
-            mean_fitted.fill(np.nan)
-            mean_error_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Error of the fit of the peak
-            mean_error_fitted.fill(np.nan)
-            sigma_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Sigma of the Gauss fit
-            sigma_fitted.fill(np.nan)
-            chi2 = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Chi2 of the fit
-            chi2.fill(np.nan)
-            n_cluster = np.sum(data, axis=1)  # Number of hits per bin
-
-            if reduce_background:
-                uu, dd, vv = np.linalg.svd(data)  # sigular value decomposition
-                background = np.matrix(uu[:, :1]) * np.diag(dd[:1]) * np.matrix(vv[:1, :])  # take first sigular value for background
-                background = np.array(background, dtype=np.int32)  # make Numpy array
-                data = (data - background).astype(np.int32)  # remove background
-                data -= data.min()  # only positive values
 
+        # Read the correlation histograms and fit them for all DUTs and dimensions in parallel
+        # The results are collected when needed, thus plotting and user interaction overlap with fitting
+        # Without fit the Hough transforms of all correlation histograms are calculated at once
+        correlation_data, n_clusters, fit_results, hough_data = {}, {}, {}, {}
+        pool = None if no_fit else Pool()  # Provide worker pool
+        try:
+            for node in in_file_h5.root:
+                data = node[:]
+                n_clusters[node.name] = np.sum(data, axis=1)  # Number of hits per bin
+                if reduce_background:
+                    data = _reduce_background(data)
+                correlation_data[node.name] = data
+                if no_fit:
+                    hough_data[node.name] = _get_hough_data(data)
+                else:
+                    x_ref = (np.linspace(0.0, data.shape[1], num=data.shape[1], endpoint=False, dtype=np.float) + 0.5)
+                    fit_results[node.name] = pool.apply_async(_fit_data, kwds={'x': x_ref,
+                                                                               'data': data,
+                                                                               's_n': s_n,
+                                                                               'fit_background': fit_background,
+                                                                               'reduce_background': reduce_background})
             if no_fit:
-                # calculate half hight
-                median = np.median(data)
-                median_max = np.median(np.max(data, axis=1))
-                half_median_data = (data > ((median + median_max) / 2))
-                # calculate maximum per column
-                max_select = np.argmax(data, axis=1)
-                hough_data = np.zeros_like(data)
-                hough_data[np.arange(data.shape[0]), max_select] = 1
-                # select maximums if larger than half hight
-                hough_data = hough_data & half_median_data
-                # transpose for correct angle
-                hough_data = hough_data.T
-                accumulator, theta, rho, theta_edges, rho_edges = analysis_utils.hough_transform(hough_data, theta_res=0.1, rho_res=1.0, return_edges=True)
-                rho_idx, th_idx = np.unravel_index(accumulator.argmax(), accumulator.shape)
-                rho_val, theta_val = rho[rho_idx], theta[th_idx]
-                slope_idx, offset_idx = -np.cos(theta_val) / np.sin(theta_val), rho_val / np.sin(theta_val)
-                slope = slope_idx * (pixel_size_ref / pixel_size_dut)
-                offset = offset_idx * pixel_size_ref
-                # offset in the center of the pixel matrix
-                offset_center = offset + slope * pixel_size_dut * n_pixel_dut * 0.5 - pixel_size_ref * n_pixel_ref * 0.5
-                offset_center += 0.5 * pixel_size_ref - slope * 0.5 * pixel_size_dut  # correct for half bin
-
-                result[dut_idx][table_prefix + '_c0'], result[dut_idx][table_prefix + '_c0_error'] = offset_center, 0.0
-                result[dut_idx][table_prefix + '_c1'], result[dut_idx][table_prefix + '_c1_error'] = slope, 0.0
-                result[dut_idx][table_prefix + '_sigma'], result[dut_idx][table_prefix + '_sigma_error'] = 0.0, 0.0
-                result[dut_idx]['z'] = z_positions[dut_idx]
-
-                plot_utils.plot_hough(x=x_dut,
-                                      data=hough_data,
-                                      accumulator=accumulator,
-                                      offset=offset_idx,
-                                      slope=slope_idx,
-                                      theta_edges=theta_edges,
-                                      rho_edges=rho_edges,
-                                      n_pixel_ref=n_pixel_ref,
-                                      n_pixel_dut=n_pixel_dut,
-                                      pixel_size_ref=pixel_size_ref,
-                                      pixel_size_dut=pixel_size_dut,
-                                      ref_name=ref_name,
-                                      dut_name=dut_name,
-                                      prefix=table_prefix,
-                                      output_pdf=output_pdf,
-                                      gui=gui,
-                                      figs=figs)
-
+                hough_results = dict(zip(hough_data.keys(), analysis_utils.hough_transforms(hough_data.values(), theta_res=0.1, rho_res=1.0, return_edges=True)))
             else:
-                # fill the arrays from above with values
-                _fit_data(x=x_ref, data=data, s_n=s_n, coeff_fitted=coeff_fitted, mean_fitted=mean_fitted, mean_error_fitted=mean_error_fitted, sigma_fitted=sigma_fitted, chi2=chi2, fit_background=fit_background, reduce_background=reduce_background)
-
-                # Convert fit results to metric units for alignment fit
-                # Origin is center of pixel matrix
-                x_dut_scaled = (x_dut - 0.5 * n_pixel_dut) * pixel_size_dut
-                mean_fitted_scaled = (mean_fitted - 0.5 * n_pixel_ref) * pixel_size_ref
-                mean_error_fitted_scaled = mean_error_fitted * pixel_size_ref
-
-                # Selected data arrays
-                x_selected = x_dut.copy()
-                x_dut_scaled_selected = x_dut_scaled.copy()
-                mean_fitted_scaled_selected = mean_fitted_scaled.copy()
-                mean_error_fitted_scaled_selected = mean_error_fitted_scaled.copy()
-                sigma_fitted_selected = sigma_fitted.copy()
-                chi2_selected = chi2.copy()
-                n_cluster_selected = n_cluster.copy()
-
-                # Show the straigt line correlation fit including fit errors and offsets from the fit
-                # Let the user change the cuts (error limit, offset limit) and refit until result looks good
-                refit = True
-                selected_data = np.ones_like(x_dut, dtype=np.bool)
-                actual_iteration = 0  # Refit counter for non interactive mode
-                while refit:
-                    if gui and not non_interactive:
-                        # Put data in queue to be processed interactively on GUI thread
-                        queue['in'].put([x_dut_scaled_selected, mean_fitted_scaled_selected,
-                                         mean_error_fitted_scaled_selected, n_cluster_selected,
-                                         ref_name, dut_name, table_prefix])
-                        # Blocking statement to wait for processed data from GUI thread
-                        selected_data, fit, refit = queue['out'].get()
-                    else:
-                        selected_data, fit, refit = plot_utils.plot_prealignments(x=x_dut_scaled_selected,
-                                                                                  mean_fitted=mean_fitted_scaled_selected,
-                                                                                  mean_error_fitted=mean_error_fitted_scaled_selected,
-                                                                                  n_cluster=n_cluster_selected,
-                                                                                  ref_name=ref_name,
-                                                                                  dut_name=dut_name,
-                                                                                  prefix=table_prefix,
-                                                                                  non_interactive=non_interactive)
-
-                    x_selected = x_selected[selected_data]
-                    x_dut_scaled_selected = x_dut_scaled_selected[selected_data]
-                    mean_fitted_scaled_selected = mean_fitted_scaled_selected[selected_data]
-                    mean_error_fitted_scaled_selected = mean_error_fitted_scaled_selected[selected_data]
-                    sigma_fitted_selected = sigma_fitted_selected[selected_data]
-                    chi2_selected = chi2_selected[selected_data]
-                    n_cluster_selected = n_cluster_selected[selected_data]
-                    # Stop in non interactive mode if the number of refits (iterations) is reached
-                    if non_interactive:
-                        actual_iteration += 1
-                        if actual_iteration >= iterations:
-                            break
+                pool.close()
+
+            for node in in_file_h5.root:
+                table_prefix = 'column' if 'column' in node.name.lower() else 'row'
+                indices = re.findall(r'\d+', node.name)
+                dut_idx = int(indices[0])
+                ref_idx = int(indices[1])
+                result[dut_idx]['DUT'] = dut_idx
+                dut_name = dut_names[dut_idx] if dut_names else ("DUT" + str(dut_idx))
+                ref_name = dut_names[ref_idx] if dut_names else ("DUT" + str(ref_idx))
+                logging.info('Aligning data from %s', node.name)
+
+                if "column" in node.name.lower():
+                    pixel_size_dut, pixel_size_ref = pixel_size[dut_idx][0], pixel_size[ref_idx][0]
+                else:
+                    pixel_size_dut, pixel_size_ref = pixel_size[dut_idx][1], pixel_size[ref_idx][1]
+
+                data = correlation_data[node.name]
+                n_cluster = n_clusters[node.name]
+
+                n_pixel_dut, n_pixel_ref = data.shape[0], data.shape[1]
+
+                # Initialize arrays with np.nan (invalid), adding 0.5 to change from index to position
+                # matrix index 0 is cluster index 1 ranging from 0.5 to 1.4999, which becomes position 0.0 to 0.999 with center at 0.5, etc.
+                x_ref = (np.linspace(0.0, n_pixel_ref, num=n_pixel_ref, endpoint=False, dtype=np.float) + 0.5)
+                x_dut = (np.linspace(0.0, n_pixel_dut, num=n_pixel_dut, endpoint=False, dtype=np.float) + 0.5)
+
+                if no_fit:
+                    accumulator, theta, rho, theta_edges, rho_edges = hough_results[node.name]
+                    rho_idx, th_idx = np.unravel_index(accumulator.argmax(), accumulator.shape)
+                    rho_val, theta_val = rho[rho_idx], theta[th_idx]
+                    slope_idx, offset_idx = -np.cos(theta_val) / np.sin(theta_val), rho_val / np.sin(theta_val)
+                    slope = slope_idx * (pixel_size_ref / pixel_size_dut)
+                    offset = offset_idx * pixel_size_ref
+                    # offset in the center of the pixel matrix
+                    offset_center = offset + slope * pixel_size_dut * n_pixel_dut * 0.5 - pixel_size_ref * n_pixel_ref * 0.5
+                    offset_center += 0.5 * pixel_size_ref - slope * 0.5 * pixel_size_dut  # correct for half bin
+
+                    result[dut_idx][table_prefix + '_c0'], result[dut_idx][table_prefix + '_c0_error'] = offset_center, 0.0
+                    result[dut_idx][table_prefix + '_c1'], result[dut_idx][table_prefix + '_c1_error'] = slope, 0.0
+                    result[dut_idx][table_prefix + '_sigma'], result[dut_idx][table_prefix + '_sigma_error'] = 0.0, 0.0
+                    result[dut_idx]['z'] = z_positions[dut_idx]
+
+                    plot_utils.plot_hough(x=x_dut,
+                                          data=hough_data[node.name],
+                                          accumulator=accumulator,
+                                          offset=offset_idx,
+                                          slope=slope_idx,
+                                          theta_edges=theta_edges,
+                                          rho_edges=rho_edges,
+                                          n_pixel_ref=n_pixel_ref,
+                                          n_pixel_dut=n_pixel_dut,
+                                          pixel_size_ref=pixel_size_ref,
+                                          pixel_size_dut=pixel_size_dut,
+                                          ref_name=ref_name,
+                                          dut_name=dut_name,
+                                          prefix=table_prefix,
+                                          output_pdf=output_pdf,
+                                          gui=gui,
+                                          figs=figs)
 
-                # Linear fit, usually describes correlation very well, slope is close to 1.
-                # With low energy beam and / or beam with diverse agular distribution, the correlation will not be perfectly straight
-                # Use results from straight line fit as start values for this final fit
-                re_fit, re_fit_pcov = curve_fit(analysis_utils.linear, x_dut_scaled_selected, mean_fitted_scaled_selected, sigma=mean_error_fitted_scaled_selected, absolute_sigma=True, p0=[fit[0], fit[1]])
-
-                # Write fit results to array
-                result[dut_idx][table_prefix + '_c0'], result[dut_idx][table_prefix + '_c0_error'] = re_fit[0], np.absolute(re_fit_pcov[0][0]) ** 0.5
-                result[dut_idx][table_prefix + '_c1'], result[dut_idx][table_prefix + '_c1_error'] = re_fit[1], np.absolute(re_fit_pcov[1][1]) ** 0.5
-                result[dut_idx]['z'] = z_positions[dut_idx]
-
-                # Calculate mean sigma (is a residual when assuming straight tracks) and its error and store the actual data in result array
-                # This error is needed for track finding and track quality determination
-                mean_sigma = pixel_size_ref * np.mean(np.array(sigma_fitted_selected))
-                mean_sigma_error = pixel_size_ref * np.std(np.array(sigma_fitted_selected)) / np.sqrt(np.array(sigma_fitted_selected).shape[0])
-
-                result[dut_idx][table_prefix + '_sigma'], result[dut_idx][table_prefix + '_sigma_error'] = mean_sigma, mean_sigma_error
-
-                # Calculate the index of the beam center based on valid indices
-                plot_index = np.average(x_selected - 1, weights=np.sum(data, axis=1)[np.array(x_selected - 1, dtype=np.int32)])
-                # Find nearest valid index to the calculated index
-                idx = (np.abs(x_selected - 1 - plot_index)).argmin()
-                plot_index = np.array(x_selected - 1, dtype=np.int32)[idx]
-
-                x_fit = np.linspace(start=x_ref.min(), stop=x_ref.max(), num=500, endpoint=True)
-                indices_lower = np.arange(plot_index)
-                indices_higher = np.arange(plot_index, n_pixel_dut)
-                alternating_indices = np.vstack((np.hstack([indices_higher, indices_lower[::-1]]), np.hstack([indices_lower[::-1], indices_higher]))).reshape((-1,), order='F')
-                unique_indices = np.unique(alternating_indices, return_index=True)[1]
-                alternating_indices = alternating_indices[np.sort(unique_indices)]
-                for plot_index in alternating_indices:
-                    plot_correlation_fit = False
-                    if coeff_fitted[plot_index] is not None:
-                        plot_correlation_fit = True
-                        break
-                if plot_correlation_fit:
-                    if np.all(np.isnan(coeff_fitted[plot_index][3:6])):
-                        y_fit = analysis_utils.gauss_offset(x_fit, *coeff_fitted[plot_index][[0, 1, 2, 6]])
-                        fit_label = "Gauss-Offset"
-                    else:
-                        y_fit = analysis_utils.double_gauss_offset(x_fit, *coeff_fitted[plot_index])
-                        fit_label = "Gauss-Gauss-Offset"
-
-                    plot_utils.plot_correlation_fit(x=x_ref,
-                                                    y=data[plot_index, :],
-                                                    x_fit=x_fit,
-                                                    y_fit=y_fit,
-                                                    xlabel='%s %s' % ("Column" if "column" in node.name.lower() else "Row", ref_name),
-                                                    fit_label=fit_label,
-                                                    title="Correlation of %s: %s vs. %s at %s %d" % (table_prefix + "s", ref_name, dut_name, table_prefix, plot_index),
-                                                    output_pdf=output_pdf,
-                                                    gui=gui,
-                                                    figs=figs)
                 else:
-                    logging.warning("Cannot plot correlation fit, no fit data available")
-
-                # Plot selected data with fit
-                fit_fn = np.poly1d(re_fit[::-1])
-                selected_indices = np.searchsorted(x_dut_scaled, x_dut_scaled_selected)
-                mask = np.zeros_like(x_dut_scaled, dtype=np.bool)
-                mask[selected_indices] = True
-
-                plot_utils.plot_prealignment_fit(x=x_dut_scaled,
-                                                 mean_fitted=mean_fitted_scaled,
-                                                 mask=mask,
-                                                 fit_fn=fit_fn,
-                                                 fit=re_fit,
-                                                 pcov=re_fit_pcov,
-                                                 chi2=chi2,
-                                                 mean_error_fitted=mean_error_fitted_scaled,
-                                                 n_cluster=n_cluster,
-                                                 n_pixel_ref=n_pixel_ref,
-                                                 n_pixel_dut=n_pixel_dut,
-                                                 pixel_size_ref=pixel_size_ref,
-                                                 pixel_size_dut=pixel_size_dut,
-                                                 ref_name=ref_name,
-                                                 dut_name=dut_name,
-                                                 prefix=table_prefix,
-                                                 output_pdf=output_pdf,
-                                                 gui=gui,
-                                                 figs=figs)
+                    # get the fit results from the worker pool
+                    coeff_fitted, mean_fitted, mean_error_fitted, sigma_fitted, chi2 = fit_results[node.name].get()
+
+                    # Convert fit results to metric units for alignment fit
+                    # Origin is center of pixel matrix
+                    x_dut_scaled = (x_dut - 0.5 * n_pixel_dut) * pixel_size_dut
+                    mean_fitted_scaled = (mean_fitted - 0.5 * n_pixel_ref) * pixel_size_ref
+                    mean_error_fitted_scaled = mean_error_fitted * pixel_size_ref
+
+                    # Selected data arrays
+                    x_selected = x_dut.copy()
+                    x_dut_scaled_selected = x_dut_scaled.copy()
+                    mean_fitted_scaled_selected = mean_fitted_scaled.copy()
+                    mean_error_fitted_scaled_selected = mean_error_fitted_scaled.copy()
+                    sigma_fitted_selected = sigma_fitted.copy()
+                    chi2_selected = chi2.copy()
+                    n_cluster_selected = n_cluster.copy()
+
+                    # Show the straigt line correlation fit including fit errors and offsets from the fit
+                    # Let the user change the cuts (error limit, offset limit) and refit until result looks good
+                    refit = True
+                    selected_data = np.ones_like(x_dut, dtype=np.bool)
+                    actual_iteration = 0  # Refit counter for non interactive mode
+                    while refit:
+                        if gui and not non_interactive:
+                            # Put data in queue to be processed interactively on GUI thread
+                            queue['in'].put([x_dut_scaled_selected, mean_fitted_scaled_selected,
+                                             mean_error_fitted_scaled_selected, n_cluster_selected,
+                                             ref_name, dut_name, table_prefix])
+                            # Blocking statement to wait for processed data from GUI thread
+                            selected_data, fit, refit = queue['out'].get()
+                        else:
+                            selected_data, fit, refit = plot_utils.plot_prealignments(x=x_dut_scaled_selected,
+                                                                                      mean_fitted=mean_fitted_scaled_selected,
+                                                                                      mean_error_fitted=mean_error_fitted_scaled_selected,
+                                                                                      n_cluster=n_cluster_selected,
+                                                                                      ref_name=ref_name,
+                                                                                      dut_name=dut_name,
+                                                                                      prefix=table_prefix,
+                                                                                      non_interactive=non_interactive)
+
+                        x_selected = x_selected[selected_data]
+                        x_dut_scaled_selected = x_dut_scaled_selected[selected_data]
+                        mean_fitted_scaled_selected = mean_fitted_scaled_selected[selected_data]
+                        mean_error_fitted_scaled_selected = mean_error_fitted_scaled_selected[selected_data]
+                        sigma_fitted_selected = sigma_fitted_selected[selected_data]
+                        chi2_selected = chi2_selected[selected_data]
+                        n_cluster_selected = n_cluster_selected[selected_data]
+                        # Stop in non interactive mode if the number of refits (iterations) is reached
+                        if non_interactive:
+                            actual_iteration += 1
+                            if actual_iteration >= iterations:
+                                break
+
+                    # Linear fit, usually describes correlation very well, slope is close to 1.
+                    # With low energy beam and / or beam with diverse agular distribution, the correlation will not be perfectly straight
+                    # Use results from straight line fit as start values for this final fit
+                    re_fit, re_fit_pcov = curve_fit(analysis_utils.linear, x_dut_scaled_selected, mean_fitted_scaled_selected, sigma=mean_error_fitted_scaled_selected, absolute_sigma=True, p0=[fit[0], fit[1]])
+
+                    # Write fit results to array
+                    result[dut_idx][table_prefix + '_c0'], result[dut_idx][table_prefix + '_c0_error'] = re_fit[0], np.absolute(re_fit_pcov[0][0]) ** 0.5
+                    result[dut_idx][table_prefix + '_c1'], result[dut_idx][table_prefix + '_c1_error'] = re_fit[1], np.absolute(re_fit_pcov[1][1]) ** 0.5
+                    result[dut_idx]['z'] = z_positions[dut_idx]
+
+                    # Calculate mean sigma (is a residual when assuming straight tracks) and its error and store the actual data in result array
+                    # This error is needed for track finding and track quality determination
+                    mean_sigma = pixel_size_ref * np.mean(np.array(sigma_fitted_selected))
+                    mean_sigma_error = pixel_size_ref * np.std(np.array(sigma_fitted_selected)) / np.sqrt(np.array(sigma_fitted_selected).shape[0])
+
+                    result[dut_idx][table_prefix + '_sigma'], result[dut_idx][table_prefix + '_sigma_error'] = mean_sigma, mean_sigma_error
+
+                    # Calculate the index of the beam center based on valid indices
+                    plot_index = np.average(x_selected - 1, weights=np.sum(data, axis=1)[np.array(x_selected - 1, dtype=np.int32)])
+                    # Find nearest valid index to the calculated index
+                    idx = (np.abs(x_selected - 1 - plot_index)).argmin()
+                    plot_index = np.array(x_selected - 1, dtype=np.int32)[idx]
+
+                    x_fit = np.linspace(start=x_ref.min(), stop=x_ref.max(), num=500, endpoint=True)
+                    indices_lower = np.arange(plot_index)
+                    indices_higher = np.arange(plot_index, n_pixel_dut)
+                    alternating_indices = np.vstack((np.hstack([indices_higher, indices_lower[::-1]]), np.hstack([indices_lower[::-1], indices_higher]))).reshape((-1,), order='F')
+                    unique_indices = np.unique(alternating_indices, return_index=True)[1]
+                    alternating_indices = alternating_indices[np.sort(unique_indices)]
+                    for plot_index in alternating_indices:
+                        plot_correlation_fit = False
+                        if coeff_fitted[plot_index] is not None:
+                            plot_correlation_fit = True
+                            break
+                    if plot_correlation_fit:
+                        if np.all(np.isnan(coeff_fitted[plot_index][3:6])):
+                            y_fit = analysis_utils.gauss_offset(x_fit, *coeff_fitted[plot_index][[0, 1, 2, 6]])
+                            fit_label = "Gauss-Offset"
+                        else:
+                            y_fit = analysis_utils.double_gauss_offset(x_fit, *coeff_fitted[plot_index])
+                            fit_label = "Gauss-Gauss-Offset"
+
+                        plot_utils.plot_correlation_fit(x=x_ref,
+                                                        y=data[plot_index, :],
+                                                        x_fit=x_fit,
+                                                        y_fit=y_fit,
+                                                        xlabel='%s %s' % ("Column" if "column" in node.name.lower() else "Row", ref_name),
+                                                        fit_label=fit_label,
+                                                        title="Correlation of %s: %s vs. %s at %s %d" % (table_prefix + "s", ref_name, dut_name, table_prefix, plot_index),
+                                                        output_pdf=output_pdf,
+                                                        gui=gui,
+                                                        figs=figs)
+                    else:
+                        logging.warning("Cannot plot correlation fit, no fit data available")
+
+                    # Plot selected data with fit
+                    fit_fn = np.poly1d(re_fit[::-1])
+                    selected_indices = np.searchsorted(x_dut_scaled, x_dut_scaled_selected)
+                    mask = np.zeros_like(x_dut_scaled, dtype=np.bool)
+                    mask[selected_indices] = True
+
+                    plot_utils.plot_prealignment_fit(x=x_dut_scaled,
+                                                     mean_fitted=mean_fitted_scaled,
+                                                     mask=mask,
+                                                     fit_fn=fit_fn,
+                                                     fit=re_fit,
+                                                     pcov=re_fit_pcov,
+                                                     chi2=chi2,
+                                                     mean_error_fitted=mean_error_fitted_scaled,
+                                                     n_cluster=n_cluster,
+                                                     n_pixel_ref=n_pixel_ref,
+                                                     n_pixel_dut=n_pixel_dut,
+                                                     pixel_size_ref=pixel_size_ref,
+                                                     pixel_size_dut=pixel_size_dut,
+                                                     ref_name=ref_name,
+                                                     dut_name=dut_name,
+                                                     prefix=table_prefix,
+                                                     output_pdf=output_pdf,
+                                                     gui=gui,
+                                                     figs=figs)
+        except Exception:
+            if pool is not None:  # Do not wait for the pending fits
+                pool.terminate()
+                pool.join()
+                pool = None
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         if gui and not non_interactive:
             queue['in'].put([None])  # Put random element in queue to signal GUI thread end of interactive prealignment
@@ -536,7 +501,7 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
         logging.info('Store pre-alignment data in %s', output_alignment_file)
         with tb.open_file(output_alignment_file, mode="w") as out_file_h5:
             try:
-                result_table = out_file_h5.create_table(out_file_h5.root, name='PreAlignment', description=result.dtype, title='Prealignment alignment from correlation', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                result_table = out_file_h5.create_table(out_file_h5.root, name='PreAlignment', description=result.dtype, title='Prealignment alignment from correlation', filters=storage.get_filters('alignment'))
                 result_table.append(result)
             except tb.exceptions.NodeError:
                 logging.warning('Coarse alignment table exists already. Do not create new.')
@@ -548,7 +513,35 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
         return figs
 
 
-def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_fitted, chi2, fit_background, reduce_background):
+def _reduce_background(data):
+    ''' Reduces the background (uncorrelated events) of a correlation histogram by removing the first singular value.'''
+    uu, dd, vv = np.linalg.svd(data)  # sigular value decomposition
+    background = np.matrix(uu[:, :1]) * np.diag(dd[:1]) * np.matrix(vv[:1, :])  # take first sigular value for background
+    background = np.array(background, dtype=np.int32)  # make Numpy array
+    data = (data - background).astype(np.int32)  # remove background
+    data -= data.min()  # only positive values
+    return data
+
+
+def _get_hough_data(data):
+    ''' Selects the maximum of each row of a correlation histogram if it is larger than the half height. Returns the transposed selection for the Hough transform.'''
+    # calculate half hight
+    median = np.median(data)
+    median_max = np.median(np.max(data, axis=1))
+    half_median_data = (data > ((median + median_max) / 2))
+    # calculate maximum per column
+    max_select = np.argmax(data, axis=1)
+    hough_data = np.zeros_like(data)
+    hough_data[np.arange(data.shape[0]), max_select] = 1
+    # select maximums if larger than half hight
+    hough_data = hough_data & half_median_data
+    # transpose for correct angle
+    return hough_data.T
+
+
+def _fit_data(x, data, s_n, fit_background, reduce_background):
+    ''' Fits the correlation peak of each row of the correlation histogram. Returns the fit coefficients, the peak mean and its error,
+    the peak sigma and the chi2 for each row (NaN / None if the fit failed).'''
 
     def calc_limits_from_fit(x, coeff):
         ''' Calculates the fit limits from the last successfull fit.'''
@@ -574,7 +567,17 @@ def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_
         return True
 
     n_pixel_dut, n_pixel_ref = data.shape[0], data.shape[1]
-    # Start values for fitting
+    coeff_fitted = [None] * n_pixel_dut
+    mean_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Peak of the Gauss fit
+    mean_fitted.fill(np.nan)
+    mean_error_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Error of the fit of the peak
+    mean_error_fitted.fill(np.nan)
+    sigma_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Sigma of the Gauss fit
+    sigma_fitted.fill(np.nan)
+    chi2 = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Chi2 of the fit
+    chi2.fill(np.nan)
+
+    # Start values for fitting, calculated from the moments of all rows at once
     # Correlation peak
     mu_peak = x[np.argmax(data, axis=1)]
     A_peak = np.max(data, axis=1)  # signal / correlation peak
@@ -583,6 +586,9 @@ def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_
     A_background = np.mean(data, axis=1)  # noise / background halo
     mu_background = np.zeros_like(n_entries)
     mu_background[n_entries > 0] = np.average(data, axis=1, weights=x)[n_entries > 0] * np.sum(x) / n_entries[n_entries > 0]
+    sigma_background = np.zeros(shape=(n_pixel_dut,), dtype=np.float)
+    mean_position = np.dot(data, x)[n_entries > 0] / n_entries[n_entries > 0]
+    sigma_background[n_entries > 0] = np.sqrt(np.sum(data[n_entries > 0] * np.square(x[np.newaxis, :] - mean_position[:, np.newaxis]), axis=1) / n_entries[n_entries > 0])  # RMS of the row
 
     coeff = None
     fit_converged = False  # To signal that las fit was good, thus the results can be taken as start values for next fit
@@ -623,7 +629,7 @@ def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_
             p0 = coeff  # Set start values from last successfull fit
             bounds = calc_limits_from_fit(x, coeff)  # Set boundaries from previous converged fit
         else:  # No (last) successfull fit, try to dedeuce reasonable start values
-            p0 = [A_peak[index], mu_peak[index], 5.0, A_background[index], mu_background[index], analysis_utils.get_rms_from_histogram(data[index, :], x), 0.0]
+            p0 = [A_peak[index], mu_peak[index], 5.0, A_background[index], mu_background[index], sigma_background[index], 0.0]
             bounds = [[0.0, x.min(), 0.0, 0.0, x.min(), 0.0, 0.0], [2.0 * A_peak[index], x.max(), x.max() - x.min(), 2.0 * A_peak[index], x.max(), np.inf, A_peak[index]]]
 
         # Fit correlation
@@ -683,6 +689,8 @@ def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_
     if few_correlation_indices:
         logging.info('Very few correlation entries for indices %s. Omit correlation fit.', str(few_correlation_indices)[1:-1])
 
+    return coeff_fitted, mean_fitted, mean_error_fitted, sigma_fitted, chi2
+
 
 def refit_advanced(x_data, y_data, y_fit, p0):
     ''' Substract the fit from the data, thus only the small signal peak should be left.
@@ -759,42 +767,6 @@ def apply_alignment(input_hit_file, input_alignment_file, output_hit_file, inver
             n_duts = alignment.shape[0]
             use_prealignment = False
 
-    def apply_alignment_to_chunk(hits_chunk, dut_index, use_prealignment, alignment, inverse, no_z):
-        if use_prealignment:  # Apply transformation from pre-alignment information
-            (hits_chunk['x_dut_%d' % dut_index],
-             hits_chunk['y_dut_%d' % dut_index],
-             hit_z,
-             hits_chunk['xerr_dut_%d' % dut_index],
-             hits_chunk['yerr_dut_%d' % dut_index],
-             hits_chunk['zerr_dut_%d' % dut_index]) = geometry_utils.apply_alignment(
-                hits_x=hits_chunk['x_dut_%d' % dut_index],
-                hits_y=hits_chunk['y_dut_%d' % dut_index],
-                hits_z=hits_chunk['z_dut_%d' % dut_index],
-                hits_xerr=hits_chunk['xerr_dut_%d' % dut_index],
-                hits_yerr=hits_chunk['yerr_dut_%d' % dut_index],
-                hits_zerr=hits_chunk['zerr_dut_%d' % dut_index],
-                dut_index=dut_index,
-                prealignment=prealignment,
-                inverse=inverse)
-        else:  # Apply transformation from fine alignment information
-            (hits_chunk['x_dut_%d' % dut_index],
-             hits_chunk['y_dut_%d' % dut_index],
-             hit_z,
-             hits_chunk['xerr_dut_%d' % dut_index],
-             hits_chunk['yerr_dut_%d' % dut_index],
-             hits_chunk['zerr_dut_%d' % dut_index]) = geometry_utils.apply_alignment(
-                hits_x=hits_chunk['x_dut_%d' % dut_index],
-                hits_y=hits_chunk['y_dut_%d' % dut_index],
-                hits_z=hits_chunk['z_dut_%d' % dut_index],
-                hits_xerr=hits_chunk['xerr_dut_%d' % dut_index],
-                hits_yerr=hits_chunk['yerr_dut_%d' % dut_index],
-                hits_zerr=hits_chunk['zerr_dut_%d' % dut_index],
-                dut_index=dut_index,
-                alignment=alignment,
-                inverse=inverse)
-        if not no_z:
-            hits_chunk['z_dut_%d' % dut_index] = hit_z
-
     # Looper over the hits of all DUTs of all hit tables in chunks and apply the alignment
     with tb.open_file(input_hit_file, mode='r') as in_file_h5:
         with tb.open_file(output_hit_file, mode='w') as out_file_h5:
@@ -805,7 +777,7 @@ def apply_alignment(input_hit_file, input_alignment_file, output_hit_file, inver
                 if new_node_name == 'MergedCluster':  # Merged cluster with alignment are tracklets
                     new_node_name = 'Tracklets'
 
-                hits_aligned_table = out_file_h5.create_table(out_file_h5.root, name=new_node_name, description=np.zeros((1,), dtype=hits.dtype).dtype, title=hits.title, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                hits_aligned_table = out_file_h5.create_table(out_file_h5.root, name=new_node_name, description=np.zeros((1,), dtype=hits.dtype).dtype, title=hits.title, filters=storage.get_filters('tracklets'), chunkshape=storage.get_chunkshape('tracklets'))
 
                 progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=hits.shape[0], term_width=80)
                 progress_bar.start()
@@ -815,7 +787,7 @@ def apply_alignment(input_hit_file, input_alignment_file, output_hit_file, inver
                         if use_duts is not None and dut_index not in use_duts:  # omit DUT
                             continue
 
-                        apply_alignment_to_chunk(hits_chunk=hits_chunk, dut_index=dut_index, use_prealignment=use_prealignment, alignment=prealignment if use_prealignment else alignment, inverse=inverse, no_z=no_z)
+                        _apply_alignment_to_hits(hits=hits_chunk, dut_index=dut_index, use_prealignment=use_prealignment, alignment=prealignment if use_prealignment else alignment, inverse=inverse, no_z=no_z)
 
                     hits_aligned_table.append(hits_chunk)
                     progress_bar.update(index)
@@ -1056,136 +1028,129 @@ def _duts_alignment(track_candidates_file, alignment_file, alignment_index, alig
                 track_quality_mask |= ((1 << dut) << quality * 8)
 
     logging.info('Use track with hits in DUTs %s', str(selection_hit_duts)[1:-1])
-    data_selection.select_hits(hit_file=track_candidates_file,
-                               output_file=os.path.splitext(track_candidates_file)[0] + '_reduced_%d.h5' % alignment_index,
-                               max_hits=use_n_tracks,
-                               track_quality=track_quality_mask,
-                               track_quality_mask=track_quality_mask,
-                               chunk_size=chunk_size)
-    track_candidates_reduced = os.path.splitext(track_candidates_file)[0] + '_reduced_%d.h5' % alignment_index
+    # The reduced track candidates are read once and kept in memory for all alignment iterations
+    track_candidates_reduced = []
+    with tb.open_file(track_candidates_file, mode='r') as in_file_h5:
+        track_candidates_table = in_file_h5.root.TrackCandidates
+        for track_candidates_chunk, _ in analysis_utils.data_aligned_at_events(track_candidates_table, chunk_size=chunk_size):
+            track_candidates_reduced.append(data_selection.select_hits_in_chunk(hits=track_candidates_chunk,
+                                                                                total_hits=track_candidates_table.shape[0],
+                                                                                max_hits=use_n_tracks,
+                                                                                track_quality=track_quality_mask,
+                                                                                track_quality_mask=track_quality_mask))
+    track_candidates_reduced = np.concatenate(track_candidates_reduced)
 
     # Step 1: Take the found tracks and revert the pre-alignment to start alignment from the beginning
     logging.info('= Alignment step 1: Revert pre-alignment =')
-    apply_alignment(input_hit_file=track_candidates_reduced,
-                    input_alignment_file=alignment_file,  # Revert prealignent
-                    output_hit_file=os.path.splitext(track_candidates_reduced)[0] + '_not_aligned.h5',
-                    inverse=True,
-                    force_prealignment=True,
-                    chunk_size=chunk_size)
-
-    # Stage N: Repeat alignment with constrained residuals until total residual does not decrease anymore
-    _calculate_translation_alignment(track_candidates_file=os.path.splitext(track_candidates_reduced)[0] + '_not_aligned.h5',
-                                     alignment_file=alignment_file,
-                                     fit_duts=align_duts,
-                                     selection_fit_duts=selection_fit_duts,
-                                     selection_hit_duts=selection_hit_duts,
-                                     selection_track_quality=selection_track_quality,
-                                     n_pixels=n_pixels,
+    with tb.open_file(alignment_file, mode="r") as in_file_h5:  # Open file with alignment data
+        prealignment = in_file_h5.root.PreAlignment[:]
+    for dut_index in range(n_duts):
+        _apply_alignment_to_hits(hits=track_candidates_reduced, dut_index=dut_index, use_prealignment=True, alignment=prealignment, inverse=True, no_z=False)
+
+    pool = Pool()
+    try:
+        # Stage N: Repeat alignment with constrained residuals until total residual does not decrease anymore
+        _calculate_translation_alignment(track_candidates=track_candidates_reduced,
+                                         alignment_file=alignment_file,
+                                         fit_duts=align_duts,
+                                         selection_fit_duts=selection_fit_duts,
+                                         selection_hit_duts=selection_hit_duts,
+                                         selection_track_quality=selection_track_quality,
+                                         n_pixels=n_pixels,
+                                         pixel_size=pixel_size,
+                                         n_duts=n_duts,
+                                         max_iterations=max_iterations,
+                                         plot_title_prefix='',
+                                         output_pdf=None,
+                                         pool=pool)
+
+        # Plot final result
+        if plot:
+            logging.info('= Alignment step 7: Plot final result =')
+            with tb.open_file(alignment_file, mode="r") as in_file_h5:  # Open file with alignment data
+                alignment = in_file_h5.root.Alignment[:]
+            with PdfPages(os.path.join(os.path.dirname(os.path.realpath(track_candidates_file)), 'Alignment_%d.pdf' % alignment_index), keep_empty=False) as output_pdf:
+                # Apply final alignment result and fit tracks without the actual DUT hit for unconstrained residuals
+                track_hits_intersections = _fit_track_candidates(track_candidates=_get_aligned_track_candidates(track_candidates_reduced, alignment, n_duts),
+                                                                 alignment=alignment,
+                                                                 fit_duts=align_duts,
+                                                                 selection_fit_duts=selection_fit_duts,
+                                                                 selection_hit_duts=selection_hit_duts,
+                                                                 selection_track_quality=selection_track_quality,
+                                                                 exclude_dut_hit=True,
+                                                                 pool=pool)
+                _histogram_residuals(track_hits_intersections=track_hits_intersections,
                                      pixel_size=pixel_size,
-                                     n_duts=n_duts,
-                                     max_iterations=max_iterations,
-                                     plot_title_prefix='',
-                                     output_pdf=None,
-                                     chunk_size=chunk_size)
+                                     output_pdf=output_pdf)
+    except Exception:  # Do not wait for the pending fits
+        pool.terminate()
+        pool.join()
+        pool = None
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    # Plot final result
-    if plot:
-        logging.info('= Alignment step 7: Plot final result =')
-        with PdfPages(os.path.join(os.path.dirname(os.path.realpath(track_candidates_file)), 'Alignment_%d.pdf' % alignment_index), keep_empty=False) as output_pdf:
-            # Apply final alignment result
-            apply_alignment(input_hit_file=os.path.splitext(track_candidates_reduced)[0] + '_not_aligned.h5',
-                            input_alignment_file=alignment_file,
-                            output_hit_file=os.path.splitext(track_candidates_file)[0] + '_final_tmp_%s.h5' % alignment_index,
-                            chunk_size=chunk_size)
-            fit_tracks(input_track_candidates_file=os.path.splitext(track_candidates_file)[0] + '_final_tmp_%d.h5' % alignment_index,
-                       input_alignment_file=alignment_file,
-                       output_tracks_file=os.path.splitext(track_candidates_file)[0] + '_tracks_final_tmp_%d.h5' % alignment_index,
-                       fit_duts=align_duts,  # Only create residuals of selected DUTs
-                       selection_fit_duts=selection_fit_duts,  # Only use selected duts
-                       selection_hit_duts=selection_hit_duts,
-                       exclude_dut_hit=True,  # For unconstrained residuals
-                       selection_track_quality=selection_track_quality,
-                       chunk_size=chunk_size)
-            calculate_residuals(input_tracks_file=os.path.splitext(track_candidates_file)[0] + '_tracks_final_tmp_%d.h5' % alignment_index,
-                                input_alignment_file=alignment_file,
-                                output_residuals_file=os.path.splitext(track_candidates_file)[0] + '_residuals_final_tmp_%d.h5' % alignment_index,
-                                n_pixels=n_pixels,
-                                pixel_size=pixel_size,
-                                plot=plot,
-                                chunk_size=chunk_size)
-            os.remove(os.path.splitext(track_candidates_file)[0] + '_final_tmp_%d.h5' % alignment_index)
-            os.remove(os.path.splitext(track_candidates_file)[0] + '_tracks_final_tmp_%d.h5' % alignment_index)
-            os.remove(os.path.splitext(track_candidates_file)[0] + '_tracks_final_tmp_%d.pdf' % alignment_index)
-            os.remove(os.path.splitext(track_candidates_file)[0] + '_residuals_final_tmp_%d.h5' % alignment_index)
-
-    os.remove(os.path.splitext(track_candidates_reduced)[0] + '_not_aligned.h5')
-    os.remove(os.path.splitext(track_candidates_file)[0] + '_reduced_%d.h5' % alignment_index)
-
-
-def _calculate_translation_alignment(track_candidates_file, alignment_file, fit_duts, selection_fit_duts, selection_hit_duts, selection_track_quality, n_pixels, pixel_size, n_duts, max_iterations, plot_title_prefix='', output_pdf=None, chunk_size=100000):
+
+def _calculate_translation_alignment(track_candidates, alignment_file, fit_duts, selection_fit_duts, selection_hit_duts, selection_track_quality, n_pixels, pixel_size, n_duts, max_iterations, plot_title_prefix='', output_pdf=None, pool=None):
     ''' Main function that fits tracks, calculates the residuals, deduces rotation and translation values from the residuals
     and applies the new alignment to the track hits. The alignment result is scored as a combined
-    residual value of all planes that are being aligned in x and y weighted by the pixel pitch in x and y. '''
+    residual value of all planes that are being aligned in x and y weighted by the pixel pitch in x and y.
+
+    All iterations are done in memory on the track candidates array (without pre-alignment), only the best alignment
+    is stored into the alignment file. '''
     with tb.open_file(alignment_file, mode="r") as in_file_h5:  # Open file with alignment data
         alignment_last_iteration = in_file_h5.root.Alignment[:]
 
-    total_residual = None
-    for iteration in range(max_iterations):
-        if iteration >= max_iterations:
-            raise RuntimeError('Did not converge to good solution in %d iterations. Increase max_iterations', iteration)
-
-        apply_alignment(input_hit_file=track_candidates_file,  # Always apply alignment to starting file
-                        input_alignment_file=alignment_file,
-                        output_hit_file=os.path.splitext(track_candidates_file)[0] + '_no_align_%d_tmp.h5' % iteration,
-                        inverse=False,
-                        force_prealignment=False,
-                        chunk_size=chunk_size)
-
-        # Step 2: Fit tracks for all DUTs
-        logging.info('= Alignment step 2 / iteration %d: Fit tracks for all DUTs =', iteration)
-        fit_tracks(input_track_candidates_file=os.path.splitext(track_candidates_file)[0] + '_no_align_%d_tmp.h5' % iteration,
-                   input_alignment_file=alignment_file,
-                   output_tracks_file=os.path.splitext(track_candidates_file)[0] + '_tracks_%d_tmp.h5' % iteration,
-                   fit_duts=fit_duts,  # Only create residuals of selected DUTs
-                   selection_fit_duts=selection_fit_duts,   # Only use selected DUTs for track fit
-                   selection_hit_duts=selection_hit_duts,  # Only use selected duts
-                   exclude_dut_hit=False,  # For constrained residuals
-                   selection_track_quality=selection_track_quality,
-                   force_prealignment=False,
-                   chunk_size=chunk_size)
-
-        # Step 3: Calculate the residuals for each DUT
-        logging.info('= Alignment step 3 / iteration %d: Calculate the residuals for each selected DUT =', iteration)
-        calculate_residuals(input_tracks_file=os.path.splitext(track_candidates_file)[0] + '_tracks_%d_tmp.h5' % iteration,
-                            input_alignment_file=alignment_file,
-                            output_residuals_file=os.path.splitext(track_candidates_file)[0] + '_residuals_%d_tmp.h5' % iteration,
-                            n_pixels=n_pixels,
-                            pixel_size=pixel_size,
-                            # smaller devices needs None, otherwise npixels_per_bin=5 and nbins_per_pixel=1 might improve the first step
-                            npixels_per_bin=None,
-                            nbins_per_pixel=None,
-                            plot=False,
-                            chunk_size=chunk_size)
-
-        # Step 4: Deduce rotations from the residuals
-        logging.info('= Alignment step 4 / iteration %d: Deduce rotations and translations from the residuals =', iteration)
-        alignment_parameters_change, new_total_residual = _analyze_residuals(residuals_file=os.path.splitext(track_candidates_file)[0] + '_residuals_%d_tmp.h5' % iteration,
-                                                                             fit_duts=fit_duts,
-                                                                             pixel_size=pixel_size,
-                                                                             n_duts=n_duts,
-                                                                             translation_only=False,
-                                                                             plot_title_prefix=plot_title_prefix,
-                                                                             relaxation_factor=1.0,  # FIXME: good code practice: nothing hardcoded
-                                                                             output_pdf=output_pdf)
-
-        # Create actual alignment (old alignment + the actual relative change)
-        new_alignment_parameters = geometry_utils.merge_alignment_parameters(
-            alignment_last_iteration,
-            alignment_parameters_change,
-            select_duts=fit_duts,
-            mode='relative')
-
-        # FIXME: This step does not work well
+    if pool is None:
+        pool = Pool()
+        close_pool = True
+    else:
+        close_pool = False
+
+    try:
+        total_residual = None
+        for iteration in range(max_iterations):
+            # Always apply alignment to starting data
+            track_candidates_aligned = _get_aligned_track_candidates(track_candidates, alignment_last_iteration, n_duts)
+
+            # Step 2: Fit tracks for all DUTs
+            logging.info('= Alignment step 2 / iteration %d: Fit tracks for all DUTs =', iteration)
+            track_hits_intersections = _fit_track_candidates(track_candidates=track_candidates_aligned,
+                                                             alignment=alignment_last_iteration,
+                                                             fit_duts=fit_duts,  # Only create residuals of selected DUTs
+                                                             selection_fit_duts=selection_fit_duts,   # Only use selected DUTs for track fit
+                                                             selection_hit_duts=selection_hit_duts,  # Only use selected duts
+                                                             selection_track_quality=selection_track_quality,
+                                                             exclude_dut_hit=False,  # For constrained residuals
+                                                             pool=pool)
+            del track_candidates_aligned
+
+            # Step 3: Calculate the residuals for each DUT
+            logging.info('= Alignment step 3 / iteration %d: Calculate the residuals for each selected DUT =', iteration)
+            residuals = _histogram_residuals(track_hits_intersections=track_hits_intersections,
+                                             pixel_size=pixel_size)
+
+            # Step 4: Deduce rotations from the residuals
+            logging.info('= Alignment step 4 / iteration %d: Deduce rotations and translations from the residuals =', iteration)
+            alignment_parameters_change, new_total_residual = _analyze_residuals(residuals=residuals,
+                                                                                 fit_duts=fit_duts,
+                                                                                 pixel_size=pixel_size,
+                                                                                 n_duts=n_duts,
+                                                                                 translation_only=False,
+                                                                                 plot_title_prefix=plot_title_prefix,
+                                                                                 relaxation_factor=1.0,  # FIXME: good code practice: nothing hardcoded
+                                                                                 output_pdf=output_pdf)
+
+            # Create actual alignment (old alignment + the actual relative change)
+            new_alignment_parameters = geometry_utils.merge_alignment_parameters(
+                alignment_last_iteration,
+                alignment_parameters_change,
+                select_duts=fit_duts,
+                mode='relative')
+
+            # FIXME: This step does not work well
 #         # Step 5: Try to find better rotation by minimizing the residual in x + y for different angles
 #         logging.info('= Alignment step 5 / iteration %d: Optimize alignment by minimizing residuals =', iteration)
 #         new_alignment_parameters, new_total_residual = _optimize_alignment(tracks_file=os.path.splitext(track_candidates_file)[0] + '_tracks_%d_tmp.h5' % iteration,
@@ -1193,31 +1158,32 @@ def _calculate_translation_alignment(track_candidates_file, alignment_file, fit_
 #                                                                            new_alignment_parameters=new_alignment_parameters,
 #                                                                            pixel_size=pixel_size)
 
-        # Delete not needed files
-        os.remove(os.path.splitext(track_candidates_file)[0] + '_no_align_%d_tmp.h5' % iteration)
-        os.remove(os.path.splitext(track_candidates_file)[0] + '_tracks_%d_tmp.h5' % iteration)
-        os.remove(os.path.splitext(track_candidates_file)[0] + '_tracks_%d_tmp.pdf' % iteration)
-        os.remove(os.path.splitext(track_candidates_file)[0] + '_residuals_%d_tmp.h5' % iteration)
-        logging.info('Total residual %1.4e', new_total_residual)
-
-        if total_residual is not None and new_total_residual > total_residual:  # True if actual alignment is worse than the alignment from last iteration
-            logging.info('!! Best alignment found !!')
-            logging.info('= Alignment step 6 / iteration %d: Use rotation / translation information from previous iteration =', iteration)
-            geometry_utils.store_alignment_parameters(alignment_file,  # Store alignment from last iteration
-                                                      alignment_last_iteration,
-                                                      mode='absolute',
-                                                      select_duts=fit_duts)
-            return
-        else:
-            total_residual = new_total_residual
-
-        alignment_last_iteration = new_alignment_parameters.copy()  # in_file_h5.root.Alignment[:]
-
-        logging.info('= Alignment step 6 / iteration %d: Set new rotation / translation information in alignment file =', iteration)
-        geometry_utils.store_alignment_parameters(alignment_file,
-                                                  new_alignment_parameters,
-                                                  mode='absolute',
-                                                  select_duts=fit_duts)
+            logging.info('Total residual %1.4e', new_total_residual)
+
+            if total_residual is not None and new_total_residual > total_residual:  # True if actual alignment is worse than the alignment from last iteration
+                logging.info('!! Best alignment found !!')
+                logging.info('= Alignment step 6 / iteration %d: Use rotation / translation information from previous iteration =', iteration)
+                break
+            else:
+                total_residual = new_total_residual
+
+            logging.info('= Alignment step 6 / iteration %d: Set new rotation / translation information =', iteration)
+            alignment_last_iteration = new_alignment_parameters.copy()
+    except Exception:
+        if close_pool:  # Do not wait for the pending fits
+            pool.terminate()
+            pool.join()
+            close_pool = False
+        raise
+    finally:
+        if close_pool:
+            pool.close()
+            pool.join()
+
+    geometry_utils.store_alignment_parameters(alignment_file,  # Store best alignment
+                                              alignment_last_iteration,
+                                              mode='absolute',
+                                              select_duts=fit_duts)
 
 
 # Helper functions for the alignment. Not to be used directly.
@@ -1238,68 +1204,209 @@ def _create_alignment_array(n_duts):
     return array
 
 
-def _analyze_residuals(residuals_file, fit_duts, pixel_size, n_duts, translation_only=False, relaxation_factor=1.0, plot_title_prefix='', output_pdf=None):
-    ''' Take the residual plots and deduce rotation and translation angles from them '''
+def _apply_alignment_to_hits(hits, dut_index, use_prealignment, alignment, inverse, no_z):
+    ''' Applies the (pre-)alignment to the hits (positions and errors) of one DUT in place. '''
+    if use_prealignment:  # Apply transformation from pre-alignment information
+        alignment_kwargs = dict(prealignment=alignment)
+    else:  # Apply transformation from fine alignment information
+        alignment_kwargs = dict(alignment=alignment)
+    hit_x, hit_y, hit_z, hit_xerr, hit_yerr, hit_zerr = geometry_utils.apply_alignment(  # Transform with float64 precision also for reduced precision hits
+        hits_x=analysis_utils.get_dut_data(hits, 'x', dut_index).astype(np.float64, copy=False),
+        hits_y=analysis_utils.get_dut_data(hits, 'y', dut_index).astype(np.float64, copy=False),
+        hits_z=analysis_utils.get_dut_data(hits, 'z', dut_index).astype(np.float64, copy=False),
+        hits_xerr=analysis_utils.get_dut_data(hits, 'xerr', dut_index).astype(np.float64, copy=False),
+        hits_yerr=analysis_utils.get_dut_data(hits, 'yerr', dut_index).astype(np.float64, copy=False),
+        hits_zerr=analysis_utils.get_dut_data(hits, 'zerr', dut_index).astype(np.float64, copy=False),
+        dut_index=dut_index,
+        inverse=inverse,
+        **alignment_kwargs)
+    for field, values in (('x', hit_x), ('y', hit_y), ('xerr', hit_xerr), ('yerr', hit_yerr), ('zerr', hit_zerr)):
+        analysis_utils.set_dut_data(hits, field, values, dut_index=dut_index)
+    if not no_z:
+        analysis_utils.set_dut_data(hits, 'z', hit_z, dut_index=dut_index)
+
+
+def _get_aligned_track_candidates(track_candidates, alignment, n_duts):
+    ''' Returns a copy of the track candidates with the alignment applied to all DUTs. '''
+    track_candidates_aligned = track_candidates.copy()
+    for dut_index in range(n_duts):
+        _apply_alignment_to_hits(hits=track_candidates_aligned, dut_index=dut_index, use_prealignment=False, alignment=alignment, inverse=False, no_z=False)
+    return track_candidates_aligned
+
+
+def _fit_track_candidates(track_candidates, alignment, fit_duts, selection_fit_duts, selection_hit_duts, selection_track_quality, exclude_dut_hit, pool):
+    ''' Fits a straight line through the track candidates in memory, the same as fit_tracks(method='Fit').
+    Returns a dictionary with the fit DUT as key and the DUT hits and the track intersections with the DUT plane as value. '''
+    track_hits_intersections = {}
+    for fit_dut in fit_duts:
+        track_quality_mask = 0
+        for index, dut in enumerate(selection_hit_duts):
+            if exclude_dut_hit and dut == fit_dut:
+                continue
+            for quality in range(3):
+                if quality <= selection_track_quality[index]:
+                    track_quality_mask |= ((1 << dut) << quality * 8)
+        dut_fit_selection = sorted(set(dut for dut in selection_fit_duts if not exclude_dut_hit or dut != fit_dut))
+        if len(dut_fit_selection) < 2:
+            logging.warning('Insufficient track hits to do the fit (< 2). Omit DUT%d', fit_dut)
+            continue
+
+        if exclude_dut_hit or not track_hits_intersections:  # Constrained tracks are the same for all fit DUTs and are fitted only once
+            good_track_selection = (track_candidates['track_quality'] & track_quality_mask) == track_quality_mask
+            good_track_selection &= track_candidates['n_tracks'] > 0  # n_tracks < 0 means merged cluster
+            good_track_candidates = track_candidates[good_track_selection]
+
+            track_hits = np.empty((good_track_candidates.shape[0], len(dut_fit_selection), 3), dtype=np.float)
+            for index, dut_index in enumerate(dut_fit_selection):
+                for dimension, field in enumerate(('x', 'y', 'z')):
+                    track_hits[:, index, dimension] = analysis_utils.get_dut_data(good_track_candidates, field, dut_index)
+
+            # Split data and fit on all available cores
+            results = pool.map(_fit_tracks_loop, np.array_split(track_hits, cpu_count()))
+            del track_hits
+            offsets = np.concatenate([i[0] for i in results])  # Merge offsets from all cores in results
+            slopes = np.concatenate([i[1] for i in results])  # Merge slopes from all cores in results
+            chi2s = np.concatenate([i[2] for i in results])  # Merge chi2 from all cores in results
+
+        # Intersect the tracks with the tilted DUT plane
+        dut_position = np.array([alignment[fit_dut]['translation_x'], alignment[fit_dut]['translation_y'], alignment[fit_dut]['translation_z']])
+        rotation_matrix = geometry_utils.rotation_matrix(alpha=alignment[fit_dut]['alpha'],
+                                                         beta=alignment[fit_dut]['beta'],
+                                                         gamma=alignment[fit_dut]['gamma'])
+        basis_global = rotation_matrix.T.dot(np.eye(3))
+        dut_plane_normal = basis_global[2]
+        intersections = geometry_utils.get_line_intersections_with_plane(line_origins=offsets,
+                                                                         line_directions=slopes,
+                                                                         position_plane=dut_position,
+                                                                         normal_plane=dut_plane_normal)
+
+        # Take only tracks where actual dut has a hit, otherwise residual wrong
+        selection = np.logical_and(~np.isnan(analysis_utils.get_dut_data(good_track_candidates, 'x', fit_dut)), ~np.isnan(chi2s))
+        hits = np.column_stack([analysis_utils.get_dut_data(good_track_candidates, field, fit_dut) for field in ('x', 'y', 'z')])
+        track_hits_intersections[fit_dut] = (hits[selection], intersections[selection])
+
+    return track_hits_intersections
+
+
+def _histogram_residuals(track_hits_intersections, pixel_size, output_pdf=None):
+    ''' Histograms and fits the global residuals in memory, the same as calculate_residuals() with automatic binning.
+    Returns a dictionary with the histogram name as key and the histogram, edges and fit result as value. '''
+    residuals = {}
+    for dut_index, (hits, intersections) in track_hits_intersections.items():
+        difference = hits - intersections
+        title = 'Residuals for DUT%d' % dut_index
+
+        # Uniform binning of the residual and position axes, the edges are calculated without histogramming the data
+        nbins, x_range = _get_residual_binning(difference[:, 0], pixel_size=pixel_size[dut_index][0])
+        residual_x_edges = np.histogram_bin_edges(difference[:, 0], range=x_range, bins=nbins)
+        position_x_edges = np.histogram_bin_edges(intersections[:, 0], bins=_get_position_binning(intersections[:, 0], pixel_size=pixel_size[dut_index][0]))
+        nbins, y_range = _get_residual_binning(difference[:, 1], pixel_size=pixel_size[dut_index][1])
+        residual_y_edges = np.histogram_bin_edges(difference[:, 1], range=y_range, bins=nbins)
+        position_y_edges = np.histogram_bin_edges(intersections[:, 1], bins=_get_position_binning(intersections[:, 1], pixel_size=pixel_size[dut_index][1]))
+
+        hist_residual_x = np.zeros(shape=(residual_x_edges.shape[0] - 1,), dtype=np.int64)
+        hist_residual_y = np.zeros(shape=(residual_y_edges.shape[0] - 1,), dtype=np.int64)
+        hist_x_residual_x = np.zeros(shape=(position_x_edges.shape[0] - 1, residual_x_edges.shape[0] - 1), dtype=np.float64)
+        hist_y_residual_y = np.zeros(shape=(position_y_edges.shape[0] - 1, residual_y_edges.shape[0] - 1), dtype=np.float64)
+        hist_x_residual_y = np.zeros(shape=(position_x_edges.shape[0] - 1, residual_y_edges.shape[0] - 1), dtype=np.float64)
+        hist_y_residual_x = np.zeros(shape=(position_y_edges.shape[0] - 1, residual_x_edges.shape[0] - 1), dtype=np.float64)
+        _fill_residual_histograms(residual_x=difference[:, 0], residual_y=difference[:, 1], position_x=intersections[:, 0], position_y=intersections[:, 1],
+                                  residual_x_edges=residual_x_edges, residual_y_edges=residual_y_edges, position_x_edges=position_x_edges, position_y_edges=position_y_edges,
+                                  hist_residual_x=hist_residual_x, hist_residual_y=hist_residual_y,
+                                  hist_x_residual_x=hist_x_residual_x, hist_y_residual_y=hist_y_residual_y, hist_x_residual_y=hist_x_residual_y, hist_y_residual_x=hist_y_residual_x)
+
+        fit_residual_x, cov_residual_x = analysis_utils.fit_residuals(hist=hist_residual_x,
+                                                                      edges=residual_x_edges,
+                                                                      label='X residual [um]',
+                                                                      title=title,
+                                                                      output_pdf=output_pdf)
+        residuals['ResidualsX_DUT%d' % dut_index] = {'hist': hist_residual_x, 'edges': residual_x_edges, 'fit_coeff': fit_residual_x, 'fit_cov': cov_residual_x}
+
+        fit_residual_y, cov_residual_y = analysis_utils.fit_residuals(hist=hist_residual_y,
+                                                                      edges=residual_y_edges,
+                                                                      label='Y residual [um]',
+                                                                      title=title,
+                                                                      output_pdf=output_pdf)
+        residuals['ResidualsY_DUT%d' % dut_index] = {'hist': hist_residual_y, 'edges': residual_y_edges, 'fit_coeff': fit_residual_y, 'fit_cov': cov_residual_y}
+
+        # Residuals as a function of the position: (name, histogram, position edges, residual edges, x label, y label)
+        for name, hist, xedges, yedges, xlabel, ylabel in (('XResidualsX', hist_x_residual_x, position_x_edges, residual_x_edges, 'X position [um]', 'X residual [um]'),
+                                                           ('YResidualsY', hist_y_residual_y, position_y_edges, residual_y_edges, 'Y position [um]', 'Y residual [um]'),
+                                                           ('XResidualsY', hist_x_residual_y, position_x_edges, residual_y_edges, 'X position [um]', 'Y residual [um]'),
+                                                           ('YResidualsX', hist_y_residual_x, position_y_edges, residual_x_edges, 'Y position [um]', 'X residual [um]')):
+            fit, cov = analysis_utils.fit_residuals_vs_position(hist=hist,
+                                                                xedges=xedges,
+                                                                yedges=yedges,
+                                                                xlabel=xlabel,
+                                                                ylabel=ylabel,
+                                                                title=title,
+                                                                output_pdf=output_pdf)
+            residuals['%s_DUT%d' % (name, dut_index)] = {'hist': hist, 'xedges': xedges, 'yedges': yedges, 'fit_coeff': fit, 'fit_cov': cov}
+
+    return residuals
+
+
+def _analyze_residuals(residuals, fit_duts, pixel_size, n_duts, translation_only=False, relaxation_factor=1.0, plot_title_prefix='', output_pdf=None):
+    ''' Take the residual histograms and deduce rotation and translation angles from them '''
     alignment_parameters = _create_alignment_array(n_duts)
 
     total_residual = 0  # Sum of all residuals to judge the overall alignment
 
-    with tb.open_file(residuals_file) as in_file_h5:
-        for dut_index in fit_duts:
-            alignment_parameters[dut_index]['DUT'] = dut_index
-            # Global residuals
-            hist_node = in_file_h5.get_node('/ResidualsX_DUT%d' % dut_index)
-            std_x = hist_node._v_attrs.fit_coeff[2]
-
-            # Add resdidual to total residual normalized to pixel pitch in x
-            total_residual = np.sqrt(np.square(total_residual) + np.square(std_x / pixel_size[dut_index][0]))
-
-            if output_pdf is not None:
-                plot_utils.plot_residuals(histogram=hist_node[:],
-                                          edges=hist_node._v_attrs.xedges,
-                                          fit=hist_node._v_attrs.fit_coeff,
-                                          fit_errors=hist_node._v_attrs.fit_cov,
-                                          title='Residuals for DUT%d' % dut_index,
-                                          x_label='X residual [um]',
-                                          output_pdf=output_pdf)
-
-            hist_node = in_file_h5.get_node('/ResidualsY_DUT%d' % dut_index)
-            std_y = hist_node._v_attrs.fit_coeff[2]
-
-            # Add resdidual to total residual normalized to pixel pitch in y
-            total_residual = np.sqrt(np.square(total_residual) + np.square(std_y / pixel_size[dut_index][1]))
-
-            if translation_only:
-                return alignment_parameters, total_residual
-
-            if output_pdf is not None:
-                plot_utils.plot_residuals(histogram=hist_node[:],
-                                          edges=hist_node._v_attrs.xedges,
-                                          fit=hist_node._v_attrs.fit_coeff,
-                                          fit_errors=hist_node._v_attrs.fit_cov,
-                                          title='Residuals for DUT%d' % dut_index,
-                                          x_label='Y residual [um]',
-                                          output_pdf=output_pdf)
-
-            # use offset at origin of sensor (center of sensor) to calculate x and y correction
-            # do not use mean/median of 1D residual since it depends on the beam spot position when the device is rotated
-            mu_x = in_file_h5.get_node_attr('/YResidualsX_DUT%d' % dut_index, 'fit_coeff')[0]
-            mu_y = in_file_h5.get_node_attr('/XResidualsY_DUT%d' % dut_index, 'fit_coeff')[0]
-            # use slope to calculate alpha, beta and gamma
-            m_xx = in_file_h5.get_node_attr('/XResidualsX_DUT%d' % dut_index, 'fit_coeff')[1]
-            m_yy = in_file_h5.get_node_attr('/YResidualsY_DUT%d' % dut_index, 'fit_coeff')[1]
-            m_xy = in_file_h5.get_node_attr('/XResidualsY_DUT%d' % dut_index, 'fit_coeff')[1]
-            m_yx = in_file_h5.get_node_attr('/YResidualsX_DUT%d' % dut_index, 'fit_coeff')[1]
-
-            alpha, beta, gamma = analysis_utils.get_rotation_from_residual_fit(m_xx=m_xx, m_xy=m_xy, m_yx=m_yx, m_yy=m_yy)
-
-            alignment_parameters[dut_index]['correlation_x'] = std_x
-            alignment_parameters[dut_index]['translation_x'] = -mu_x
-            alignment_parameters[dut_index]['correlation_y'] = std_y
-            alignment_parameters[dut_index]['translation_y'] = -mu_y
-            alignment_parameters[dut_index]['alpha'] = alpha * relaxation_factor
-            alignment_parameters[dut_index]['beta'] = beta * relaxation_factor
-            alignment_parameters[dut_index]['gamma'] = gamma * relaxation_factor
+    for dut_index in fit_duts:
+        alignment_parameters[dut_index]['DUT'] = dut_index
+        # Global residuals
+        hist_residual_x = residuals['ResidualsX_DUT%d' % dut_index]
+        std_x = hist_residual_x['fit_coeff'][2]
+
+        # Add resdidual to total residual normalized to pixel pitch in x
+        total_residual = np.sqrt(np.square(total_residual) + np.square(std_x / pixel_size[dut_index][0]))
+
+        if output_pdf is not None:
+            plot_utils.plot_residuals(histogram=hist_residual_x['hist'],
+                                      edges=hist_residual_x['edges'],
+                                      fit=hist_residual_x['fit_coeff'],
+                                      fit_errors=hist_residual_x['fit_cov'],
+                                      title='Residuals for DUT%d' % dut_index,
+                                      x_label='X residual [um]',
+                                      output_pdf=output_pdf)
+
+        hist_residual_y = residuals['ResidualsY_DUT%d' % dut_index]
+        std_y = hist_residual_y['fit_coeff'][2]
+
+        # Add resdidual to total residual normalized to pixel pitch in y
+        total_residual = np.sqrt(np.square(total_residual) + np.square(std_y / pixel_size[dut_index][1]))
+
+        if translation_only:
+            return alignment_parameters, total_residual
+
+        if output_pdf is not None:
+            plot_utils.plot_residuals(histogram=hist_residual_y['hist'],
+                                      edges=hist_residual_y['edges'],
+                                      fit=hist_residual_y['fit_coeff'],
+                                      fit_errors=hist_residual_y['fit_cov'],
+                                      title='Residuals for DUT%d' % dut_index,
+                                      x_label='Y residual [um]',
+                                      output_pdf=output_pdf)
+
+        # use offset at origin of sensor (center of sensor) to calculate x and y correction
+        # do not use mean/median of 1D residual since it depends on the beam spot position when the device is rotated
+        mu_x = residuals['YResidualsX_DUT%d' % dut_index]['fit_coeff'][0]
+        mu_y = residuals['XResidualsY_DUT%d' % dut_index]['fit_coeff'][0]
+        # use slope to calculate alpha, beta and gamma
+        m_xx = residuals['XResidualsX_DUT%d' % dut_index]['fit_coeff'][1]
+        m_yy = residuals['YResidualsY_DUT%d' % dut_index]['fit_coeff'][1]
+        m_xy = residuals['XResidualsY_DUT%d' % dut_index]['fit_coeff'][1]
+        m_yx = residuals['YResidualsX_DUT%d' % dut_index]['fit_coeff'][1]
+
+        alpha, beta, gamma = analysis_utils.get_rotation_from_residual_fit(m_xx=m_xx, m_xy=m_xy, m_yx=m_yx, m_yy=m_yy)
+
+        alignment_parameters[dut_index]['correlation_x'] = std_x
+        alignment_parameters[dut_index]['translation_x'] = -mu_x
+        alignment_parameters[dut_index]['correlation_y'] = std_y
+        alignment_parameters[dut_index]['translation_y'] = -mu_y
+        alignment_parameters[dut_index]['alpha'] = alpha * relaxation_factor
+        alignment_parameters[dut_index]['beta'] = beta * relaxation_factor
+        alignment_parameters[dut_index]['gamma'] = gamma * relaxation_factor
 
     return alignment_parameters, total_residual
 
@@ -1440,13 +1547,20 @@ def _optimize_alignment(tracks_file, alignment_last_iteration, new_alignment_par
 
 
 # Helper functions to be called from multiple processes
-def _correlate_cluster(cluster_dut_0, cluster_file, start_index, start_event_number, stop_event_number, column_correlation, row_correlation, chunk_size):
-    with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open other DUT cluster file
-        for actual_dut_cluster, start_index in analysis_utils.data_aligned_at_events(actual_in_file_h5.root.Cluster, start_index=start_index, start_event_number=start_event_number, stop_event_number=stop_event_number, chunk_size=chunk_size, fail_on_missing_events=False):  # Loop over the cluster in the actual cluster file in chunks
-
-            analysis_utils.correlate_cluster_on_event_number(data_1=cluster_dut_0,
-                                                             data_2=actual_dut_cluster,
-                                                             column_corr_hist=column_correlation,
-                                                             row_corr_hist=row_correlation)
-
-    return start_index, column_correlation, row_correlation
+def _correlate_cluster(reference_cluster_file, cluster_file, shape_column, shape_row, chunk_size):
+    '''Correlates the cluster of one device with the cluster of the reference device.
+    Both cluster files are read once in lockstep, the histograms are filled locally.
+    '''
+    column_correlation = np.zeros(shape_column, dtype=np.int32)
+    row_correlation = np.zeros(shape_row, dtype=np.int32)
+    with tb.open_file(reference_cluster_file, mode='r') as reference_in_file_h5:  # Open DUT0 cluster file
+        with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open other DUT cluster file
+            for (cluster_dut_0, actual_dut_cluster), _ in analysis_utils.data_aligned_at_events_in_tables([reference_in_file_h5.root.Cluster, actual_in_file_h5.root.Cluster], chunk_size=chunk_size):  # Loop over the cluster of DUT0 and the actual DUT in chunks
+                if actual_dut_cluster.shape[0] == 0:
+                    continue
+                analysis_utils.correlate_cluster_on_event_number(data_1=cluster_dut_0,
+                                                                 data_2=actual_dut_cluster,
+                                                                 column_corr_hist=column_correlation,
+                                                                 row_corr_hist=row_correlation)
+
+    return column_correlation, row_correlation
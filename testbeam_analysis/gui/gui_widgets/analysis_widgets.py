@@ -16,7 +16,7 @@ from PyQt5 import QtWidgets, QtCore, QtGui
 
 from testbeam_analysis.gui.gui_widgets import option_widgets
 from testbeam_analysis.gui.gui_widgets.plotter import AnalysisPlotter
-from testbeam_analysis.gui.gui_widgets.worker import AnalysisWorker
+from testbeam_analysis.gui.gui_widgets.worker import AnalysisWorker, ProcessPoolWorker
 from testbeam_analysis.gui.gui_widgets.progbar import AnalysisBar
 
 
@@ -428,6 +428,18 @@ class AnalysisWidget(QtWidgets.QWidget):
         Setup info and generic options are added if needed.
         """
 
+        # Get functions return value
+        val = func(**self._get_func_kwargs(func, kwargs))
+
+        # Most functions return None. If not None, store value
+        if val is not None:
+            self.return_values = val
+
+    def _get_func_kwargs(self, func, kwargs):
+        """
+        Returns the kwargs of an analysis function. Setup info and generic options are added if needed.
+        """
+
         # Set missing kwargs from setting data structures
         args = inspect.getargspec(func)[0]
         for arg in args:
@@ -447,12 +459,7 @@ class AnalysisWidget(QtWidgets.QWidget):
                 else:
                     raise RuntimeError('Function argument %s not defined', arg)
 
-        # Get functions return value
-        val = func(**kwargs)
-
-        # Most functions return None. If not None, store value
-        if val is not None:
-            self.return_values = val
+        return kwargs
 
     def _call_funcs(self):
         """
@@ -606,7 +613,7 @@ class ParallelAnalysisWidget(QtWidgets.QWidget):
     # Signal emitted when user wants to re-run analysis of respective widget
     rerunSignal = QtCore.pyqtSignal(str)
 
-    def __init__(self, parent, setup, options, name, tab_list=None):
+    def __init__(self, parent, setup, options, name, tab_list=None, use_processes=True):
 
         super(ParallelAnalysisWidget, self).__init__(parent)
 
@@ -653,6 +660,9 @@ class ParallelAnalysisWidget(QtWidgets.QWidget):
         self.analysis_thread = QtCore.QThread()  # no parent
         self.analysis_worker = {}
         self._n_workers_finished = 0
+
+        # Run the analysis of each DUT in a separate process instead of one after another in the analysis thread
+        self.use_processes = use_processes
         self.plotting_thread = QtCore.QThread()
 
         # Make dict to store all tabs calls.values() (dict) in a list with parallel function as key
@@ -827,6 +837,10 @@ class ParallelAnalysisWidget(QtWidgets.QWidget):
         self.p_bar.setVisible(True)
         self.p_bar.setBusy('Running analysis...')
 
+        if self.use_processes:
+            self._call_parallel_funcs_in_processes()
+            return
+
         for dut in self.duts:
 
             # Disable widgets
@@ -858,6 +872,55 @@ class ParallelAnalysisWidget(QtWidgets.QWidget):
         # Start thread
         self.analysis_thread.start()
 
+    def _call_parallel_funcs_in_processes(self):
+        """
+        Calls the analysis functions of each of the AnalysisWidgets in a separate process. The function arguments
+        are set in the main thread, a single worker in the analysis thread waits for all processes
+        """
+
+        duts_funcs_args = OrderedDict()
+        for dut in self.duts:
+
+            # Disable widgets
+            self.tw[dut].container.setDisabled(True)
+
+            # Set function arguments here, since the AnalysisWidgets cannot be send to other processes
+            duts_funcs_args[dut] = [(func, self.tw[dut]._get_func_kwargs(func, kwargs)) for func, kwargs in self.tw[dut].calls.items()]
+
+        # Create one worker for all DUTs and move to thread
+        self.analysis_worker = ProcessPoolWorker(duts_funcs_args=duts_funcs_args)
+        self.analysis_worker.moveToThread(self.analysis_thread)
+
+        # Connect worker's status and store return values
+        self.analysis_worker.progressSignal.connect(lambda: self.p_bar.setRange(0, len(self.duts)))
+        self.analysis_worker.progressSignal.connect(lambda: self.p_bar.setValue(self.p_bar.value() + 1))
+        self.analysis_worker.resultSignal.connect(self._set_return_values)
+
+        # Connect exceptions signal
+        self.analysis_worker.exceptionSignal.connect(lambda e, trc_bck: self.emit_exception(exception=e,
+                                                                                            trace_back=trc_bck,
+                                                                                            name=self.name,
+                                                                                            cause='analysis'))
+
+        # Connect workers work method to the start of the thread, quit thread when worker finishes and clean-up
+        self.analysis_thread.started.connect(self.analysis_worker.work)
+        self.analysis_worker.finished.connect(self.analysis_thread.quit)
+        self.analysis_thread.finished.connect(self.emit_parallel_analysis_done)
+        self.analysis_thread.finished.connect(self.analysis_worker.deleteLater)
+        self.analysis_thread.finished.connect(self.analysis_thread.deleteLater)
+
+        # Start thread
+        self.analysis_thread.start()
+
+    def _set_return_values(self, dut, val):
+        """
+        Stores the return value of the analysis of a DUT that was done in a separate process
+        """
+
+        # Most functions return None. If not None, store value
+        if val is not None:
+            self.tw[dut].return_values = val
+
     def _quit_thread(self):
         """
         Increments the worker finished counter and finishes analysis_thread when all workers have finished
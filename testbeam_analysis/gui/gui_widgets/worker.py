@@ -1,9 +1,12 @@
 """
-Implements a worker object on which analysis can be done. The worker is then moved to a separate QThread
+Implements worker objects on which analysis can be done. The workers are then moved to a separate QThread
 via the QObject.moveToThread() method.
 """
 
+import time
 import traceback
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
 
 from PyQt5 import QtCore
 
@@ -62,3 +65,82 @@ class AnalysisWorker(QtCore.QObject):
 
             # Emit exception signal
             self.exceptionSignal.emit(e, trc_bck)
+
+
+def call_funcs(funcs_args):
+    """
+    Calls the functions in funcs_args with the corresponding kwargs in a row and returns the last return
+    value that is not None. Used to run the analysis of one DUT in a separate process.
+    """
+
+    return_values = None
+    for func, kwargs in funcs_args:
+        val = func(**kwargs)
+        if val is not None:
+            return_values = val
+    return return_values
+
+
+class ProcessPoolWorker(QtCore.QObject):
+    """
+    Implements a worker class which runs the analysis functions of each DUT in a separate process of a
+    process pool. The worker itself is moved to an extra thread to keep the GUI responsive; it waits for the
+    processes and passes progress, return values and exceptions to the main thread via signals
+    """
+
+    finished = QtCore.pyqtSignal()
+    exceptionSignal = QtCore.pyqtSignal(Exception, str)
+    progressSignal = QtCore.pyqtSignal()
+    resultSignal = QtCore.pyqtSignal(str, object)
+
+    def __init__(self, duts_funcs_args, n_processes=None):
+        super(ProcessPoolWorker, self).__init__()
+
+        # Dict with DUT names as keys and lists of functions and corresponding kwargs as values;
+        # functions and kwargs have to be picklable
+        self.duts_funcs_args = duts_funcs_args
+        # Number of processes; if None, one process per DUT but not more than CPUs
+        self.n_processes = n_processes if n_processes else max(1, min(len(duts_funcs_args), cpu_count()))
+
+    def work(self):
+        """
+        Runs the functions of each DUT in a separate process. Progress signal is emitted for each finished DUT.
+        If errors or exceptions occur, the remaining processes are terminated and a signal sends the exception
+        to main thread.
+        """
+
+        pool = Pool(self.n_processes)
+
+        try:
+
+            results = OrderedDict()
+            for dut, funcs_args in self.duts_funcs_args.items():
+                results[dut] = pool.apply_async(call_funcs, args=(funcs_args,))
+            pool.close()
+
+            # Collect results as soon as they are available
+            while results:
+                for dut in [dut for dut, result in results.items() if result.ready()]:
+
+                    # Re-raises exception from analysis process
+                    self.resultSignal.emit(dut, results.pop(dut).get())
+
+                    # Emit progress signal
+                    self.progressSignal.emit()
+
+                if results:
+                    time.sleep(0.01)
+
+            pool.join()
+
+            self.finished.emit()
+
+        except Exception as e:
+
+            pool.terminate()
+
+            # Format traceback and send
+            trc_bck = traceback.format_exc()
+
+            # Emit exception signal
+            self.exceptionSignal.emit(e, trc_bck)
@@ -11,6 +11,7 @@ from scipy.ndimage import median_filter
 from pixel_clusterizer.clusterizer import HitClusterizer
 
 from testbeam_analysis.tools import smc
+from testbeam_analysis.tools import storage
 from testbeam_analysis.tools import analysis_utils, plot_utils
 from testbeam_analysis.tools.plot_utils import plot_masked_pixels, plot_cluster_size
 
@@ -60,16 +61,12 @@ def check_file(input_hits_file, n_pixel, output_check_file=None,
                                                title='Change of event number per non empty event',
                                                shape=(0, ),
                                                atom=tb.Atom.from_dtype(np.dtype(np.uint64)),
-                                               filters=tb.Filters(complib='blosc',
-                                                                  complevel=5,
-                                                                  fletcher32=False))
+                                               filters=storage.get_filters('histogram'))
             out_E = out_file_h5.create_earray(out_file_h5.root, name='EventNumber',
                                               title='Event number of non empty event',
                                               shape=(0, ),
                                               atom=tb.Atom.from_dtype(np.dtype(np.uint64)),
-                                              filters=tb.Filters(complib='blosc',
-                                                                 complevel=5,
-                                                                 fletcher32=False))
+                                              filters=storage.get_filters('histogram'))
 
             for hits, _ in analysis_utils.data_aligned_at_events(
                     input_file_h5.root.Hits,
@@ -105,16 +102,12 @@ def check_file(input_hits_file, n_pixel, output_check_file=None,
                                                 title='Column Correlation with event range=%s' % event_range,
                                                 atom=tb.Atom.from_dtype(col_corr.dtype),
                                                 shape=col_corr.shape,
-                                                filters=tb.Filters(complib='blosc',
-                                                                   complevel=5,
-                                                                   fletcher32=False))
+                                                filters=storage.get_filters('histogram'))
             out_row = out_file_h5.create_carray(out_file_h5.root, name='CorrelationRows',
                                                 title='Row Correlation with event range=%s' % event_range,
                                                 atom=tb.Atom.from_dtype(row_corr.dtype),
                                                 shape=row_corr.shape,
-                                                filters=tb.Filters(complib='blosc',
-                                                                   complevel=5,
-                                                                   fletcher32=False))
+                                                filters=storage.get_filters('histogram'))
             out_col[:] = col_corr
             out_row[:] = row_corr
 
@@ -165,7 +158,7 @@ def generate_pixel_mask(input_hits_file, n_pixel, pixel_mask_name="NoisyPixelMas
     smc.SMC(table_file_in=input_hits_file,
             file_out=output_mask_file,
             func=work,
-            node_desc={'name': 'HistOcc'},
+            node_desc={'name': 'HistOcc', 'filters': storage.get_filters('histogram')},
             chunk_size=chunk_size)
 
     # Create mask from occupancy histogram
@@ -183,7 +176,7 @@ def generate_pixel_mask(input_hits_file, n_pixel, pixel_mask_name="NoisyPixelMas
         pixel_mask = np.ma.getmaskarray(occupancy)
 
         # Create masked pixels array
-        masked_pixel_table = out_file_h5.create_carray(out_file_h5.root, name=pixel_mask_name, title='Pixel Mask', atom=tb.Atom.from_dtype(pixel_mask.dtype), shape=pixel_mask.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        masked_pixel_table = out_file_h5.create_carray(out_file_h5.root, name=pixel_mask_name, title='Pixel Mask', atom=tb.Atom.from_dtype(pixel_mask.dtype), shape=pixel_mask.shape, filters=storage.get_filters('histogram'))
         masked_pixel_table[:] = pixel_mask
 
     if plot:
@@ -192,7 +185,7 @@ def generate_pixel_mask(input_hits_file, n_pixel, pixel_mask_name="NoisyPixelMas
     return output_mask_file
 
 
-def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel_mask_file=None, input_noisy_pixel_mask_file=None, min_hit_charge=0, max_hit_charge=None, column_cluster_distance=1, row_cluster_distance=1, frame_cluster_distance=1, dut_name=None, plot=True, chunk_size=1000000):
+def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel_mask_file=None, input_noisy_pixel_mask_file=None, min_hit_charge=0, max_hit_charge=None, column_cluster_distance=1, row_cluster_distance=1, frame_cluster_distance=1, dut_name=None, fused=False, plot=True, chunk_size=1000000):
     '''Clusters the hits in the data file containing the hit table.
 
     Parameters
@@ -217,6 +210,13 @@ def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel
         Sometimes an event has additional timing information (e.g. bunch crossing ID, frame ID). Value of 0 effectively disables the clusterization in time.
     dut_name : string
         Name of the DUT. If None, filename of the output cluster file will be used.
+    fused : bool
+        If True, cluster the hits and fill the cluster size histogram in one pass, the cluster table is written only once.
+        The position errors of small clusters (up to 2x2) depend on the cluster size histogram of the full data set.
+        Their cluster dimension is kept in the err_cols/err_rows columns and the position errors are stored as lookup table
+        in the position_error_lookup attribute of the cluster table. The lookup table is applied when reading the cluster
+        (see analysis_utils.apply_position_error_lookup()).
+        If False, the position errors are written into the cluster table in an additional pass.
     plot : bool
         If True, create additional output plots.
     chunk_size : int
@@ -282,16 +282,6 @@ def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel
                                  disabled_pixels=disabled_pixels)
         return cl
 
-    smc.SMC(table_file_in=input_hits_file,
-            file_out=output_cluster_file,
-            func=cluster_func,
-            func_kwargs={'clz': clz,
-                         'noisy_pixels': noisy_pixels,
-                         'disabled_pixels': disabled_pixels},
-            node_desc={'name': 'Cluster'},
-            align_at='event_number',
-            chunk_size=chunk_size)
-
     # Calculate cluster size histogram
     def hist_func(cluster):
         n_hits = cluster['n_hits']
@@ -299,57 +289,82 @@ def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel
                                             shape=(np.max(n_hits) + 1,))
         return hist
 
-    smc.SMC(table_file_in=output_cluster_file,
-            file_out=output_cluster_file[:-3] + '_hist.h5',
-            func=hist_func,
-            node_desc={'name': 'HistClusterSize'},
-            chunk_size=chunk_size)
-
-    # Load infos from cluster size for error determination and plotting
-    with tb.open_file(output_cluster_file[:-3] + '_hist.h5', 'r') as input_file_h5:
-        hight = input_file_h5.root.HistClusterSize[:]
-        n_clusters = hight.sum()
-        n_hits = (hight * np.arange(0, hight.shape[0])).sum()
-        max_cluster_size = hight.shape[0] - 1
-
-    # Calculate position error from cluster size
-    def get_eff_pitch(hist, cluster_size):
-        ''' Effective pitch to describe the cluster
-            size propability distribution
-
-        hist : array like
-            Histogram with cluster size distribution
-        cluster_size : Cluster size to calculate the pitch for
-        '''
-
-        return np.sqrt(hight[int(cluster_size)].astype(np.float) / hight.sum())
-
-    def pos_error_func(clusters):
-        # Check if end_of_cluster function was called
-        # Under unknown and rare circumstances this might not be the case
-        if not np.any(clusters['err_cols']):
+    # Run clusterizer, set position errors of big clusters and fill the cluster size histogram in one pass
+    def fused_cluster_func(hits, clz, noisy_pixels, disabled_pixels):
+        cl = cluster_func(hits, clz, noisy_pixels, disabled_pixels)
+        check_cluster_dimensions(cl)
+        set_big_cluster_position_errors(cl)
+        if cl.shape[0] == 0:
+            return cl, np.zeros(shape=(1,), dtype=np.uint32)
+        return cl, hist_func(cl)
+
+    # Check if end_of_cluster function was called
+    # Under unknown and rare circumstances this might not be the case
+    def check_cluster_dimensions(clusters):
+        if clusters.shape[0] and not np.any(clusters['err_cols']):
             raise RuntimeError('Clustering failed, please report bug at:'
                                'https://github.com/SiLab-Bonn/testbeam_analysis/issues')
-        # Set errors for small clusters, where charge sharing enhances
-        # resolution
-        for css in [(1, 1), (1, 2), (2, 1), (2, 2)]:
-            sel = np.logical_and(clusters['err_cols'] == css[0],
-                                 clusters['err_rows'] == css[1])
-            clusters['err_cols'][sel] = get_eff_pitch(hist=hight,
-                                                      cluster_size=css[0]) / np.sqrt(12)
-            clusters['err_rows'][sel] = get_eff_pitch(hist=hight,
-                                                      cluster_size=css[1]) / np.sqrt(12)
-        # Set errors for big clusters, where delta electrons reduce resolution
+
+    # Set errors for big clusters, where delta electrons reduce resolution
+    def set_big_cluster_position_errors(clusters):
         sel = np.logical_or(clusters['err_cols'] > 2, clusters['err_rows'] > 2)
         clusters['err_cols'][sel] = clusters['err_cols'][sel] / np.sqrt(12)
         clusters['err_rows'][sel] = clusters['err_rows'][sel] / np.sqrt(12)
 
-        return clusters
-
-    smc.SMC(table_file_in=output_cluster_file,
-            file_out=output_cluster_file,
-            func=pos_error_func,
-            chunk_size=chunk_size)
+    if fused:
+        cluster_smc = smc.SMC(table_file_in=input_hits_file,
+                              file_out=output_cluster_file,
+                              func=fused_cluster_func,
+                              func_kwargs={'clz': clz,
+                                           'noisy_pixels': noisy_pixels,
+                                           'disabled_pixels': disabled_pixels},
+                              node_desc={'name': 'Cluster', 'filters': storage.get_filters('cluster'), 'chunkshape': storage.get_chunkshape('cluster')},
+                              align_at='event_number',
+                              chunk_size=chunk_size)
+        hight = cluster_smc.aux_data
+
+        # Store cluster size histogram
+        with tb.open_file(output_cluster_file[:-3] + '_hist.h5', 'w') as output_file_h5:
+            hist_cluster_size = output_file_h5.create_carray(output_file_h5.root, name='HistClusterSize', title='Cluster size histogram', atom=tb.Atom.from_dtype(hight.dtype), shape=hight.shape, filters=storage.get_filters('histogram'))
+            hist_cluster_size[:] = hight
+
+        # Position errors of small clusters are set when reading the cluster
+        with tb.open_file(output_cluster_file, 'r+') as output_file_h5:
+            output_file_h5.root.Cluster.attrs.position_error_lookup = analysis_utils.get_position_error_lookup(hight)
+    else:
+        smc.SMC(table_file_in=input_hits_file,
+                file_out=output_cluster_file,
+                func=cluster_func,
+                func_kwargs={'clz': clz,
+                             'noisy_pixels': noisy_pixels,
+                             'disabled_pixels': disabled_pixels},
+                node_desc={'name': 'Cluster', 'filters': storage.get_filters('cluster'), 'chunkshape': storage.get_chunkshape('cluster')},
+                align_at='event_number',
+                chunk_size=chunk_size)
+
+        smc.SMC(table_file_in=output_cluster_file,
+                file_out=output_cluster_file[:-3] + '_hist.h5',
+                func=hist_func,
+                node_desc={'name': 'HistClusterSize', 'filters': storage.get_filters('histogram')},
+                chunk_size=chunk_size)
+
+        # Load infos from cluster size for error determination
+        with tb.open_file(output_cluster_file[:-3] + '_hist.h5', 'r') as input_file_h5:
+            position_error_lookup = analysis_utils.get_position_error_lookup(input_file_h5.root.HistClusterSize[:])
+
+        # Calculate position error from cluster size
+        def pos_error_func(clusters):
+            check_cluster_dimensions(clusters)
+            set_big_cluster_position_errors(clusters)
+            # Set errors for small clusters, where charge sharing enhances
+            # resolution
+            analysis_utils.apply_position_error_lookup(clusters['err_cols'], clusters['err_rows'], position_error_lookup)
+            return clusters
+
+        smc.SMC(table_file_in=output_cluster_file,
+                file_out=output_cluster_file,
+                func=pos_error_func,
+                chunk_size=chunk_size)
 
     # Copy masks to result cluster file
     with tb.open_file(output_cluster_file, 'r+') as output_file_h5:
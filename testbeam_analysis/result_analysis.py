@@ -8,6 +8,7 @@ import os.path
 
 import tables as tb
 import numpy as np
+from numba import njit
 from matplotlib.backends.backend_pdf import PdfPages
 from scipy.stats import binned_statistic_2d
 from scipy.optimize import curve_fit
@@ -15,6 +16,7 @@ from scipy.optimize import curve_fit
 from testbeam_analysis.tools import plot_utils
 from testbeam_analysis.tools import geometry_utils
 from testbeam_analysis.tools import analysis_utils
+from testbeam_analysis.tools import storage
 
 
 def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel_size, output_residuals_file=None, dut_names=None, use_duts=None, max_chi2=None, nbins_per_pixel=None, npixels_per_bin=None, force_prealignment=False, use_fit_limits=True, cluster_size_selection=None, plot=True, gui=False, chunk_size=1000000):
@@ -136,251 +138,70 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                     # Histogram residuals in different ways
                     if initialize:  # Only true for the first iteration, calculate the binning for the histograms
                         initialize = False
-                        plot_n_pixels = 6.0
-
-                        # detect peaks and calculate width to estimate the size of the histograms
-                        if nbins_per_pixel is not None:
-                            min_difference, max_difference = np.min(difference[:, 0]), np.max(difference[:, 0])
-                            nbins = np.arange(min_difference - (pixel_size[actual_dut][0] / nbins_per_pixel), max_difference + 2 * (pixel_size[actual_dut][0] / nbins_per_pixel), pixel_size[actual_dut][0] / nbins_per_pixel)
-                        else:
-                            nbins = "auto"
-                        hist, edges = np.histogram(difference[:, 0], bins=nbins)
-                        edge_center = (edges[1:] + edges[:-1]) / 2.0
-                        try:
-                            _, center_x, fwhm_x, _ = analysis_utils.peak_detect(edge_center, hist)
-                        except RuntimeError:
-                            # do some simple FWHM with numpy array
-                            try:
-                                _, center_x, fwhm_x, _ = analysis_utils.simple_peak_detect(edge_center, hist)
-                            except RuntimeError:
-                                center_x, fwhm_x = 0.0, pixel_size[actual_dut][0] * plot_n_pixels
-
-                        if nbins_per_pixel is not None:
-                            min_difference, max_difference = np.min(difference[:, 1]), np.max(difference[:, 1])
-                            nbins = np.arange(min_difference - (pixel_size[actual_dut][1] / nbins_per_pixel), max_difference + 2 * (pixel_size[actual_dut][1] / nbins_per_pixel), pixel_size[actual_dut][1] / nbins_per_pixel)
-                        else:
-                            nbins = "auto"
-                        hist, edges = np.histogram(difference[:, 1], bins=nbins)
-                        edge_center = (edges[1:] + edges[:-1]) / 2.0
-                        try:
-                            _, center_y, fwhm_y, _ = analysis_utils.peak_detect(edge_center, hist)
-                        except RuntimeError:
-                            # do some simple FWHM with numpy array
-                            try:
-                                _, center_y, fwhm_y, _ = analysis_utils.simple_peak_detect(edge_center, hist)
-                            except RuntimeError:
-                                center_y, fwhm_y = 0.0, pixel_size[actual_dut][1] * plot_n_pixels
-
-                        if nbins_per_pixel is not None:
-                            min_difference, max_difference = np.min(difference_local[:, 0]), np.max(difference_local[:, 0])
-                            nbins = np.arange(min_difference - (pixel_size[actual_dut][0] / nbins_per_pixel), max_difference + 2 * (pixel_size[actual_dut][0] / nbins_per_pixel), pixel_size[actual_dut][0] / nbins_per_pixel)
-                        else:
-                            nbins = "auto"
-                        hist, edges = np.histogram(difference_local[:, 0], bins=nbins)
-                        edge_center = (edges[1:] + edges[:-1]) / 2.0
-                        try:
-                            _, center_col, fwhm_col, _ = analysis_utils.peak_detect(edge_center, hist)
-                        except RuntimeError:
-                            # do some simple FWHM with numpy array
-                            try:
-                                _, center_col, fwhm_col, _ = analysis_utils.simple_peak_detect(edge_center, hist)
-                            except RuntimeError:
-                                center_col, fwhm_col = 0.0, pixel_size[actual_dut][0] * plot_n_pixels
-
-                        if nbins_per_pixel is not None:
-                            min_difference, max_difference = np.min(difference_local[:, 1]), np.max(difference_local[:, 1])
-                            nbins = np.arange(min_difference - (pixel_size[actual_dut][1] / nbins_per_pixel), max_difference + 2 * (pixel_size[actual_dut][1] / nbins_per_pixel), pixel_size[actual_dut][1] / nbins_per_pixel)
-                        else:
-                            nbins = "auto"
-                        hist, edges = np.histogram(difference_local[:, 1], bins=nbins)
-                        edge_center = (edges[1:] + edges[:-1]) / 2.0
-                        try:
-                            _, center_row, fwhm_row, _ = analysis_utils.peak_detect(edge_center, hist)
-                        except RuntimeError:
-                            # do some simple FWHM with numpy array
-                            try:
-                                _, center_row, fwhm_row, _ = analysis_utils.simple_peak_detect(edge_center, hist)
-                            except RuntimeError:
-                                center_row, fwhm_row = 0.0, pixel_size[actual_dut][1] * plot_n_pixels
-
                         # calculate the binning of the histograms, the minimum size is given by plot_n_pixels, otherwise FWHM is taken into account
-                        if nbins_per_pixel is not None:
-                            width = max(plot_n_pixels * pixel_size[actual_dut][0], pixel_size[actual_dut][0] * np.ceil(plot_n_pixels * fwhm_x / pixel_size[actual_dut][0]))
-                            if np.mod(width / pixel_size[actual_dut][0], 2) != 0:
-                                width += pixel_size[actual_dut][0]
-                            nbins = int(nbins_per_pixel * width / pixel_size[actual_dut][0])
-                            x_range = (center_x - 0.5 * width, center_x + 0.5 * width)
-                        else:
-                            nbins = "auto"
-                            width = pixel_size[actual_dut][0] * np.ceil(plot_n_pixels * fwhm_x / pixel_size[actual_dut][0])
-                            x_range = (center_x - width, center_x + width)
-                        hist_residual_x_hist, hist_residual_x_xedges = np.histogram(difference[:, 0], range=x_range, bins=nbins)
-
-                        if npixels_per_bin is not None:
-                            min_intersection, max_intersection = np.min(intersection_x), np.max(intersection_x)
-                            nbins = np.arange(min_intersection, max_intersection + npixels_per_bin * pixel_size[actual_dut][0], npixels_per_bin * pixel_size[actual_dut][0])
-                        else:
-                            nbins = "auto"
-                        _, hist_residual_x_yedges = np.histogram(intersection_x, bins=nbins)
-
-                        if nbins_per_pixel is not None:
-                            width = max(plot_n_pixels * pixel_size[actual_dut][1], pixel_size[actual_dut][1] * np.ceil(plot_n_pixels * fwhm_y / pixel_size[actual_dut][1]))
-                            if np.mod(width / pixel_size[actual_dut][1], 2) != 0:
-                                width += pixel_size[actual_dut][1]
-                            nbins = int(nbins_per_pixel * width / pixel_size[actual_dut][1])
-                            y_range = (center_y - 0.5 * width, center_y + 0.5 * width)
-                        else:
-                            nbins = "auto"
-                            width = pixel_size[actual_dut][1] * np.ceil(plot_n_pixels * fwhm_y / pixel_size[actual_dut][1])
-                            y_range = (center_y - width, center_y + width)
-                        hist_residual_y_hist, hist_residual_y_yedges = np.histogram(difference[:, 1], range=y_range, bins=nbins)
-
-                        if npixels_per_bin is not None:
-                            min_intersection, max_intersection = np.min(intersection_y), np.max(intersection_y)
-                            nbins = np.arange(min_intersection, max_intersection + npixels_per_bin * pixel_size[actual_dut][1], npixels_per_bin * pixel_size[actual_dut][1])
-                        else:
-                            nbins = "auto"
-                        _, hist_residual_y_xedges = np.histogram(intersection_y, bins=nbins)
-
-                        if nbins_per_pixel is not None:
-                            width = max(plot_n_pixels * pixel_size[actual_dut][0], pixel_size[actual_dut][0] * np.ceil(plot_n_pixels * fwhm_col / pixel_size[actual_dut][0]))
-                            if np.mod(width / pixel_size[actual_dut][0], 2) != 0:
-                                width += pixel_size[actual_dut][0]
-                            nbins = int(nbins_per_pixel * width / pixel_size[actual_dut][0])
-                            col_range = (center_col - 0.5 * width, center_col + 0.5 * width)
-                        else:
-                            nbins = "auto"
-                            width = pixel_size[actual_dut][0] * np.ceil(plot_n_pixels * fwhm_col / pixel_size[actual_dut][0])
-                            col_range = (center_col - width, center_col + width)
-                        hist_residual_col_hist, hist_residual_col_xedges = np.histogram(difference_local[:, 0], range=col_range, bins=nbins)
-
-                        if npixels_per_bin is not None:
-                            min_intersection, max_intersection = np.min(intersection_x_local), np.max(intersection_x_local)
-                            nbins = np.arange(min_intersection, max_intersection + npixels_per_bin * pixel_size[actual_dut][0], npixels_per_bin * pixel_size[actual_dut][0])
-                        else:
-                            nbins = "auto"
-                        _, hist_residual_col_yedges = np.histogram(intersection_x_local, bins=nbins)
-
-                        if nbins_per_pixel is not None:
-                            width = max(plot_n_pixels * pixel_size[actual_dut][1], pixel_size[actual_dut][1] * np.ceil(plot_n_pixels * fwhm_row / pixel_size[actual_dut][1]))
-                            if np.mod(width / pixel_size[actual_dut][1], 2) != 0:
-                                width += pixel_size[actual_dut][1]
-                            nbins = int(nbins_per_pixel * width / pixel_size[actual_dut][1])
-                            row_range = (center_row - 0.5 * width, center_row + 0.5 * width)
-                        else:
-                            nbins = "auto"
-                            width = pixel_size[actual_dut][1] * np.ceil(plot_n_pixels * fwhm_row / pixel_size[actual_dut][1])
-                            row_range = (center_row - width, center_row + width)
-                        hist_residual_row_hist, hist_residual_row_yedges = np.histogram(difference_local[:, 1], range=row_range, bins=nbins)
-
-                        if npixels_per_bin is not None:
-                            min_intersection, max_intersection = np.min(intersection_y_local), np.max(intersection_y_local)
-                            nbins = np.arange(min_intersection, max_intersection + npixels_per_bin * pixel_size[actual_dut][1], npixels_per_bin * pixel_size[actual_dut][1])
-                        else:
-                            nbins = "auto"
-                        _, hist_residual_row_xedges = np.histogram(intersection_y_local, bins=nbins)
-
-                        # global x residual against x position
-                        hist_x_residual_x_hist, hist_x_residual_x_xedges, hist_x_residual_x_yedges = np.histogram2d(
-                            intersection_x,
-                            difference[:, 0],
-                            bins=(hist_residual_x_yedges, hist_residual_x_xedges))
+                        nbins, x_range = _get_residual_binning(difference[:, 0], pixel_size=pixel_size[actual_dut][0], nbins_per_pixel=nbins_per_pixel)
+                        hist_residual_x_xedges = np.histogram_bin_edges(difference[:, 0], range=x_range, bins=nbins)
+                        hist_residual_x_yedges = np.histogram_bin_edges(intersection_x, bins=_get_position_binning(intersection_x, pixel_size=pixel_size[actual_dut][0], npixels_per_bin=npixels_per_bin))
 
-                        # global y residual against y position
-                        hist_y_residual_y_hist, hist_y_residual_y_xedges, hist_y_residual_y_yedges = np.histogram2d(
-                            intersection_y,
-                            difference[:, 1],
-                            bins=(hist_residual_y_xedges, hist_residual_y_yedges))
+                        nbins, y_range = _get_residual_binning(difference[:, 1], pixel_size=pixel_size[actual_dut][1], nbins_per_pixel=nbins_per_pixel)
+                        hist_residual_y_yedges = np.histogram_bin_edges(difference[:, 1], range=y_range, bins=nbins)
+                        hist_residual_y_xedges = np.histogram_bin_edges(intersection_y, bins=_get_position_binning(intersection_y, pixel_size=pixel_size[actual_dut][1], npixels_per_bin=npixels_per_bin))
 
-                        # global y residual against x position
-                        hist_x_residual_y_hist, hist_x_residual_y_xedges, hist_x_residual_y_yedges = np.histogram2d(
-                            intersection_x,
-                            difference[:, 1],
-                            bins=(hist_residual_x_yedges, hist_residual_y_yedges))
+                        nbins, col_range = _get_residual_binning(difference_local[:, 0], pixel_size=pixel_size[actual_dut][0], nbins_per_pixel=nbins_per_pixel)
+                        hist_residual_col_xedges = np.histogram_bin_edges(difference_local[:, 0], range=col_range, bins=nbins)
+                        hist_residual_col_yedges = np.histogram_bin_edges(intersection_x_local, bins=_get_position_binning(intersection_x_local, pixel_size=pixel_size[actual_dut][0], npixels_per_bin=npixels_per_bin))
 
-                        # global x residual against y position
-                        hist_y_residual_x_hist, hist_y_residual_x_xedges, hist_y_residual_x_yedges = np.histogram2d(
-                            intersection_y,
-                            difference[:, 0],
-                            bins=(hist_residual_y_xedges, hist_residual_x_xedges))
+                        nbins, row_range = _get_residual_binning(difference_local[:, 1], pixel_size=pixel_size[actual_dut][1], nbins_per_pixel=nbins_per_pixel)
+                        hist_residual_row_yedges = np.histogram_bin_edges(difference_local[:, 1], range=row_range, bins=nbins)
+                        hist_residual_row_xedges = np.histogram_bin_edges(intersection_y_local, bins=_get_position_binning(intersection_y_local, pixel_size=pixel_size[actual_dut][1], npixels_per_bin=npixels_per_bin))
 
-                        # local column residual against column position
-                        hist_col_residual_col_hist, hist_col_residual_col_xedges, hist_col_residual_col_yedges = np.histogram2d(
-                            intersection_x_local,
-                            difference_local[:, 0],
-                            bins=(hist_residual_col_yedges, hist_residual_col_xedges))
-
-                        # local row residual against row position
-                        hist_row_residual_row_hist, hist_row_residual_row_xedges, hist_row_residual_row_yedges = np.histogram2d(
-                            intersection_y_local,
-                            difference_local[:, 1],
-                            bins=(hist_residual_row_xedges, hist_residual_row_yedges))
-
-                        # local row residual against column position
-                        hist_col_residual_row_hist, hist_col_residual_row_xedges, hist_col_residual_row_yedges = np.histogram2d(
-                            intersection_x_local,
-                            difference_local[:, 1],
-                            bins=(hist_residual_col_yedges, hist_residual_row_yedges))
-
-                        # local column residual against row position
-                        hist_row_residual_col_hist, hist_row_residual_col_xedges, hist_row_residual_col_yedges = np.histogram2d(
-                            intersection_y_local,
-                            difference_local[:, 0],
-                            bins=(hist_residual_row_xedges, hist_residual_col_xedges))
-
-                    else:  # adding data to existing histograms
-                        hist_residual_x_hist += np.histogram(difference[:, 0], bins=hist_residual_x_xedges)[0]
-                        hist_residual_y_hist += np.histogram(difference[:, 1], bins=hist_residual_y_yedges)[0]
-                        hist_residual_col_hist += np.histogram(difference_local[:, 0], bins=hist_residual_col_xedges)[0]
-                        hist_residual_row_hist += np.histogram(difference_local[:, 1], bins=hist_residual_row_yedges)[0]
+                        # 1D residual histograms
+                        hist_residual_x_hist = np.zeros(shape=(hist_residual_x_xedges.shape[0] - 1,), dtype=np.int64)
+                        hist_residual_y_hist = np.zeros(shape=(hist_residual_y_yedges.shape[0] - 1,), dtype=np.int64)
+                        hist_residual_col_hist = np.zeros(shape=(hist_residual_col_xedges.shape[0] - 1,), dtype=np.int64)
+                        hist_residual_row_hist = np.zeros(shape=(hist_residual_row_yedges.shape[0] - 1,), dtype=np.int64)
 
                         # global x residual against x position
-                        hist_x_residual_x_hist += np.histogram2d(
-                            intersection_x,
-                            difference[:, 0],
-                            bins=(hist_x_residual_x_xedges, hist_x_residual_x_yedges))[0]
+                        hist_x_residual_x_xedges, hist_x_residual_x_yedges = hist_residual_x_yedges, hist_residual_x_xedges
+                        hist_x_residual_x_hist = np.zeros(shape=(hist_x_residual_x_xedges.shape[0] - 1, hist_x_residual_x_yedges.shape[0] - 1), dtype=np.float64)
 
                         # global y residual against y position
-                        hist_y_residual_y_hist += np.histogram2d(
-                            intersection_y,
-                            difference[:, 1],
-                            bins=(hist_y_residual_y_xedges, hist_y_residual_y_yedges))[0]
+                        hist_y_residual_y_xedges, hist_y_residual_y_yedges = hist_residual_y_xedges, hist_residual_y_yedges
+                        hist_y_residual_y_hist = np.zeros(shape=(hist_y_residual_y_xedges.shape[0] - 1, hist_y_residual_y_yedges.shape[0] - 1), dtype=np.float64)
 
                         # global y residual against x position
-                        hist_x_residual_y_hist += np.histogram2d(
-                            intersection_x,
-                            difference[:, 1],
-                            bins=(hist_x_residual_y_xedges, hist_x_residual_y_yedges))[0]
+                        hist_x_residual_y_xedges, hist_x_residual_y_yedges = hist_residual_x_yedges, hist_residual_y_yedges
+                        hist_x_residual_y_hist = np.zeros(shape=(hist_x_residual_y_xedges.shape[0] - 1, hist_x_residual_y_yedges.shape[0] - 1), dtype=np.float64)
 
                         # global x residual against y position
-                        hist_y_residual_x_hist += np.histogram2d(
-                            intersection_y,
-                            difference[:, 0],
-                            bins=(hist_y_residual_x_xedges, hist_y_residual_x_yedges))[0]
+                        hist_y_residual_x_xedges, hist_y_residual_x_yedges = hist_residual_y_xedges, hist_residual_x_xedges
+                        hist_y_residual_x_hist = np.zeros(shape=(hist_y_residual_x_xedges.shape[0] - 1, hist_y_residual_x_yedges.shape[0] - 1), dtype=np.float64)
 
                         # local column residual against column position
-                        hist_col_residual_col_hist += np.histogram2d(
-                            intersection_x_local,
-                            difference_local[:, 0],
-                            bins=(hist_col_residual_col_xedges, hist_col_residual_col_yedges))[0]
+                        hist_col_residual_col_xedges, hist_col_residual_col_yedges = hist_residual_col_yedges, hist_residual_col_xedges
+                        hist_col_residual_col_hist = np.zeros(shape=(hist_col_residual_col_xedges.shape[0] - 1, hist_col_residual_col_yedges.shape[0] - 1), dtype=np.float64)
 
                         # local row residual against row position
-                        hist_row_residual_row_hist += np.histogram2d(
-                            intersection_y_local,
-                            difference_local[:, 1],
-                            bins=(hist_row_residual_row_xedges, hist_row_residual_row_yedges))[0]
+                        hist_row_residual_row_xedges, hist_row_residual_row_yedges = hist_residual_row_xedges, hist_residual_row_yedges
+                        hist_row_residual_row_hist = np.zeros(shape=(hist_row_residual_row_xedges.shape[0] - 1, hist_row_residual_row_yedges.shape[0] - 1), dtype=np.float64)
 
                         # local row residual against column position
-                        hist_col_residual_row_hist += np.histogram2d(
-                            intersection_x_local,
-                            difference_local[:, 1],
-                            bins=(hist_col_residual_row_xedges, hist_col_residual_row_yedges))[0]
+                        hist_col_residual_row_xedges, hist_col_residual_row_yedges = hist_residual_col_yedges, hist_residual_row_yedges
+                        hist_col_residual_row_hist = np.zeros(shape=(hist_col_residual_row_xedges.shape[0] - 1, hist_col_residual_row_yedges.shape[0] - 1), dtype=np.float64)
 
                         # local column residual against row position
-                        hist_row_residual_col_hist += np.histogram2d(
-                            intersection_y_local,
-                            difference_local[:, 0],
-                            bins=(hist_row_residual_col_xedges, hist_row_residual_col_yedges))[0]
+                        hist_row_residual_col_xedges, hist_row_residual_col_yedges = hist_residual_row_xedges, hist_residual_col_xedges
+                        hist_row_residual_col_hist = np.zeros(shape=(hist_row_residual_col_xedges.shape[0] - 1, hist_row_residual_col_yedges.shape[0] - 1), dtype=np.float64)
+
+                    # Fill the global and local residual histograms
+                    _fill_residual_histograms(residual_x=difference[:, 0], residual_y=difference[:, 1], position_x=intersection_x, position_y=intersection_y,
+                                              residual_x_edges=hist_residual_x_xedges, residual_y_edges=hist_residual_y_yedges, position_x_edges=hist_residual_x_yedges, position_y_edges=hist_residual_y_xedges,
+                                              hist_residual_x=hist_residual_x_hist, hist_residual_y=hist_residual_y_hist,
+                                              hist_x_residual_x=hist_x_residual_x_hist, hist_y_residual_y=hist_y_residual_y_hist, hist_x_residual_y=hist_x_residual_y_hist, hist_y_residual_x=hist_y_residual_x_hist)
+                    _fill_residual_histograms(residual_x=difference_local[:, 0], residual_y=difference_local[:, 1], position_x=intersection_x_local, position_y=intersection_y_local,
+                                              residual_x_edges=hist_residual_col_xedges, residual_y_edges=hist_residual_row_yedges, position_x_edges=hist_residual_col_yedges, position_y_edges=hist_residual_row_xedges,
+                                              hist_residual_x=hist_residual_col_hist, hist_residual_y=hist_residual_row_hist,
+                                              hist_x_residual_x=hist_col_residual_col_hist, hist_y_residual_y=hist_row_residual_row_hist, hist_x_residual_y=hist_col_residual_row_hist, hist_y_residual_x=hist_row_residual_col_hist)
 
                 logging.debug('Storing residual histograms...')
 
@@ -400,7 +221,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                       title='Residual distribution in x direction for %s' % (dut_name),
                                                       atom=tb.Atom.from_dtype(hist_residual_x_hist.dtype),
                                                       shape=hist_residual_x_hist.shape,
-                                                      filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                      filters=storage.get_filters('histogram'))
                 out_res_x.attrs.xedges = hist_residual_x_xedges
                 out_res_x.attrs.fit_coeff = fit_residual_x
                 out_res_x.attrs.fit_cov = cov_residual_x
@@ -420,7 +241,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                       title='Residual distribution in y direction for %s' % (dut_name),
                                                       atom=tb.Atom.from_dtype(hist_residual_y_hist.dtype),
                                                       shape=hist_residual_y_hist.shape,
-                                                      filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                      filters=storage.get_filters('histogram'))
                 out_res_y.attrs.yedges = hist_residual_y_yedges
                 out_res_y.attrs.fit_coeff = fit_residual_y
                 out_res_y.attrs.fit_cov = cov_residual_y
@@ -443,7 +264,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                         title='Residual distribution in x direction as a function of the x position for %s' % (dut_name),
                                                         atom=tb.Atom.from_dtype(hist_x_residual_x_hist.dtype),
                                                         shape=hist_x_residual_x_hist.shape,
-                                                        filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                        filters=storage.get_filters('histogram'))
                 out_x_res_x.attrs.xedges = hist_x_residual_x_xedges
                 out_x_res_x.attrs.yedges = hist_x_residual_x_yedges
                 out_x_res_x.attrs.fit_coeff = fit_x_residual_x
@@ -466,7 +287,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                         title='Residual distribution in y direction as a function of the y position for %s' % (dut_name),
                                                         atom=tb.Atom.from_dtype(hist_y_residual_y_hist.dtype),
                                                         shape=hist_y_residual_y_hist.shape,
-                                                        filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                        filters=storage.get_filters('histogram'))
                 out_y_res_y.attrs.xedges = hist_y_residual_y_xedges
                 out_y_res_y.attrs.yedges = hist_y_residual_y_yedges
                 out_y_res_y.attrs.fit_coeff = fit_y_residual_y
@@ -489,7 +310,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                         title='Residual distribution in y direction as a function of the x position for %s' % (dut_name),
                                                         atom=tb.Atom.from_dtype(hist_x_residual_y_hist.dtype),
                                                         shape=hist_x_residual_y_hist.shape,
-                                                        filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                        filters=storage.get_filters('histogram'))
                 out_x_res_y.attrs.xedges = hist_x_residual_y_xedges
                 out_x_res_y.attrs.yedges = hist_x_residual_y_yedges
                 out_x_res_y.attrs.fit_coeff = fit_x_residual_y
@@ -512,7 +333,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                         title='Residual distribution in x direction as a function of the y position for %s' % (dut_name),
                                                         atom=tb.Atom.from_dtype(hist_y_residual_x_hist.dtype),
                                                         shape=hist_y_residual_x_hist.shape,
-                                                        filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                        filters=storage.get_filters('histogram'))
                 out_y_res_x.attrs.xedges = hist_y_residual_x_xedges
                 out_y_res_x.attrs.yedges = hist_y_residual_x_yedges
                 out_y_res_x.attrs.fit_coeff = fit_y_residual_x
@@ -534,7 +355,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                         title='Residual distribution in column direction for %s' % (dut_name),
                                                         atom=tb.Atom.from_dtype(hist_residual_col_hist.dtype),
                                                         shape=hist_residual_col_hist.shape,
-                                                        filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                        filters=storage.get_filters('histogram'))
                 out_res_col.attrs.xedges = hist_residual_col_xedges
                 out_res_col.attrs.fit_coeff = fit_residual_col
                 out_res_col.attrs.fit_cov = cov_residual_col
@@ -554,7 +375,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                         title='Residual distribution in row direction for %s' % (dut_name),
                                                         atom=tb.Atom.from_dtype(hist_residual_row_hist.dtype),
                                                         shape=hist_residual_row_hist.shape,
-                                                        filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                        filters=storage.get_filters('histogram'))
                 out_res_row.attrs.yedges = hist_residual_row_yedges
                 out_res_row.attrs.fit_coeff = fit_residual_row
                 out_res_row.attrs.fit_cov = cov_residual_row
@@ -576,7 +397,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                             title='Residual distribution in column direction as a function of the column position for %s' % (dut_name),
                                                             atom=tb.Atom.from_dtype(hist_col_residual_col_hist.dtype),
                                                             shape=hist_col_residual_col_hist.shape,
-                                                            filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                            filters=storage.get_filters('histogram'))
                 out_col_res_col.attrs.xedges = hist_col_residual_col_xedges
                 out_col_res_col.attrs.yedges = hist_col_residual_col_yedges
                 out_col_res_col.attrs.fit_coeff = fit_col_residual_col
@@ -599,7 +420,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                             title='Residual distribution in row direction as a function of the row position for %s' % (dut_name),
                                                             atom=tb.Atom.from_dtype(hist_row_residual_row_hist.dtype),
                                                             shape=hist_row_residual_row_hist.shape,
-                                                            filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                            filters=storage.get_filters('histogram'))
                 out_row_res_row.attrs.xedges = hist_row_residual_row_xedges
                 out_row_res_row.attrs.yedges = hist_row_residual_row_yedges
                 out_row_res_row.attrs.fit_coeff = fit_row_residual_row
@@ -622,7 +443,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                             title='Residual distribution in row direction as a function of the column position for %s' % (dut_name),
                                                             atom=tb.Atom.from_dtype(hist_col_residual_row_hist.dtype),
                                                             shape=hist_col_residual_row_hist.shape,
-                                                            filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                            filters=storage.get_filters('histogram'))
                 out_col_res_row.attrs.xedges = hist_col_residual_row_xedges
                 out_col_res_row.attrs.yedges = hist_col_residual_row_yedges
                 out_col_res_row.attrs.fit_coeff = fit_col_residual_row
@@ -645,7 +466,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                                                             title='Residual distribution in column direction as a function of the row position for %s' % (dut_name),
                                                             atom=tb.Atom.from_dtype(hist_row_residual_col_hist.dtype),
                                                             shape=hist_row_residual_col_hist.shape,
-                                                            filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                            filters=storage.get_filters('histogram'))
                 out_row_res_col.attrs.xedges = hist_row_residual_col_xedges
                 out_row_res_col.attrs.yedges = hist_row_residual_col_yedges
                 out_row_res_col.attrs.fit_coeff = fit_row_residual_col
@@ -886,12 +707,23 @@ def calculate_efficiency(input_tracks_file, input_alignment_file, bin_size, sens
 
                 dut_group = out_file_h5.create_group(out_file_h5.root, 'DUT_%d' % actual_dut)
 
-                out_efficiency = out_file_h5.create_carray(dut_group, name='Efficiency', title='Efficiency map of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(efficiency.dtype), shape=efficiency.T.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-                out_efficiency_mask = out_file_h5.create_carray(dut_group, name='Efficiency_mask', title='Masked pixel map of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(efficiency.mask.dtype), shape=efficiency.mask.T.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                out_efficiency = out_file_h5.create_carray(dut_group, name='Efficiency', title='Efficiency map of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(efficiency.dtype), shape=efficiency.T.shape, filters=storage.get_filters('histogram'))
+                out_efficiency_mask = out_file_h5.create_carray(dut_group, name='Efficiency_mask', title='Masked pixel map of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(efficiency.mask.dtype), shape=efficiency.mask.T.shape, filters=storage.get_filters('histogram'))
 
                 # For correct statistical error calculation the number of detected tracks over total tracks is needed
-                out_pass = out_file_h5.create_carray(dut_group, name='Passing_tracks', title='Passing events of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(total_track_density_with_DUT_hit.dtype), shape=total_track_density_with_DUT_hit.T.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-                out_total = out_file_h5.create_carray(dut_group, name='Total_tracks', title='Total events of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(total_track_density.dtype), shape=total_track_density.T.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                out_pass = out_file_h5.create_carray(dut_group, name='Passing_tracks', title='Passing events of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(total_track_density_with_DUT_hit.dtype), shape=total_track_density_with_DUT_hit.T.shape, filters=storage.get_filters('histogram'))
+                out_total = out_file_h5.create_carray(dut_group, name='Total_tracks', title='Total events of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(total_track_density.dtype), shape=total_track_density.T.shape, filters=storage.get_filters('histogram'))
+
+                # Statistical errors of the efficiency map
+                efficiency_lower_limit, efficiency_upper_limit = analysis_utils.get_efficiency_interval(array_pass=total_track_density_with_DUT_hit,
+                                                                                                        array_total=total_track_density)
+                out_efficiency_lower_limit = out_file_h5.create_carray(dut_group, name='Efficiency_lower_limit', title='Lower limit of efficiency map of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(efficiency_lower_limit.dtype), shape=efficiency_lower_limit.T.shape, filters=storage.get_filters('histogram'))
+                out_efficiency_upper_limit = out_file_h5.create_carray(dut_group, name='Efficiency_upper_limit', title='Upper limit of efficiency map of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(efficiency_upper_limit.dtype), shape=efficiency_upper_limit.T.shape, filters=storage.get_filters('histogram'))
+                for out_limit in (out_efficiency_lower_limit, out_efficiency_upper_limit):
+                    out_limit.attrs.interval = 0.68
+                    out_limit.attrs.method = 'clopper_pearson'
+                out_efficiency_lower_limit[:] = efficiency_lower_limit.T * 100.
+                out_efficiency_upper_limit[:] = efficiency_upper_limit.T * 100.
 
                 pass_tracks.append(total_track_density_with_DUT_hit.sum())
                 total_tracks.append(total_track_density.sum())
@@ -1126,12 +958,12 @@ def calculate_purity(input_tracks_file, input_alignment_file, bin_size, sensor_s
 
                 dut_group = out_file_h5.create_group(out_file_h5.root, 'DUT_%d' % actual_dut)
 
-                out_purity = out_file_h5.create_carray(dut_group, name='Purity', title='Purity map of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(purity.dtype), shape=purity.T.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-                out_purity_mask = out_file_h5.create_carray(dut_group, name='Purity_mask', title='Masked pixel map of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(purity.mask.dtype), shape=purity.mask.T.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                out_purity = out_file_h5.create_carray(dut_group, name='Purity', title='Purity map of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(purity.dtype), shape=purity.T.shape, filters=storage.get_filters('histogram'))
+                out_purity_mask = out_file_h5.create_carray(dut_group, name='Purity_mask', title='Masked pixel map of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(purity.mask.dtype), shape=purity.mask.T.shape, filters=storage.get_filters('histogram'))
 
                 # For correct statistical error calculation the number of pure hits over total hits is needed
-                out_pure_hits = out_file_h5.create_carray(dut_group, name='Pure_hits', title='Passing events of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(total_pure_hit_hist.dtype), shape=total_pure_hit_hist.T.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-                out_total_total = out_file_h5.create_carray(dut_group, name='Total_hits', title='Total events of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(total_hit_hist.dtype), shape=total_hit_hist.T.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                out_pure_hits = out_file_h5.create_carray(dut_group, name='Pure_hits', title='Passing events of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(total_pure_hit_hist.dtype), shape=total_pure_hit_hist.T.shape, filters=storage.get_filters('histogram'))
+                out_total_total = out_file_h5.create_carray(dut_group, name='Total_hits', title='Total events of DUT%d' % actual_dut, atom=tb.Atom.from_dtype(total_hit_hist.dtype), shape=total_hit_hist.T.shape, filters=storage.get_filters('histogram'))
 
                 pure_hits.append(total_pure_hit_hist.sum())
                 total_hits.append(total_hit_hist.sum())
@@ -1251,19 +1083,19 @@ def histogram_track_angle(input_tracks_file, input_alignment_file=None, output_t
                                                               title='Total track angle distribution%s' % (("_for_%s" % dut_name) if dut_name else ""),
                                                               atom=tb.Atom.from_dtype(total_angle_hist.dtype),
                                                               shape=total_angle_hist.shape,
-                                                              filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                              filters=storage.get_filters('histogram'))
                 track_angle_beta = out_file_h5.create_carray(where=out_file_h5.root,
                                                              name='Beta_Track_Angle_Hist%s' % (("_%s" % dut_name) if dut_name else ""),
                                                              title='Beta track angle distribution%s' % (("_for_%s" % dut_name) if dut_name else ""),
                                                              atom=tb.Atom.from_dtype(beta_angle_hist.dtype),
                                                              shape=beta_angle_hist.shape,
-                                                             filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                             filters=storage.get_filters('histogram'))
                 track_angle_alpha = out_file_h5.create_carray(where=out_file_h5.root,
                                                               name='Alpha_Track_Angle_Hist%s' % (("_%s" % dut_name) if dut_name else ""),
                                                               title='Alpha track angle distribution%s' % (("_for_%s" % dut_name) if dut_name else ""),
                                                               atom=tb.Atom.from_dtype(alpha_angle_hist.dtype),
                                                               shape=alpha_angle_hist.shape,
-                                                              filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                                                              filters=storage.get_filters('histogram'))
 
                 # fit histograms for x and y direction
                 bin_center = (total_angle_hist_edges[1:] + total_angle_hist_edges[:-1]) / 2.0
@@ -1303,3 +1135,91 @@ def histogram_track_angle(input_tracks_file, input_alignment_file=None, output_t
 
     if plot:
         plot_utils.plot_track_angle(input_track_angle_file=output_track_angle_file, output_pdf_file=None, dut_names=dut_names)
+
+
+# Helper functions that are not meant to be called directly during analysis
+@njit
+def _get_bin_index(value, edges):
+    ''' Returns the bin index of the value for monotonically increasing, (nearly) uniform bin edges.
+    The index is calculated from the bin width and corrected with the edges, giving the same result as numpy.histogram().
+    Returns -1 for values outside the edges and NaN. '''
+    n_bins = edges.shape[0] - 1
+    if not (value >= edges[0] and value <= edges[n_bins]):
+        return -1
+    index = int((value - edges[0]) * (n_bins / (edges[n_bins] - edges[0])))
+    index = min(max(index, 0), n_bins - 1)
+    while index > 0 and value < edges[index]:
+        index -= 1
+    while index < n_bins - 1 and value >= edges[index + 1]:
+        index += 1
+    return index
+
+
+@njit
+def _fill_residual_histograms(residual_x, residual_y, position_x, position_y,
+                              residual_x_edges, residual_y_edges, position_x_edges, position_y_edges,
+                              hist_residual_x, hist_residual_y,
+                              hist_x_residual_x, hist_y_residual_y, hist_x_residual_y, hist_y_residual_x):
+    ''' Adds the residuals to the 1D residual histograms and the 2D residual vs. position histograms of one coordinate system (global x/y or local column/row).
+    The bin indices of each track are calculated once and shared between all histograms. '''
+    for i in range(residual_x.shape[0]):
+        residual_x_index = _get_bin_index(residual_x[i], residual_x_edges)
+        residual_y_index = _get_bin_index(residual_y[i], residual_y_edges)
+        position_x_index = _get_bin_index(position_x[i], position_x_edges)
+        position_y_index = _get_bin_index(position_y[i], position_y_edges)
+
+        if residual_x_index >= 0:
+            hist_residual_x[residual_x_index] += 1
+            if position_x_index >= 0:
+                hist_x_residual_x[position_x_index, residual_x_index] += 1
+            if position_y_index >= 0:
+                hist_y_residual_x[position_y_index, residual_x_index] += 1
+        if residual_y_index >= 0:
+            hist_residual_y[residual_y_index] += 1
+            if position_y_index >= 0:
+                hist_y_residual_y[position_y_index, residual_y_index] += 1
+            if position_x_index >= 0:
+                hist_x_residual_y[position_x_index, residual_y_index] += 1
+
+
+def _get_residual_binning(difference, pixel_size, nbins_per_pixel=None, plot_n_pixels=6.0):
+    ''' Returns the number of bins and the range of a residual histogram. The residual peak is detected
+    and the range is set to plot_n_pixels times the FWHM, but at least plot_n_pixels pixels. '''
+    # detect peaks and calculate width to estimate the size of the histograms
+    if nbins_per_pixel is not None:
+        min_difference, max_difference = np.min(difference), np.max(difference)
+        nbins = np.arange(min_difference - (pixel_size / nbins_per_pixel), max_difference + 2 * (pixel_size / nbins_per_pixel), pixel_size / nbins_per_pixel)
+    else:
+        nbins = "auto"
+    hist, edges = np.histogram(difference, bins=nbins)
+    edge_center = (edges[1:] + edges[:-1]) / 2.0
+    try:
+        _, center, fwhm, _ = analysis_utils.peak_detect(edge_center, hist)
+    except RuntimeError:
+        # do some simple FWHM with numpy array
+        try:
+            _, center, fwhm, _ = analysis_utils.simple_peak_detect(edge_center, hist)
+        except RuntimeError:
+            center, fwhm = 0.0, pixel_size * plot_n_pixels
+
+    # calculate the binning of the histograms, the minimum size is given by plot_n_pixels, otherwise FWHM is taken into account
+    if nbins_per_pixel is not None:
+        width = max(plot_n_pixels * pixel_size, pixel_size * np.ceil(plot_n_pixels * fwhm / pixel_size))
+        if np.mod(width / pixel_size, 2) != 0:
+            width += pixel_size
+        nbins = int(nbins_per_pixel * width / pixel_size)
+        hist_range = (center - 0.5 * width, center + 0.5 * width)
+    else:
+        nbins = "auto"
+        width = pixel_size * np.ceil(plot_n_pixels * fwhm / pixel_size)
+        hist_range = (center - width, center + width)
+
+    return nbins, hist_range
+
+
+def _get_position_binning(position, pixel_size, npixels_per_bin=None):
+    ''' Returns the binning of the position axis of a residual vs. position histogram. '''
+    if npixels_per_bin is not None:
+        min_position, max_position = np.min(position), np.max(position)
+        return np.arange(min_position, max_position + npixels_per_bin * pixel_size, npixels_per_bin * pixel_size)
+    return "auto"
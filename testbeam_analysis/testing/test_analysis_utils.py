@@ -6,6 +6,7 @@ import unittest
 
 import tables as tb
 import numpy as np
+from scipy import stats
 
 from testbeam_analysis.cpp import data_struct
 from testbeam_analysis.tools import analysis_utils, test_tools
@@ -134,6 +135,118 @@ class TestAnalysisUtils(unittest.TestCase):
                 pass
             self.assertTrue(exception_ok & np.all(array == array_fast))
 
+    def test_position_error_lookup(self):  # check position errors of small and big clusters
+        cluster_size_hist = np.array([0, 6, 3, 0, 1], dtype=np.uint32)
+        position_error_lookup = analysis_utils.get_position_error_lookup(cluster_size_hist)
+        self.assertAlmostEqual(position_error_lookup[1], np.sqrt(0.6 / 12))
+        self.assertAlmostEqual(position_error_lookup[2], np.sqrt(0.3 / 12))
+        err_cols = np.array([1, 1, 2, 2, 3. / np.sqrt(12)], dtype=np.float32)
+        err_rows = np.array([1, 2, 1, 2, 1. / np.sqrt(12)], dtype=np.float32)
+        analysis_utils.apply_position_error_lookup(err_cols, err_rows, position_error_lookup)
+        np.testing.assert_allclose(err_cols, position_error_lookup[[1, 1, 2, 2]].tolist() + [3. / np.sqrt(12)], rtol=1e-6)
+        np.testing.assert_allclose(err_rows, position_error_lookup[[1, 2, 1, 2]].tolist() + [1. / np.sqrt(12)], rtol=1e-6)
+        # Cluster size 2 does not exist in histogram
+        position_error_lookup = analysis_utils.get_position_error_lookup(np.array([0, 4], dtype=np.uint32))
+        np.testing.assert_allclose(position_error_lookup, [0., np.sqrt(1. / 12), 0.])
+
+    def test_searchsorted_event_number(self):  # check binary search in table and data selection by event number
+        event_numbers = np.sort(np.random.RandomState(0).randint(0, 5000, size=20000)).astype(np.int64)
+        data = np.zeros(shape=event_numbers.shape, dtype=[('event_number', np.int64), ('value', np.uint32)])
+        data['event_number'] = event_numbers
+        data['value'] = np.arange(data.shape[0])
+        with tb.open_file(os.path.join(testing_path, 'event_numbers.h5'), mode='w', driver='H5FD_CORE', driver_core_backing_store=0) as out_file_h5:
+            table = out_file_h5.create_table(out_file_h5.root, name='Hits', obj=data)
+            for event_number in (-1, 0, 1, 17, 2500, 4999, 5000, 6000):
+                for side in ('left', 'right'):
+                    for block_size in (1, 10, 10000):
+                        self.assertEqual(np.searchsorted(event_numbers, event_number, side=side), analysis_utils.searchsorted_event_number(table, event_number, side=side, block_size=block_size))
+                    self.assertEqual(min(max(np.searchsorted(event_numbers, event_number, side=side), 100), 1000), analysis_utils.searchsorted_event_number(table, event_number, side=side, start_index=100, stop_index=1000, block_size=10))
+            for start_event_number, stop_event_number in ((0, 10), (1002, 3000), (4990, None)):
+                selected_data = np.concatenate([chunk for chunk, _ in analysis_utils.data_aligned_at_events(table, start_event_number=start_event_number, stop_event_number=stop_event_number, chunk_size=999, fail_on_missing_events=False)])
+                selection = data['event_number'] >= start_event_number
+                if stop_event_number is not None:
+                    selection &= data['event_number'] < stop_event_number
+                np.testing.assert_array_equal(selected_data, data[selection])
+
+    def test_data_aligned_at_events_in_tables(self):  # check reading several tables in lockstep
+        random_state = np.random.RandomState(0)
+        with tb.open_file(os.path.join(testing_path, 'event_numbers.h5'), mode='w', driver='H5FD_CORE', driver_core_backing_store=0) as out_file_h5:
+            tables, data = [], []
+            for index, max_event_number in enumerate((5000, 5500, 4000)):
+                actual_data = np.zeros(shape=(20000,), dtype=[('event_number', np.int64), ('value', np.uint32)])
+                actual_data['event_number'] = np.sort(random_state.randint(0, max_event_number, size=actual_data.shape[0]))
+                actual_data['value'] = np.arange(actual_data.shape[0])
+                tables.append(out_file_h5.create_table(out_file_h5.root, name='Hits_%d' % index, obj=actual_data))
+                data.append(actual_data)
+            for chunk_size in (999, 10000000):
+                chunks = [[] for _ in tables]
+                for actual_chunks, index in analysis_utils.data_aligned_at_events_in_tables(tables, chunk_size=chunk_size):
+                    self.assertEqual(index, np.searchsorted(data[0]['event_number'], actual_chunks[0]['event_number'][-1], side='right'))
+                    for actual_chunk in actual_chunks[1:]:  # chunks of the other tables end at the last event of the reference chunk
+                        self.assertTrue(actual_chunk.shape[0] == 0 or actual_chunk['event_number'][-1] <= actual_chunks[0]['event_number'][-1])
+                    for table_index, actual_chunk in enumerate(actual_chunks):
+                        chunks[table_index].append(actual_chunk)
+                for actual_data, actual_chunks in zip(data, chunks):
+                    np.testing.assert_array_equal(np.concatenate(actual_chunks), actual_data[actual_data['event_number'] <= data[0]['event_number'][-1]])
+
+    def test_dut_data_layouts(self):  # check reading and writing DUT data in both merged table layouts
+        random_state = np.random.RandomState(0)
+        x = random_state.normal(size=(1000, 4))
+        data_columns = np.zeros(shape=(1000,), dtype=analysis_utils.get_merged_description(n_duts=4))
+        data_arrays = np.zeros(shape=(1000,), dtype=analysis_utils.get_merged_description(n_duts=4, dut_arrays=True))
+        self.assertFalse(analysis_utils.has_dut_arrays(data_columns))
+        self.assertTrue(analysis_utils.has_dut_arrays(data_arrays))
+        self.assertEqual(len(data_columns.dtype.names), 8 * 4 + 3)
+        self.assertEqual(len(data_arrays.dtype.names), 8 + 3)
+        for data in (data_columns, data_arrays):
+            analysis_utils.set_dut_data(data, 'x', x)
+            analysis_utils.set_dut_data(data, 'xerr', x[:, 2], dut_index=1)
+            np.testing.assert_array_equal(analysis_utils.get_dut_data(data, 'x'), x)
+            np.testing.assert_array_equal(analysis_utils.get_dut_data(data, 'x', dut_index=3), x[:, 3])
+            np.testing.assert_array_equal(analysis_utils.get_dut_data(data, 'xerr')[:, 1], x[:, 2])
+        analysis_utils.get_dut_data(data_arrays, 'y')[:] = x  # DUT arrays are views of the data
+        np.testing.assert_array_equal(data_arrays['y'], x)
+        data_reduced = np.zeros(shape=(1000,), dtype=analysis_utils.get_merged_description(n_duts=4, reduced_precision=True))
+        self.assertEqual(data_reduced.itemsize, 8 + 4 * (7 * 4 + 1) + 4 + 1)  # float32 positions, errors and charges
+
+    def test_hough_transform(self):  # check compiled Hough transform against closest rho search
+        random_state = np.random.RandomState(0)
+        img = np.zeros(shape=(80, 100), dtype=np.int32)
+        img[np.arange(80), np.arange(80) // 2 + 10] = 1  # straight line
+        img[random_state.randint(0, 80, size=50), random_state.randint(0, 100, size=50)] = 1  # background
+        for theta_res, rho_res in ((1.0, 1.0), (0.5, 0.7)):
+            accumulator, thetas, rhos = analysis_utils.hough_transform(img, theta_res=theta_res, rho_res=rho_res)
+            accumulator_expected = np.zeros_like(accumulator)
+            y_idxs, x_idxs = np.nonzero(img)
+            for theta_idx, theta in enumerate(thetas):
+                rho_values = x_idxs * np.cos(theta) + y_idxs * np.sin(theta)
+                np.add.at(accumulator_expected[:, theta_idx], np.argmin(np.abs(rhos[np.newaxis, :] - rho_values[:, np.newaxis]), axis=1), 1)
+            np.testing.assert_array_equal(accumulator, accumulator_expected)
+            for result in analysis_utils.hough_transforms([img, img.T], theta_res=theta_res, rho_res=rho_res):
+                self.assertEqual(result[0].sum(), img.sum() * thetas.shape[0])
+            # Changing the returned bin centers does not change the cached tables
+            thetas *= 2.
+            np.testing.assert_array_equal(analysis_utils.hough_transform(img, theta_res=theta_res, rho_res=rho_res)[1], thetas / 2.)
+
+    def test_efficiency_interval(self):  # check efficiency limits of efficiency maps
+        array_total = np.array([[0, 1, 10, 100], [1000, 1000, 1000, 20]], dtype=np.float)
+        array_pass = np.array([[0, 1, 7, 100], [0, 500, 999, 19]], dtype=np.float)
+        for method in ('clopper_pearson', 'bayesian'):
+            lower, upper = analysis_utils.get_efficiency_interval(array_pass, array_total, interval=0.68, method=method)
+            self.assertTrue(np.isnan(lower[0, 0]) and np.isnan(upper[0, 0]))  # no tracks
+            self.assertTrue(np.all(lower[array_total > 0] >= 0.) and np.all(upper[array_total > 0] <= 1.) and np.all(lower[array_total > 0] < upper[array_total > 0]))
+        # Clopper-Pearson limits contain the efficiency, check limits for no passing / all passing events
+        lower, upper = analysis_utils.get_efficiency_interval(array_pass, array_total, interval=0.68)
+        efficiency = array_pass[array_total > 0] / array_total[array_total > 0]
+        self.assertTrue(np.all(lower[array_total > 0] <= efficiency) and np.all(efficiency <= upper[array_total > 0]))
+        self.assertEqual(lower[1, 0], 0.)
+        self.assertEqual(upper[0, 3], 1.)
+        np.testing.assert_allclose(upper[1, 0], 1. - 0.16**(1. / 1000), rtol=1e-6)
+        np.testing.assert_allclose(lower[0, 3], 0.16**(1. / 100), rtol=1e-6)
+        # Bayesian limits contain the interval of the efficiency probability density function
+        lower, upper = analysis_utils.get_efficiency_interval(array_pass, array_total, interval=0.68, method='bayesian')
+        np.testing.assert_allclose(stats.beta.cdf(upper[array_total > 0], array_pass[array_total > 0] + 1, array_total[array_total > 0] - array_pass[array_total > 0] + 1) - stats.beta.cdf(lower[array_total > 0], array_pass[array_total > 0] + 1, array_total[array_total > 0] - array_pass[array_total > 0] + 1), 0.68, rtol=1e-6)
+
 if __name__ == '__main__':
     import logging
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
@@ -0,0 +1,63 @@
+''' Script to check the batch analysis of several runs.
+'''
+import os
+import shutil
+import unittest
+
+from testbeam_analysis import batch_analysis
+from testbeam_analysis.tools import simulate_data, test_tools
+
+testing_path = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestBatchAnalysis(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_folder = 'tmp_test_batch_output'
+        test_tools.create_folder(cls.output_folder)
+        sim = simulate_data.SimulateData(random_seed=0)
+        sim.n_duts = 3
+        sim.set_std_settings()
+        cls.runs = {}
+        for run_name in ('run_0', 'run_1'):
+            sim.create_data_and_store(os.path.join(cls.output_folder, run_name), n_events=10000)
+            cls.runs[run_name] = [os.path.join(cls.output_folder, run_name + '_DUT%d.h5' % dut_index) for dut_index in range(sim.n_duts)]
+        cls.setup = {'n_pixels': sim.dut_n_pixel,
+                     'pixel_size': sim.dut_pixel_size,
+                     'z_positions': sim.z_positions,
+                     'mask': {'plot': False},
+                     'cluster': {'plot': False},
+                     'correlate': {'plot': False}}
+
+    @classmethod
+    def tearDownClass(cls):  # remove created files
+        shutil.rmtree(cls.output_folder)
+
+    def test_batch_analysis(self):  # check that all stages run and are skipped when called again
+        stages = ('mask', 'cluster', 'correlate', 'merge')
+        report = batch_analysis.run_batch_analysis(self.runs, self.setup, output_folder=self.output_folder, stages=stages, n_cores=3)
+        self.assertEqual(len(report), 2 * (2 * 3 + 2))  # Two per DUT stages and two stages per run
+        self.assertTrue(all(wall_time is not None for _, _, _, wall_time in report))
+        for run_name in self.runs:
+            for file_name in ('Correlation.h5', 'Merged.h5'):
+                self.assertTrue(os.path.isfile(os.path.join(self.output_folder, run_name, file_name)))
+            # Per DUT stages run before the stages that need all DUTs
+            run_stages = [stage for actual_run_name, stage, _, _ in report if actual_run_name == run_name]
+            self.assertEqual(run_stages.index('mask'), 0)
+            self.assertGreater(min(run_stages.index('correlate'), run_stages.index('merge')), max(index for index, stage in enumerate(run_stages) if stage == 'cluster'))
+
+        # Outputs are up to date, nothing to do
+        report = batch_analysis.run_batch_analysis(self.runs, self.setup, output_folder=self.output_folder, stages=stages, n_cores=3)
+        self.assertTrue(all(wall_time is None for _, _, _, wall_time in report))
+
+        # Stages that fail are reported
+        with self.assertRaises(RuntimeError):
+            batch_analysis.run_batch_analysis(self.runs, dict(self.setup, merge={'unknown_parameter': 0}), output_folder=self.output_folder, stages=('merge', ), n_cores=3, force=True)
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestBatchAnalysis)
+    unittest.TextTestRunner(verbosity=2).run(suite)
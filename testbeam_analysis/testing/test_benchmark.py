@@ -0,0 +1,51 @@
+''' Script to check the benchmark of the analysis stages.
+'''
+import os
+import json
+import shutil
+import unittest
+
+from testbeam_analysis.tools import benchmark
+
+testing_path = os.path.dirname(os.path.abspath(__file__))
+
+
+def _crash():  # Exits without sending a result, like a process killed when out of memory
+    os._exit(1)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_folder = os.path.join(testing_path, 'tmp_test_benchmark_output')
+
+    @classmethod
+    def tearDownClass(cls):  # remove created files
+        shutil.rmtree(cls.output_folder, ignore_errors=True)
+
+    def test_benchmark(self):  # check that the results of all selected stages are stored
+        stages = ('generate_pixel_mask', 'cluster_hits', 'correlate_cluster', 'merge_cluster_data')
+        result = benchmark.run_benchmark(self.output_folder, n_duts=3, n_events=10000, stages=stages)
+        with open(os.path.join(self.output_folder, 'benchmark.json')) as in_file:
+            self.assertEqual(json.load(in_file), json.loads(json.dumps(result)))
+        self.assertEqual(result['settings']['n_events'], 10000)
+        self.assertListEqual([stage_result['stage'] for stage_result in result['results']], list(stages))
+        for stage_result in result['results']:
+            self.assertGreater(stage_result['wall_time'], 0)
+            self.assertGreater(stage_result['input_rows'], 0)
+            self.assertAlmostEqual(stage_result['rows_per_second'], stage_result['input_rows'] / stage_result['wall_time'])
+
+        with self.assertRaises(ValueError):
+            benchmark.run_benchmark(self.output_folder, stages=('unknown_stage', ))
+
+    def test_crashed_stage(self):  # check that a stage process that dies is reported and does not block
+        with self.assertRaises(RuntimeError):
+            benchmark._benchmark_stage('crash', [(_crash, {})])
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestBenchmark)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,64 @@
+''' Script to check the formatting of EUDAQ hit data.
+'''
+import os
+
+import unittest
+
+import tables as tb
+import numpy as np
+
+from testbeam_analysis.converter import eudaq_converter
+
+testing_path = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestEudaqConverter(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_file = os.path.join(testing_path, 'eudaq_data.h5')
+        cls.output_files = [os.path.join(testing_path, 'eudaq_data_DUT%d.h5' % dut_index) for dut_index in range(3)]
+        random_state = np.random.RandomState(0)
+        hit_dtype = [('timestamp', np.uint64), ('plane', np.uint8), ('frame', np.uint8), ('x', np.uint16), ('y', np.uint16), ('val', np.uint16)]
+        # Two readout nodes, plane 1 is read out by both nodes with interleaved time stamps
+        cls.nodes = {}
+        for node_name, planes in (('NI', (0, 1)), ('USBPIX', (1, 2))):
+            hits = np.zeros(shape=(10000,), dtype=hit_dtype)
+            hits['timestamp'] = np.sort(random_state.randint(100, 5000, size=hits.shape[0]))
+            hits['plane'] = random_state.choice(planes, size=hits.shape[0])
+            hits['x'] = random_state.randint(0, 80, size=hits.shape[0])
+            hits['y'] = random_state.randint(0, 336, size=hits.shape[0])
+            hits['val'] = random_state.randint(0, 14, size=hits.shape[0])
+            cls.nodes[node_name] = hits
+        with tb.open_file(cls.data_file, 'w') as out_file:
+            for node_name, hits in cls.nodes.items():
+                out_file.create_table(out_file.root, name=node_name, obj=hits)
+
+    @classmethod
+    def tearDownClass(cls):  # remove created files
+        for f in [cls.data_file] + cls.output_files:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def test_format_hit_table(self):  # check that hits of a plane from several readout nodes are merged ordered by event number
+        eudaq_converter.format_hit_table(self.data_file, chunk_size=999)
+        all_hits = np.concatenate(list(self.nodes.values()))
+        min_timestamp = all_hits['timestamp'].min()
+        for dut_index, output_file in enumerate(self.output_files):
+            with tb.open_file(output_file) as in_file:
+                hits = in_file.root.Hits[:]
+            hits_expected = all_hits[all_hits['plane'] == dut_index]
+            self.assertEqual(hits.shape[0], hits_expected.shape[0])
+            self.assertTrue(np.all(np.diff(hits['event_number']) >= 0))
+            np.testing.assert_array_equal(hits['event_number'], np.sort(hits_expected['timestamp'] - min_timestamp))
+            # Same hits independent of the order
+            hits_expected_formatted = np.column_stack((hits_expected['timestamp'] - min_timestamp, hits_expected['x'] + 1, hits_expected['y'] + 1, hits_expected['val']))
+            hits_formatted = np.column_stack((hits['event_number'], hits['column'], hits['row'], hits['charge']))
+            np.testing.assert_array_equal(hits_formatted[np.lexsort(hits_formatted.T[::-1])], hits_expected_formatted[np.lexsort(hits_expected_formatted.T[::-1])])
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestEudaqConverter)
+    unittest.TextTestRunner(verbosity=2).run(suite)
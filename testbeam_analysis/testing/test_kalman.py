@@ -64,6 +64,35 @@ class TestTrackAnalysis(unittest.TestCase):
             data_equal = np.allclose(test, result[i])
             self.assertTrue(data_equal)
 
+    def test_kalman_missing_hit(self):
+        ''' Check that a missing hit of a single track is treated like a DUT which is not in the fit selection.'''
+        pixel_size = np.array([(18.5, 18.5)] * 6)
+        pixel_resolution = pixel_size / np.sqrt(12)
+        track_hits = np.array([[[-1229.22372954, 2828.19616302, 0., pixel_resolution[0][0], pixel_resolution[0][1]],
+                                [-1254.51224282, 2827.4291421, 29900., pixel_resolution[1][0], pixel_resolution[1][1]],
+                                [-1285.6117892, 2822.34536687, 60300., pixel_resolution[2][0], pixel_resolution[2][1]],
+                                [-1311.31083616, 2823.56121414, 82100., pixel_resolution[3][0], pixel_resolution[3][1]],
+                                [-1335.8529645, 2828.43359043, 118700., pixel_resolution[4][0], pixel_resolution[4][1]],
+                                [-1357.81872222, 2840.86947964, 160700., pixel_resolution[5][0], pixel_resolution[5][1]]]])
+        kwargs = {'pixel_size': pixel_size,
+                  'n_pixels': [(576, 1152)] * 6,
+                  'z_positions': [0., 29900, 60300, 82100, 118700, 160700],
+                  'alignment': None,
+                  'beam_energy': 2500.,
+                  'material_budget': np.array([100.] * 6) / 125390.,
+                  'add_scattering_plane': False}
+
+        # Second track has no hit in DUT 3
+        track_hits_missing = np.concatenate((track_hits, track_hits), axis=0)
+        track_hits_missing[1, 3] = np.nan
+        result_missing = track_analysis._fit_tracks_kalman_loop(track_hits=track_hits_missing, dut_fit_selection=0b111111, **kwargs)
+        result_all = track_analysis._fit_tracks_kalman_loop(track_hits=track_hits, dut_fit_selection=0b111111, **kwargs)
+        result_excluded = track_analysis._fit_tracks_kalman_loop(track_hits=track_hits, dut_fit_selection=0b110111, **kwargs)
+
+        for i in range(4):  # test each return (state estimates, chi, x error, y errors) seperatly
+            self.assertTrue(np.allclose(result_missing[i][0], result_all[i][0]))
+            self.assertTrue(np.allclose(result_missing[i][1], result_excluded[i][0]))
+
 
 if __name__ == '__main__':
     import logging
@@ -462,6 +462,26 @@ class TestHitAnalysis(unittest.TestCase):
                                                                 exact=False)
             self.assertTrue(data_equal, msg=error_msg)
 
+    def test_parallel_simulation(self):
+        ''' Check that the parallel simulation does not depend on the number of cores '''
+        self.simulate_data.reset()
+        self.simulate_data.set_std_settings()
+
+        hits = []
+        for n_cores in (1, 3):
+            self.simulate_data.create_data_and_store(
+                'simulated_data_parallel', n_events=10000, chunk_size=3000, parallel=True, n_cores=n_cores)
+            actual_hits = []
+            for dut_index in range(self.simulate_data.n_duts):
+                with tb.open_file('simulated_data_parallel_DUT%d.h5' % dut_index, 'r') as in_file_h5:
+                    actual_hits.append(in_file_h5.root.Hits[:])
+                os.remove('simulated_data_parallel_DUT%d.h5' % dut_index)
+            hits.append(actual_hits)
+
+        for dut_index in range(self.simulate_data.n_duts):
+            np.testing.assert_array_equal(hits[0][dut_index], hits[1][dut_index])
+            self.assertTrue(np.all(np.diff(hits[0][dut_index]['event_number']) >= 0))
+
 
 if __name__ == '__main__':
     import logging
@@ -0,0 +1,92 @@
+''' Script to check the split, map, combine class.
+'''
+import os
+
+import unittest
+
+import tables as tb
+import numpy as np
+
+from testbeam_analysis.tools import smc, analysis_utils
+
+testing_path = os.path.dirname(os.path.abspath(__file__))
+
+
+def _select_data(data):  # Changes the number of rows
+    return data[data['charge'] > 5]
+
+
+def _hist_data(data):
+    return analysis_utils.hist_1d_index(data['charge'], shape=(np.max(data['charge']) + 1,))
+
+
+def _select_data_and_hist(data):
+    return _select_data(data), _hist_data(data)
+
+
+class TestSMC(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_file = os.path.join(testing_path, 'smc_data.h5')
+        cls.output_file = os.path.join(testing_path, 'smc_result.h5')
+        np.random.seed(0)
+        data = np.zeros(shape=(100000,), dtype=[('event_number', np.int64), ('charge', np.uint16)])
+        data['event_number'] = np.sort(np.random.randint(0, 20000, size=data.shape[0]))
+        data['charge'] = np.random.randint(0, 20, size=data.shape[0])
+        cls.data = data
+        with tb.open_file(cls.data_file, 'w') as out_file:
+            out_file.create_table(out_file.root, name='Hits', obj=data)
+
+    @classmethod
+    def tearDownClass(cls):  # remove created files
+        for f in (cls.data_file, cls.output_file):
+            if os.path.exists(f):
+                os.remove(f)
+
+    def test_table(self):  # check resulting table for different number of cores
+        for n_cores in (1, 3):
+            smc.SMC(table_file_in=self.data_file, file_out=self.output_file, func=_select_data, node_desc={'name': 'Selected'}, align_at='event_number', n_cores=n_cores, chunk_size=9999)
+            with tb.open_file(self.output_file) as in_file:
+                np.testing.assert_array_equal(in_file.root.Selected[:], _select_data(self.data))
+
+    def test_histogram(self):  # check resulting histogram for different number of cores
+        for n_cores in (1, 3):
+            smc.SMC(table_file_in=self.data_file, file_out=self.output_file, func=_hist_data, node_desc={'name': 'Hist'}, n_cores=n_cores, chunk_size=9999)
+            with tb.open_file(self.output_file) as in_file:
+                np.testing.assert_array_equal(in_file.root.Hist[:], _hist_data(self.data))
+
+    def test_table_and_histogram(self):  # check resulting table and additional histogram
+        for n_cores in (1, 3):
+            smc_obj = smc.SMC(table_file_in=self.data_file, file_out=self.output_file, func=_select_data_and_hist, node_desc={'name': 'Selected'}, align_at='event_number', n_cores=n_cores, chunk_size=9999)
+            with tb.open_file(self.output_file) as in_file:
+                np.testing.assert_array_equal(in_file.root.Selected[:], _select_data(self.data))
+            np.testing.assert_array_equal(smc_obj.aux_data, _hist_data(self.data))
+
+    def test_in_place(self):  # check that the input table can be overwritten
+        with tb.open_file(self.output_file, 'w') as out_file:
+            out_file.create_table(out_file.root, name='Hits', obj=self.data)
+        smc.SMC(table_file_in=self.output_file, file_out=self.output_file, func=_select_data, align_at='event_number', n_cores=3, chunk_size=9999)
+        with tb.open_file(self.output_file) as in_file:
+            np.testing.assert_array_equal(in_file.root.Hits[:], _select_data(self.data))
+        self.assertFalse([f for f in os.listdir(testing_path) if f.startswith('tmp')])
+
+    def test_pipelined(self):  # check that items are returned in order and only n_pending items are submitted ahead
+        for n_pending in (0, 1, 3, 20):
+            submitted = []
+
+            def submit(item):
+                submitted.append(item)
+                return item ** 2
+
+            for item, result in smc.pipelined(items=range(10), submit=submit, n_pending=n_pending):
+                self.assertEqual(result, item ** 2)
+                self.assertEqual(submitted[-1], min(item + n_pending, 9))
+            self.assertListEqual(submitted, list(range(10)))
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSMC)
+    unittest.TextTestRunner(verbosity=2).run(suite)
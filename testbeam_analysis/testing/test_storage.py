@@ -0,0 +1,82 @@
+''' Script to check the storage policy of the created tables.
+'''
+import os
+
+import unittest
+
+import tables as tb
+import numpy as np
+
+from testbeam_analysis.tools import storage, data_selection
+
+testing_path = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestStorage(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_file = os.path.join(testing_path, 'storage_data.h5')
+        cls.output_file = os.path.join(testing_path, 'storage_result.h5')
+        np.random.seed(0)
+        data = np.zeros(shape=(100000,), dtype=[('event_number', np.int64), ('frame', np.uint8), ('column', np.uint16), ('row', np.uint16), ('charge', np.uint16)])
+        data['event_number'] = np.sort(np.random.randint(0, 20000, size=data.shape[0]))
+        data['column'] = np.random.randint(1, 81, size=data.shape[0])
+        data['row'] = np.random.randint(1, 337, size=data.shape[0])
+        data['charge'] = np.random.randint(0, 14, size=data.shape[0])
+        with tb.open_file(cls.data_file, 'w') as out_file:
+            out_file.create_table(out_file.root, name='Hits', obj=data)
+
+    @classmethod
+    def tearDownClass(cls):  # remove created files
+        storage.set_storage_policy(None)
+        for f in (cls.data_file, cls.output_file):
+            if os.path.exists(f):
+                os.remove(f)
+
+    def test_storage_policy(self):  # check the filters and chunk shapes per node type
+        # The default policy has the former fixed filters of all nodes
+        policy = storage.StoragePolicy()
+        for node_type in storage.NODE_TYPES:
+            self.assertEqual(policy.get_filters(node_type), tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            self.assertIsNone(policy.get_chunkshape(node_type))
+
+        policy = storage.StoragePolicy(preset='archive', presets={'tracklets': 'scratch', 'tracks': {'complib': 'zlib', 'complevel': 1}}, chunkshapes={'tracklets': (10000, )})
+        self.assertEqual(policy.get_filters('tracklets'), tb.Filters(complib='blosc:lz4', complevel=1, shuffle=True, fletcher32=False))
+        self.assertEqual(policy.get_filters('tracks'), tb.Filters(complib='zlib', complevel=1, fletcher32=False))
+        self.assertEqual(policy.get_filters('hits'), tb.Filters(complib='blosc:zstd', complevel=9, shuffle=True, fletcher32=False))
+        self.assertEqual(policy.get_chunkshape('tracklets'), (10000, ))
+        self.assertIsNone(policy.get_chunkshape('tracks'))
+
+        with self.assertRaises(ValueError):
+            storage.StoragePolicy(preset='unknown')
+        with self.assertRaises(ValueError):
+            storage.StoragePolicy(presets={'unknown': 'scratch'})
+
+    def test_created_tables(self):  # check that created tables use the active storage policy
+        storage.set_storage_policy(storage.StoragePolicy(presets={'hits': 'scratch'}, chunkshapes={'hits': (5000, )}))
+        try:
+            data_selection.combine_hit_files([self.data_file] * 2, self.output_file, chunk_size=9999)
+        finally:
+            storage.set_storage_policy(None)
+        with tb.open_file(self.output_file) as in_file:
+            self.assertEqual(in_file.root.Hits.filters, tb.Filters(complib='blosc:lz4', complevel=1, shuffle=True, fletcher32=False))
+            self.assertEqual(in_file.root.Hits.chunkshape, (5000, ))
+            self.assertEqual(in_file.root.Hits.nrows, 200000)
+
+    def test_benchmark_presets(self):  # check the benchmark results of all presets
+        results = storage.benchmark_presets(self.data_file, node_name='Hits', chunk_size=9999)
+        self.assertListEqual([result['preset'] for result in results], sorted(storage.PRESETS))
+        for result in results:
+            self.assertGreater(result['write_speed'], 0)
+            self.assertGreater(result['read_speed'], 0)
+        ratios = dict((result['preset'], result['compression_ratio']) for result in results)
+        self.assertLess(ratios['uncompressed'], ratios['default'])
+        self.assertLess(ratios['default'], ratios['archive'])
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestStorage)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -4,6 +4,8 @@ import os
 import shutil
 import unittest
 
+import numpy as np
+
 from testbeam_analysis import track_analysis
 from testbeam_analysis.tools import analysis_utils, test_tools
 
@@ -143,6 +145,43 @@ class TestTrackAnalysis(unittest.TestCase):
                                                                                     output=os.path.join(testing_path, 'fixtures/track_analysis/Tracks_merged_result.h5')), os.path.join(self.output_folder, 'Tracks_merged.h5'), exact=False)
         self.assertTrue(data_equal, msg=error_msg)
 
+    def test_line_fit(self):  # Check the line fit of many tracks at once with missing hits
+        z = np.array([0., 10000., 20000., 30000.])
+        offsets = np.array([[100., -50., 0.], [0., 0., 0.], [-3000., 20., 0.]])
+        slopes = np.array([[0.001, 0.002, 1.], [0., 0., 1.], [-0.01, 0., 1.]])
+        track_hits = offsets[:, np.newaxis, :] + slopes[:, np.newaxis, :] * z[np.newaxis, :, np.newaxis]
+        track_hits[1, 1:] = np.nan  # Only one hit, cannot be fitted
+        track_hits[2, 2] = np.nan  # Missing hit, is omitted in fit
+        offset, slope, chi2 = track_analysis._fit_tracks_loop(track_hits)
+        for index in (0, 2):
+            slope[index] *= np.sign(slope[index, 2])  # Direction of fitted line not defined
+            self.assertTrue(np.allclose(slope[index], slopes[index] / np.sqrt(np.sum(np.square(slopes[index])))))
+            self.assertTrue(np.allclose(offset[index], np.nanmean(track_hits[index], axis=0)))
+            self.assertEqual(chi2[index], 0)
+        self.assertTrue(np.all(np.isnan(offset[1])) and np.all(np.isnan(slope[1])) and np.isnan(chi2[1]))
+
+    def test_track_finding_grid(self):  # Check that the grid search finds the same tracks if the tracks are well separated
+        np.random.seed(0)
+        n_events, n_duts = 100, 4
+        track_x, track_y = np.random.uniform(0, 10000, (n_events, 10)), np.random.uniform(0, 10000, (n_events, 10))
+        x = np.repeat(track_x.reshape(-1, 1), n_duts, axis=1) + np.random.normal(0, 3, (n_events * 10, n_duts))
+        y = np.repeat(track_y.reshape(-1, 1), n_duts, axis=1) + np.random.normal(0, 3, (n_events * 10, n_duts))
+        x[:, 1:][np.random.random((n_events * 10, n_duts - 1)) < 0.1] = np.nan  # Missing hits, the first DUT is the reference
+        for event in range(n_events):  # Unsorted hits in each DUT
+            for dut_index in range(n_duts):
+                order = np.random.permutation(10)
+                x[event * 10:(event + 1) * 10, dut_index] = x[event * 10:(event + 1) * 10, dut_index][order]
+                y[event * 10:(event + 1) * 10, dut_index] = y[event * 10:(event + 1) * 10, dut_index][order]
+        y[np.isnan(x)] = np.nan
+        results = []
+        for find_tracks_loop in (track_analysis._find_tracks_loop, track_analysis._find_tracks_loop_grid):
+            data = [x.copy(), y.copy()] + [np.zeros_like(x) for _ in range(5)] + [np.ones(x.shape, dtype=np.uint32)]  # x, y, z, errors, charge, n_hits
+            track_quality, n_tracks = np.zeros(x.shape[0], dtype=np.uint32), np.zeros(x.shape[0], dtype=np.int8)
+            find_tracks_loop(np.repeat(np.arange(n_events), 10), *(data + [track_quality, n_tracks, np.full(n_duts, 10.), np.full(n_duts, 10.), np.full(n_duts, 20.)]))
+            results.append((data[0], data[1], track_quality, n_tracks))
+        for old, new in zip(*results):
+            np.testing.assert_array_equal(old, new)
+
 
 if __name__ == '__main__':
     import logging
@@ -230,6 +230,51 @@ def map_cluster(events, cluster):
     return mapped_cluster
 
 
+def get_position_error_lookup(cluster_size_hist):
+    """
+    Calculates the position error of small clusters (up to 2 pixels in column / row direction)
+    from the cluster size distribution. Charge sharing enhances the resolution of these clusters,
+    the effective pitch is given by the square root of the probability of the cluster size.
+
+    Parameters
+    ----------
+    cluster_size_hist : array like
+        Histogram with cluster size distribution.
+
+    Returns
+    -------
+    np.ndarray with the position errors in units of the pixel pitch indexed by the cluster dimension (1 or 2).
+
+    """
+    hight = np.zeros(shape=(max(3, cluster_size_hist.shape[0]),), dtype=cluster_size_hist.dtype)
+    hight[:cluster_size_hist.shape[0]] = cluster_size_hist
+    position_error_lookup = np.zeros(shape=(3,), dtype=np.float64)
+    for cluster_size in (1, 2):
+        position_error_lookup[cluster_size] = np.sqrt(hight[cluster_size].astype(np.float) / hight.sum()) / np.sqrt(12)
+    return position_error_lookup
+
+
+def apply_position_error_lookup(err_cols, err_rows, position_error_lookup):
+    """
+    Sets the position error of small clusters (1x1, 1x2, 2x1, 2x2) from the lookup table in place.
+    The cluster dimensions are given in err_cols / err_rows. Position errors that are already set are not changed.
+
+    Parameters
+    ----------
+    err_cols : np.array
+        Cluster dimension in column direction. Is overwritten with the column position error.
+    err_rows : np.array
+        Cluster dimension in row direction. Is overwritten with the row position error.
+    position_error_lookup : array like
+        Position errors indexed by the cluster dimension, see get_position_error_lookup().
+
+    """
+    for css in [(1, 1), (1, 2), (2, 1), (2, 2)]:
+        sel = np.logical_and(err_cols == css[0], err_rows == css[1])
+        err_cols[sel] = position_error_lookup[css[0]]
+        err_rows[sel] = position_error_lookup[css[1]]
+
+
 def get_events_in_both_arrays(events_one, events_two):
     """
     Calculates the events that exist in both arrays.
@@ -382,6 +427,45 @@ def get_data_in_event_range(array, event_start=None, event_stop=None, assume_sor
         return array[ne.evaluate('event_number >= event_start & event_number < event_stop')]
 
 
+def searchsorted_event_number(table, event_number, side='left', start_index=None, stop_index=None, block_size=10000):
+    '''Finds the row index of an event number in a table with a sorted event_number column.
+    Behaves like numpy.searchsorted() on the event_number column, but a binary search on the table is done.
+    Only O(log n) single rows and one block of rows are read from the table.
+
+    Parameters
+    ----------
+    table : pytables.table
+        The data.
+    event_number : int
+        Event number to search for.
+    side : string
+        If 'left', the index of the first row with event number >= event_number is returned.
+        If 'right', the index of the first row with event number > event_number is returned.
+    start_index : int
+        Start index of the search range. If None, no limit is set.
+    stop_index : int
+        Stop index of the search range. If None, no limit is set.
+    block_size : int
+        If the search range is smaller than the block size, the event numbers are read at once.
+
+    Returns
+    -------
+    Row index. The stop index of the search range if all event numbers are smaller (side='left') or smaller/equal (side='right').
+    '''
+    lo = 0 if start_index is None else start_index
+    hi = table.nrows if stop_index is None else min(stop_index, table.nrows)
+    while hi - lo > block_size:
+        mid = (lo + hi) // 2
+        mid_event_number = table.read(start=mid, stop=mid + 1)['event_number'][0]
+        if mid_event_number < event_number or (side == 'right' and mid_event_number == event_number):
+            lo = mid + 1
+        else:
+            hi = mid
+    if hi <= lo:
+        return lo
+    return lo + np.searchsorted(table.read(start=lo, stop=hi)['event_number'], event_number, side=side)
+
+
 def data_aligned_at_events(table, start_event_number=None, stop_event_number=None, start_index=None, stop_index=None, chunk_size=10000000, try_speedup=False, first_event_aligned=True, fail_on_missing_events=True):
     '''Takes the table with a event_number column and returns chunks with the size up to chunk_size. The chunks are chosen in a way that the events are not splitted.
     Additional parameters can be set to increase the readout speed. Events between a certain range can be selected.
@@ -464,6 +548,9 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
         # search for begin
         current_start_index = start_index
         if start_event_number is not None:
+            # skip the chunks before the chunk with the start event number, binary search instead of reading the chunks
+            skip_chunks = (searchsorted_event_number(table, start_event_number, side='left', start_index=start_index, stop_index=stop_index) - start_index) // chunk_size
+            current_start_index = current_start_index + skip_chunks * chunk_size
             while current_start_index < stop_index:
                 current_stop_index = min(current_start_index + chunk_size, stop_index)
                 array_chunk = table.read(start=current_start_index, stop=current_stop_index)  # stop index is exclusive, so add 1
@@ -545,6 +632,145 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
             current_start_index = current_start_index + nrows + chunk_start_index  # events fully read, increase start index and continue reading
 
 
+def data_aligned_at_events_in_tables(tables, chunk_size=10000000):
+    '''Reads several tables with a sorted event_number column in lockstep. Every table is read exactly once from the beginning to the end.
+    The first table is the reference table and is read in chunks that are aligned at events (see data_aligned_at_events()).
+    For each reference chunk the other tables return all rows with event numbers up to and including the last event number of the reference chunk,
+    that have not been returned yet. Rows of the other tables with event numbers larger than the last event number of the reference table are not returned.
+    Each other table keeps a read buffer of up to chunk_size rows.
+
+    Parameters
+    ----------
+    tables : list of pytables.table
+        The data. The first table is the reference table.
+    chunk_size : int
+        Number of rows that are read at once from each table.
+
+    Returns
+    -------
+    Iterator of tuples
+        List of the data chunks (one per table) and the stop index of the reference chunk in the reference table.
+    '''
+    buffers = [np.empty(shape=(0,), dtype=table.dtype) for table in tables[1:]]
+    read_indices = [0] * (len(tables) - 1)
+
+    for reference_chunk, reference_index in data_aligned_at_events(tables[0], chunk_size=chunk_size):
+        stop_event_number = reference_chunk['event_number'][-1] + 1
+        chunks = [reference_chunk]
+        for i, table in enumerate(tables[1:]):
+            chunk_parts = []
+            while True:
+                if buffers[i].shape[0] == 0 and read_indices[i] < table.nrows:  # refill the read buffer
+                    buffers[i] = table.read(start=read_indices[i], stop=read_indices[i] + chunk_size)
+                    read_indices[i] += buffers[i].shape[0]
+                if buffers[i].shape[0] == 0:  # table fully read
+                    break
+                n_rows = np.searchsorted(buffers[i]['event_number'], stop_event_number, side='left')
+                chunk_parts.append(buffers[i][:n_rows])
+                buffers[i] = buffers[i][n_rows:]
+                if buffers[i].shape[0] != 0:  # remaining data belongs to following chunks
+                    break
+            chunks.append(np.concatenate(chunk_parts) if chunk_parts else buffers[i][:0])
+        yield chunks, reference_index
+
+
+def get_merged_description(n_duts, dut_arrays=False, reduced_precision=False):
+    '''Returns the description of the merged hit tables (MergedCluster, Tracklets and TrackCandidates).
+
+    Parameters
+    ----------
+    n_duts : int
+        Number of DUTs.
+    dut_arrays : bool
+        If False, one column per DUT and quantity (e.g. x_dut_0, ..., x_dut_n).
+        If True, one column with shape (n_duts,) per quantity (e.g. x). Reading the hits of all DUTs
+        does not need to restack the columns then.
+    reduced_precision : bool
+        If True, positions, position errors and charges are stored as float32 instead of float64.
+        This is a precision of better than 0.01 um for positions up to 10 cm and halves the table size.
+
+    Returns
+    -------
+    list of tuples
+        The description. Can be used as numpy dtype.
+    '''
+    def dut_columns(field, dtype):
+        if dut_arrays:
+            return [(field, dtype, (n_duts,))]
+        return [('%s_dut_%d' % (field, index), dtype) for index in range(n_duts)]
+
+    float_type = np.float32 if reduced_precision else np.float
+    description = [('event_number', np.int64)]
+    for field, dtype in (('x', float_type), ('y', float_type), ('z', float_type), ('charge', float_type), ('n_hits', np.int8)):
+        description.extend(dut_columns(field, dtype))
+    description.extend([('track_quality', np.uint32), ('n_tracks', np.int8)])
+    for field in ('xerr', 'yerr', 'zerr'):
+        description.extend(dut_columns(field, float_type))
+    return description
+
+
+def has_dut_arrays(data):
+    '''Returns True if the hits of all DUTs are stored in one column per quantity (see get_merged_description()).
+    '''
+    return 'x' in data.dtype.names and data.dtype['x'].shape != ()
+
+
+def get_dut_data(data, field, dut_index=None):
+    '''Returns the data of one quantity (e.g. x, xerr, charge) of merged hit data for both table layouts (see get_merged_description()).
+
+    Parameters
+    ----------
+    data : numpy structured array
+        The merged hit data.
+    field : string
+        The quantity without DUT suffix, e.g. x.
+    dut_index : int
+        If None, the data of all DUTs is returned. Otherwise the data of the given DUT.
+
+    Returns
+    -------
+    numpy array
+        Array with shape (n_rows, n_duts) or (n_rows,) if dut_index is given. For data with DUT arrays
+        this is a view of the data, otherwise the data of all DUTs is a new array.
+    '''
+    if has_dut_arrays(data):
+        if dut_index is None:
+            return data[field]
+        return data[field][:, dut_index]
+    if dut_index is None:
+        n_duts = 0
+        while '%s_dut_%d' % (field, n_duts) in data.dtype.names:
+            n_duts += 1
+        return np.column_stack([data['%s_dut_%d' % (field, index)] for index in range(n_duts)])
+    return data['%s_dut_%d' % (field, dut_index)]
+
+
+def set_dut_data(data, field, values, dut_index=None):
+    '''Sets the data of one quantity (e.g. x, xerr, charge) of merged hit data for both table layouts (see get_merged_description()).
+
+    Parameters
+    ----------
+    data : numpy structured array
+        The merged hit data.
+    field : string
+        The quantity without DUT suffix, e.g. x.
+    values : numpy array
+        Array with shape (n_rows, n_duts) or (n_rows,) if dut_index is given.
+    dut_index : int
+        If None, the data of all DUTs is set. Otherwise the data of the given DUT.
+    '''
+    if has_dut_arrays(data):
+        if dut_index is None:
+            data[field] = values
+        else:
+            data[field][:, dut_index] = values
+    elif dut_index is None:
+        for index in range(values.shape[1]):
+            data['%s_dut_%d' % (field, index)] = values[:, index]
+    else:
+        data['%s_dut_%d' % (field, dut_index)] = values
+
+
 def fix_event_alignment(event_numbers, ref_column, column, ref_row, row, ref_charge, charge, error=3., n_bad_events=5, n_good_events=3, correlation_search_range=2000, good_events_search_range=10):
     correlated = np.ascontiguousarray(np.ones(shape=event_numbers.shape, dtype=np.uint8))  # array to signal correlation to be ables to omit not correlated events in the analysis
     event_numbers = np.ascontiguousarray(event_numbers)
@@ -745,6 +971,44 @@ def get_mean_efficiency(array_pass, array_total, interval=0.68):
     return eff, lim_e_m - eff, lim_e_p - eff
 
 
+def get_efficiency_interval(array_pass, array_total, interval=0.68, method='clopper_pearson'):
+    ''' Calculates the confidence interval limits of the efficiency for each entry of the arrays (e.g. efficiency maps).
+        The limits are given by quantiles of the beta distribution and are calculated for all entries at once.
+
+        Parameters
+        ----------
+        array_pass, array_total : numpy array
+            Number of passing events and total number of events.
+        interval : float
+            Confidence interval. The limits are the (1 - interval) / 2 and (1 + interval) / 2 quantiles.
+        method : string
+            'clopper_pearson': Clopper-Pearson (exact frequentist) interval.
+            'bayesian': Central interval of the efficiency probability density function with uniform prior,
+            see http://lss.fnal.gov/archive/test-tm/2000/fermilab-tm-2286-cd.pdf
+
+        Returns
+        -------
+        Tuple with: Lower and upper efficiency limits (NaN if total number of events is zero)
+    '''
+    k = np.asarray(array_pass, dtype=np.float)
+    N = np.asarray(array_total, dtype=np.float)
+    alpha = 1.0 - interval
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'clopper_pearson':
+            lower = np.where(k > 0, stats.beta.ppf(alpha / 2.0, k, N - k + 1), 0.0)
+            upper = np.where(k < N, stats.beta.ppf(1.0 - alpha / 2.0, k + 1, N - k), 1.0)
+        elif method == 'bayesian':
+            lower = stats.beta.ppf(alpha / 2.0, k + 1, N - k + 1)
+            upper = stats.beta.ppf(1.0 - alpha / 2.0, k + 1, N - k + 1)
+        else:
+            raise ValueError('Unknown method %s' % method)
+
+    lower = np.where(N > 0, lower, np.nan)
+    upper = np.where(N > 0, upper, np.nan)
+    return lower, upper
+
+
 def fwhm(x, y):
     """
     Determine full-with-half-maximum of a peaked set of points, x and y.
@@ -931,35 +1195,70 @@ def fit_residuals_vs_position(hist, xedges, yedges, xlabel="", ylabel="", title=
     return fit, cov
 
 
+_hough_tables = {}  # Cache of the theta bin centers and the sine / cosine tables for each theta resolution
+
+
+def _get_hough_tables(theta_res):
+    ''' Returns the theta bin centers from -90 to 90 degree and the cosine / sine of theta. The tables are cached and read-only.'''
+    if theta_res not in _hough_tables:
+        thetas = np.linspace(-90.0, 0.0, int(np.ceil(90.0 / theta_res)) + 1)
+        thetas = np.concatenate((thetas, -thetas[len(thetas) - 2::-1]))
+        thetas = np.deg2rad(thetas)
+        tables = (thetas, np.cos(thetas), np.sin(thetas))
+        for table in tables:
+            table.setflags(write=False)
+        _hough_tables[theta_res] = tables
+    return _hough_tables[theta_res]
+
+
+@njit
+def _fill_hough_accumulator(accumulator, x_idxs, y_idxs, rhos, rho_res, cos_t, sin_t):
+    ''' Fills the Hough accumulator. The rho bin is calculated from the bin width and corrected to the nearest bin center
+    (lower bin center if equally close), giving the same result as searching the closest rho value.'''
+    n_rhos = rhos.shape[0]
+    for i in range(x_idxs.shape[0]):
+        x = x_idxs[i]
+        y = y_idxs[i]
+        for theta_idx in range(cos_t.shape[0]):
+            rho_val = x * cos_t[theta_idx] + y * sin_t[theta_idx]
+            rho_idx = int(np.floor((rho_val - rhos[0]) / rho_res + 0.5))
+            rho_idx = min(max(rho_idx, 0), n_rhos - 1)
+            if rho_idx > 0 and abs(rhos[rho_idx - 1] - rho_val) <= abs(rhos[rho_idx] - rho_val):
+                rho_idx -= 1
+            elif rho_idx < n_rhos - 1 and abs(rhos[rho_idx + 1] - rho_val) < abs(rhos[rho_idx] - rho_val):
+                rho_idx += 1
+            accumulator[rho_idx, theta_idx] += 1
+
+
 def hough_transform(img, theta_res=1.0, rho_res=1.0, return_edges=False):
-    thetas = np.linspace(-90.0, 0.0, np.ceil(90.0 / theta_res) + 1)
-    thetas = np.concatenate((thetas, -thetas[len(thetas) - 2::-1]))
-    thetas = np.deg2rad(thetas)
+    '''Calculates the Hough transform (straight lines) of the non-zero entries of a 2D array.
+
+    Parameters
+    ----------
+    img : 2D array
+        The data. All non-zero entries are transformed.
+    theta_res : float
+        Bin width of the angle theta in degree. Theta ranges from -90 to 90 degree.
+    rho_res : float
+        Bin width of the distance rho in units of array indices.
+    return_edges : bool
+        If True, also return the bin edges of theta and rho.
+
+    Returns
+    -------
+    Accumulator histogram with shape (n_rhos, n_thetas), bin centers of theta and rho and optionally the bin edges of theta and rho.
+    '''
+    thetas, cos_t, sin_t = _get_hough_tables(theta_res)
+    thetas = thetas.copy()  # The returned bin centers can be changed by the caller without changing the cache
     width, height = img.shape
     diag_len = np.sqrt((width - 1)**2 + (height - 1)**2)
     q = np.ceil(diag_len / rho_res)
-    nrhos = 2 * q + 1
+    nrhos = int(2 * q + 1)
     rhos = np.linspace(-q * rho_res, q * rho_res, nrhos)
 
-    cos_t = np.cos(thetas)
-    sin_t = np.sin(thetas)
-
     accumulator = np.zeros((rhos.size, thetas.size), dtype=np.int32)
     y_idxs, x_idxs = np.nonzero(img)
-
-    @njit
-    def loop(accumulator, x_idxs, y_idxs, thetas, rhos, sin_t, cos_t):
-
-        for i in range(len(x_idxs)):
-            x = x_idxs[i]
-            y = y_idxs[i]
-
-            for theta_idx in range(thetas.size):
-                #rho_idx = np.around(x * cos_t[theta_idx] + y * sin_t[theta_idx]) + diag_len
-                rhoVal = x * cos_t[theta_idx] + y * sin_t[theta_idx]
-                rho_idx = (np.abs(rhos - rhoVal)).argmin()
-                accumulator[rho_idx, theta_idx] += 1
-    loop(accumulator, x_idxs, y_idxs, thetas, rhos, sin_t, cos_t)
+    _fill_hough_accumulator(accumulator, x_idxs, y_idxs, rhos, float(rho_res), cos_t, sin_t)
 
     if return_edges:
         thetas_diff = thetas[1] - thetas[0]
@@ -973,6 +1272,17 @@ def hough_transform(img, theta_res=1.0, rho_res=1.0, return_edges=False):
         return accumulator, thetas, rhos  # return histogram and bin centers
 
 
+def hough_transforms(imgs, theta_res=1.0, rho_res=1.0, return_edges=False):
+    '''Calculates the Hough transforms of several 2D arrays (e.g. the correlation histograms of all DUTs)
+    with the same binning of theta. See hough_transform().
+
+    Returns
+    -------
+    List with the results of hough_transform() for each array.
+    '''
+    return [hough_transform(img, theta_res=theta_res, rho_res=rho_res, return_edges=return_edges) for img in imgs]
+
+
 def get_data(path, output=None, fail_on_overwrite=False):
     ''' Downloads data (eg. for examples, fixtures).
 
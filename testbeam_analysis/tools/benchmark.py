@@ -0,0 +1,261 @@
+''' Benchmark of the analysis stages on simulated data.
+
+A telescope with a configurable number of DUTs, pixel matrix and tracks per event is simulated and
+each stage of the analysis chain is run in its own process. The wall time, the throughput and the
+peak memory of each stage are stored in a JSON file, thus benchmarks of different versions and
+machines can be compared. Run from the command line with e.g.:
+
+    python -m testbeam_analysis.tools.benchmark benchmark --n_duts 6 --n_events 100000
+'''
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import traceback
+from collections import OrderedDict
+from multiprocessing import Process, Queue, cpu_count
+try:
+    from queue import Empty
+except ImportError:  # Python 2
+    from Queue import Empty
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import numpy as np
+import tables as tb
+import numba
+
+import testbeam_analysis
+from testbeam_analysis import hit_analysis
+from testbeam_analysis import dut_alignment
+from testbeam_analysis import track_analysis
+from testbeam_analysis import result_analysis
+from testbeam_analysis.tools import simulate_data
+
+# All stages in the order of their dependencies
+STAGES = ('generate_pixel_mask', 'cluster_hits', 'correlate_cluster', 'prealignment', 'merge_cluster_data', 'apply_alignment',
+          'find_tracks', 'fit_tracks', 'fit_tracks_kalman', 'alignment', 'calculate_residuals', 'calculate_efficiency', 'calculate_purity')
+
+
+def run_benchmark(output_folder, n_duts=6, n_pixels=(80, 336), pixel_size=(250, 50), tracks_per_event=1, n_events=100000, stages=None, random_seed=0, output_file=None):
+    '''Simulates a telescope and measures the wall time, the throughput and the peak memory of the analysis stages.
+
+    Every stage runs in its own process, thus the peak memory of each stage is measured separately
+    and the wall time includes the just in time compilation of the numba functions of the stage.
+    The simulated data only depends on the settings and the random seed, thus benchmarks with the same settings are comparable.
+
+    Parameters
+    ----------
+    output_folder : string
+        Folder for the simulated data and the output files of the stages.
+    n_duts : int
+        Number of DUTs of the telescope.
+    n_pixels : tuple
+        Number of pixels (column/row) of each DUT.
+    pixel_size : tuple
+        Pixel dimension (column/row) of each DUT in um.
+    tracks_per_event : float
+        Average number of tracks per event.
+    n_events : int
+        Number of simulated events.
+    stages : iterable of strings
+        The stages to benchmark. If None, all STAGES are benchmarked. The output files of
+        stages that are not run have to exist from an earlier call with the same settings.
+    random_seed : int
+        Seed of the simulation.
+    output_file : string
+        Filename of the JSON output file. If None, benchmark.json in the output folder is used.
+
+    Returns
+    -------
+    dict
+        The settings, the environment and the results. The results have for each stage the wall time in seconds,
+        the number of input rows, the rows and events per second and the peak resident memory in MB of the stage
+        process and of its largest worker process. The memory is None if it cannot be measured on this platform.
+    '''
+    logging.info('=== Benchmark of the analysis stages ===')
+
+    if stages is None:
+        stages = STAGES
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError('Stage "%s" not recognized!' % stage)
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    if output_file is None:
+        output_file = os.path.join(output_folder, 'benchmark.json')
+
+    sim = simulate_data.SimulateData(random_seed=random_seed)
+    sim.n_duts = n_duts
+    sim.set_std_settings()
+    sim.dut_n_pixel = [tuple(n_pixels)] * n_duts
+    sim.dut_pixel_size = [tuple(pixel_size)] * n_duts
+    # Beam in the center of the sensors and illuminating the whole pixel matrix
+    sim.offsets = [(-n_pixels[0] * pixel_size[0] / 2., -n_pixels[1] * pixel_size[1] / 2.)] * n_duts
+    sim.beam_position_sigma = (n_pixels[0] * pixel_size[0] / 4., n_pixels[1] * pixel_size[1] / 4.)
+    sim.tracks_per_event = tracks_per_event
+
+    start_time = time.time()
+    sim.create_data_and_store(os.path.join(output_folder, 'simulated_data'), n_events=n_events)
+    logging.info('Simulated %d events in %.1f s', n_events, time.time() - start_time)
+
+    settings = OrderedDict([('n_duts', n_duts), ('n_pixels', list(n_pixels)), ('pixel_size', list(pixel_size)),
+                            ('tracks_per_event', tracks_per_event), ('n_events', n_events), ('random_seed', random_seed)])
+    benchmark = OrderedDict([('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+                             ('settings', settings),
+                             ('environment', _get_environment()),
+                             ('results', [])])
+
+    for stage, (calls, row_files) in _create_stage_calls(sim, output_folder).items():
+        if stage not in stages:
+            continue
+        if stage == 'alignment':  # The alignment changes its alignment file, thus it works on a copy of the prealignment
+            shutil.copyfile(os.path.join(output_folder, 'Alignment.h5'), os.path.join(output_folder, 'Alignment_aligned.h5'))
+        logging.info('Benchmark %s', stage)
+        n_rows = _get_n_rows(row_files)
+        wall_time, peak_rss, peak_rss_workers = _benchmark_stage(stage, calls)
+        benchmark['results'].append(OrderedDict([('stage', stage),
+                                                 ('wall_time', wall_time),
+                                                 ('input_rows', n_rows),
+                                                 ('rows_per_second', n_rows / wall_time),
+                                                 ('events_per_second', n_events / wall_time),
+                                                 ('peak_rss', peak_rss),
+                                                 ('peak_rss_workers', peak_rss_workers)]))
+
+    for result in benchmark['results']:
+        logging.info('%-22s %8.1f s %12.0f rows/s %10s MB', result['stage'], result['wall_time'], result['rows_per_second'], 'n/a' if result['peak_rss'] is None else '%.0f' % max(result['peak_rss'], result['peak_rss_workers']))
+
+    with open(output_file, 'w') as out_file:
+        json.dump(benchmark, out_file, indent=2)
+
+    return benchmark
+
+
+def _create_stage_calls(sim, output_folder):
+    ''' Returns the function calls of each stage and the files with the input rows of the stage. '''
+    n_duts = sim.n_duts
+    n_pixels, pixel_size = sim.dut_n_pixel, sim.dut_pixel_size
+    sensor_size = [(n_pixels[dut_index][0] * pixel_size[dut_index][0], n_pixels[dut_index][1] * pixel_size[dut_index][1]) for dut_index in range(n_duts)]
+
+    hit_files = [os.path.join(output_folder, 'simulated_data_DUT%d.h5' % dut_index) for dut_index in range(n_duts)]
+    mask_files = [os.path.splitext(hit_file)[0] + '_noisy_pixel_mask.h5' for hit_file in hit_files]
+    cluster_files = [os.path.splitext(hit_file)[0] + '_clustered.h5' for hit_file in hit_files]
+    correlation_file = os.path.join(output_folder, 'Correlation.h5')
+    alignment_file = os.path.join(output_folder, 'Alignment.h5')
+    merged_file = os.path.join(output_folder, 'Merged.h5')
+    tracklets_file = os.path.join(output_folder, 'Tracklets_prealigned.h5')
+    track_candidates_file = os.path.join(output_folder, 'TrackCandidates_prealigned.h5')
+    tracks_file = os.path.join(output_folder, 'Tracks_prealigned.h5')
+
+    stages = OrderedDict()
+    stages['generate_pixel_mask'] = ([(hit_analysis.generate_pixel_mask, dict(input_hits_file=hit_files[dut_index], n_pixel=n_pixels[dut_index], pixel_size=pixel_size[dut_index], output_mask_file=mask_files[dut_index], plot=False)) for dut_index in range(n_duts)],
+                                     hit_files)
+    stages['cluster_hits'] = ([(hit_analysis.cluster_hits, dict(input_hits_file=hit_files[dut_index], output_cluster_file=cluster_files[dut_index], input_noisy_pixel_mask_file=mask_files[dut_index], plot=False)) for dut_index in range(n_duts)],
+                              hit_files)
+    stages['correlate_cluster'] = ([(dut_alignment.correlate_cluster, dict(input_cluster_files=cluster_files, output_correlation_file=correlation_file, n_pixels=n_pixels, pixel_size=pixel_size, plot=False))],
+                                   cluster_files)
+    stages['prealignment'] = ([(dut_alignment.prealignment, dict(input_correlation_file=correlation_file, output_alignment_file=alignment_file, z_positions=sim.z_positions, pixel_size=pixel_size, non_interactive=True, plot=False))],
+                              cluster_files)  # The correlation histograms are filled from the cluster
+    stages['merge_cluster_data'] = ([(dut_alignment.merge_cluster_data, dict(input_cluster_files=cluster_files, output_merged_file=merged_file, n_pixels=n_pixels, pixel_size=pixel_size))],
+                                    cluster_files)
+    stages['apply_alignment'] = ([(dut_alignment.apply_alignment, dict(input_hit_file=merged_file, input_alignment_file=alignment_file, output_hit_file=tracklets_file, force_prealignment=True))],
+                                 [merged_file])
+    stages['find_tracks'] = ([(track_analysis.find_tracks, dict(input_tracklets_file=tracklets_file, input_alignment_file=alignment_file, output_track_candidates_file=track_candidates_file))],
+                             [tracklets_file])
+    stages['fit_tracks'] = ([(track_analysis.fit_tracks, dict(input_track_candidates_file=track_candidates_file, input_alignment_file=alignment_file, output_tracks_file=tracks_file, force_prealignment=True))],
+                            [track_candidates_file])
+    stages['fit_tracks_kalman'] = ([(track_analysis.fit_tracks, dict(input_track_candidates_file=track_candidates_file, input_alignment_file=alignment_file, output_tracks_file=os.path.join(output_folder, 'Tracks_kalman.h5'), pixel_size=pixel_size, n_pixels=n_pixels, beam_energy=sim.beam_momentum, material_budget=sim.dut_material_budget, force_prealignment=True, method='Kalman'))],
+                                   [track_candidates_file])
+    stages['alignment'] = ([(dut_alignment.alignment, dict(input_track_candidates_file=track_candidates_file, input_alignment_file=os.path.join(output_folder, 'Alignment_aligned.h5'), n_pixels=n_pixels, pixel_size=pixel_size))],
+                           [track_candidates_file])
+    stages['calculate_residuals'] = ([(result_analysis.calculate_residuals, dict(input_tracks_file=tracks_file, input_alignment_file=alignment_file, output_residuals_file=os.path.join(output_folder, 'Residuals_prealigned.h5'), n_pixels=n_pixels, pixel_size=pixel_size, force_prealignment=True, plot=False))],
+                                     [tracks_file])
+    stages['calculate_efficiency'] = ([(result_analysis.calculate_efficiency, dict(input_tracks_file=tracks_file, input_alignment_file=alignment_file, output_efficiency_file=os.path.join(output_folder, 'Efficiency.h5'), bin_size=pixel_size, sensor_size=sensor_size, pixel_size=pixel_size, n_pixels=n_pixels, cut_distance=500, force_prealignment=True, plot=False))],
+                                      [tracks_file])
+    stages['calculate_purity'] = ([(result_analysis.calculate_purity, dict(input_tracks_file=tracks_file, input_alignment_file=alignment_file, output_purity_file=os.path.join(output_folder, 'Purity.h5'), bin_size=pixel_size, sensor_size=sensor_size, pixel_size=pixel_size, n_pixels=n_pixels, minimum_hit_density=1, cut_distance=500, force_prealignment=True, plot=False))],
+                                  [tracks_file])
+    return stages
+
+
+def _benchmark_stage(stage, calls):
+    ''' Runs one stage in its own process and returns the wall time and the peak memory of the stage process and its workers. '''
+    result_queue = Queue()
+    process = Process(target=_run_stage, args=(calls, result_queue))
+    process.start()
+    while True:
+        try:
+            wall_time, peak_rss, peak_rss_workers, error = result_queue.get(timeout=1.)
+            break
+        except Empty:  # Check for a process that died without sending a result, e.g. killed when out of memory
+            if not process.is_alive() and result_queue.empty():
+                raise RuntimeError('Benchmark of %s failed, the process died with exit code %s' % (stage, process.exitcode))
+    process.join()
+    if error:
+        raise RuntimeError('Benchmark of %s failed:\n%s' % (stage, error))
+    return wall_time, peak_rss, peak_rss_workers
+
+
+def _run_stage(calls, result_queue):
+    ''' Runs the calls of one stage and sends the wall time, the peak memory and the traceback of an exception to the result queue. '''
+    start_time = time.time()
+    try:
+        for func, kwargs in calls:
+            func(**kwargs)
+    except Exception:
+        result_queue.put((time.time() - start_time, None, None, traceback.format_exc()))
+    else:
+        result_queue.put((time.time() - start_time, _get_peak_rss(workers=False), _get_peak_rss(workers=True), None))
+
+
+def _get_peak_rss(workers=False):
+    ''' Returns the peak resident memory in MB of this process or of its largest finished child process. None if not available (Windows). '''
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN if workers else resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1e6 if sys.platform == 'darwin' else max_rss / 1e3  # Bytes on Mac OS, kB on Linux
+
+
+def _get_n_rows(files):
+    ''' Returns the number of rows of all tables in the files. '''
+    n_rows = 0
+    for actual_file in files:
+        with tb.open_file(actual_file, mode='r') as in_file_h5:
+            for table in in_file_h5.walk_nodes(in_file_h5.root, classname='Table'):
+                n_rows += int(table.nrows)
+    return n_rows
+
+
+def _get_environment():
+    ''' Returns the versions and the machine the benchmark runs on. '''
+    return OrderedDict([('testbeam_analysis', testbeam_analysis.VERSION),
+                        ('python', platform.python_version()),
+                        ('numpy', np.__version__),
+                        ('numba', numba.__version__),
+                        ('tables', tb.__version__),
+                        ('platform', platform.platform()),
+                        ('processor', platform.processor()),
+                        ('cpu_count', cpu_count())])
+
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    parser = argparse.ArgumentParser(description='Benchmark of the analysis stages on simulated data')
+    parser.add_argument('output_folder', help='Folder for the simulated data, the output files and benchmark.json')
+    parser.add_argument('--n_duts', type=int, default=6)
+    parser.add_argument('--n_pixels', type=int, nargs=2, default=(80, 336))
+    parser.add_argument('--pixel_size', type=float, nargs=2, default=(250, 50))
+    parser.add_argument('--tracks_per_event', type=float, default=1)
+    parser.add_argument('--n_events', type=int, default=100000)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=None)
+    parser.add_argument('--random_seed', type=int, default=0)
+    parser.add_argument('--output_file', default=None, help='JSON output file, default is benchmark.json in the output folder')
+    args = parser.parse_args()
+    run_benchmark(**vars(args))
@@ -10,6 +10,7 @@ import numexpr as ne
 from numba import njit
 
 from testbeam_analysis.tools import analysis_utils
+from testbeam_analysis.tools import storage
 
 # Hit data dtype
 hit_dcr = np.dtype([('event_number', np.int64), ('frame', np.uint8),
@@ -40,9 +41,8 @@ def combine_hit_files(hit_files, combined_file, event_number_offsets=None,
         hits_out = out_file.create_table(out_file.root, name='Hits',
                                          description=hit_dcr,
                                          title='Selected FE-I4 hits',
-                                         filters=tb.Filters(complib='blosc',
-                                                            complevel=5,
-                                                            fletcher32=False))
+                                         filters=storage.get_filters('hits'),
+                                         chunkshape=storage.get_chunkshape('hits'))
         for index, hit_file in enumerate(hit_files):
             if event_number_offsets and event_number_offsets[index] is not None:
                 event_number_offset = event_number_offsets[index]
@@ -92,13 +92,13 @@ def reduce_hit_files(hit_files, fraction=10, chunk_size=1000000):
         with tb.open_file(hit_file, mode='r') as in_file:
             with tb.open_file(os.path.splitext(hit_file)[0] +
                               '_reduced.h5', mode="w") as out_file:
-                filters = tb.Filters(complib='blosc', complevel=5,
-                                     fletcher32=False)
+                filters = storage.get_filters('hits')
                 hits_out = out_file.create_table(out_file.root,
                                                  name='Hits',
                                                  description=hit_dcr,
                                                  title='Selected FE-I4 hits',
-                                                 filters=filters)
+                                                 filters=filters,
+                                                 chunkshape=storage.get_chunkshape('hits'))
                 for hits, _ in analysis_utils.data_aligned_at_events(
                         in_file.root.Hits, chunk_size=chunk_size):
                     hits_out.append(_delete_events(hits, fraction))
@@ -141,44 +141,79 @@ def select_hits(hit_file, max_hits=None, condition=None, track_quality=None,
                 hits_out = out_file.create_table(out_file.root, name=node.name,
                                                  description=node.dtype,
                                                  title=node.title,
-                                                 filters=tb.Filters(
-                                                     complib='blosc',
-                                                     complevel=5,
-                                                     fletcher32=False))
+                                                 filters=storage.get_filters('hits'),
+                                                 chunkshape=storage.get_chunkshape('hits'))
                 for hits, i in analysis_utils.data_aligned_at_events(node, chunk_size=chunk_size):
-                    n_hits = hits.shape[0]
-                    if condition:
-                        hits = _select_hits_with_condition(hits, condition)
-
-                    if track_quality:
-                        # If no mask is defined select all quality bits
-                        if not track_quality_mask:
-                            track_quality_mask = int(0xFFFFFFFF)
-                        sel = (hits['track_quality'] &
-                               track_quality_mask) == (track_quality)
-                        hits = hits[sel]
-
-                    if hits.shape[0] == 0:
-                        logging.warning('No hits selected')
-
-                    # Reduce the number of added hits of this chunk to not
-                    # exeed max_hits
-                    if max_hits:
-                        # Calculate number of hits to add for this chunk
-                        # Fraction of hits to add per chunk
-                        hit_fraction = max_hits / float(total_hits)
-                        sel = np.ceil(np.linspace(0,
-                                                  hits.shape[0],
-                                                  int(hit_fraction * n_hits),
-                                                  endpoint=False)).astype(np.int32)
-                        sel = sel[sel < hits.shape[0]]
-                        hits = hits[sel]
-
+                    hits = select_hits_in_chunk(hits=hits,
+                                                total_hits=total_hits,
+                                                max_hits=max_hits,
+                                                condition=condition,
+                                                track_quality=track_quality,
+                                                track_quality_mask=track_quality_mask)
                     hits_out.append(hits)
                     progress_bar.update(i)
                 progress_bar.finish()
 
 
+def select_hits_in_chunk(hits, total_hits=None, max_hits=None, condition=None,
+                         track_quality=None, track_quality_mask=None):
+    ''' Selects hits of one chunk in memory. Same selection as select_hits().
+
+    Parameters
+    ----------
+    hits : array
+        Hit array of the actual chunk.
+    total_hits : uint
+        Total number of hits in the data set the chunk is taken from. Needed to
+        reduce the chunk to the fraction max_hits / total_hits.
+        If None, the chunk is the whole data set.
+    max_hits : uint
+        Number of maximum hits with selection. For data reduction.
+    condition : string
+        A condition that is applied to the hits in numexpr.
+    track_quality : uint
+        Select hits with (track_quality & track_quality_mask) == track_quality.
+    track_quality_mask : uint
+        Mask for the track quality. If None, all quality bits are selected.
+
+    Returns
+    -------
+    Array with the selected hits.
+    '''
+    n_hits = hits.shape[0]
+    if total_hits is None:
+        total_hits = n_hits
+
+    if condition:
+        hits = _select_hits_with_condition(hits, condition)
+
+    if track_quality:
+        # If no mask is defined select all quality bits
+        if not track_quality_mask:
+            track_quality_mask = int(0xFFFFFFFF)
+        sel = (hits['track_quality'] &
+               track_quality_mask) == (track_quality)
+        hits = hits[sel]
+
+    if hits.shape[0] == 0:
+        logging.warning('No hits selected')
+
+    # Reduce the number of added hits of this chunk to not
+    # exeed max_hits
+    if max_hits:
+        # Calculate number of hits to add for this chunk
+        # Fraction of hits to add per chunk
+        hit_fraction = max_hits / float(total_hits)
+        sel = np.ceil(np.linspace(0,
+                                  hits.shape[0],
+                                  int(hit_fraction * n_hits),
+                                  endpoint=False)).astype(np.int32)
+        sel = sel[sel < hits.shape[0]]
+        hits = hits[sel]
+
+    return hits
+
+
 def _select_hits_with_condition(hits_array, condition):
     for variable in set(re.findall(r'(\d*[a-zA-Z_]+\d*)', condition)):
         exec(variable + ' = hits_array[\'' + variable + '\']')  # expose variables; not a copy, this is just a reference
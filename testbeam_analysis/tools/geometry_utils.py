@@ -8,6 +8,8 @@ import logging
 import tables as tb
 import numpy as np
 
+from testbeam_analysis.tools import storage
+
 
 def get_plane_normal(direction_vector_1, direction_vector_2):
     ''' Normal vector of a plane.
@@ -589,10 +591,7 @@ def store_alignment_parameters(alignment_file, alignment_parameters,
                                                  'alignment geometry parameters '
                                                  '(translations and rotations)',
                                                  description=alignment_parameters.dtype,
-                                                 filters=tb.Filters(
-                                                     complib='blosc',
-                                                     complevel=5,
-                                                     fletcher32=False))
+                                                 filters=storage.get_filters('alignment'))
             align_tab.append(alignment_parameters)
         except tb.NodeError:
             alignment_parameters = merge_alignment_parameters(
@@ -609,10 +608,7 @@ def store_alignment_parameters(alignment_file, alignment_parameters,
                                                  'alignment geometry parameters '
                                                  '(translations and rotations)',
                                                  description=alignment_parameters.dtype,
-                                                 filters=tb.Filters(
-                                                     complib='blosc',
-                                                     complevel=5,
-                                                     fletcher32=False))
+                                                 filters=storage.get_filters('alignment'))
             align_tab.append(alignment_parameters)
 
         string = "\n".join(['DUT%d: alpha=%1.4f, beta=%1.4f, gamma=%1.4f Rad, '
@@ -1,312 +1,314 @@
 import numpy as np
 
 from numba import njit
-from numpy import linalg
 from testbeam_analysis.tools import geometry_utils
 
+# Dimension of the state (x, y, slope_x, slope_y) and of the observation vector.
+# Fixed size allows the compiler to unroll the matrix operations.
+n_dim = 4
+
 
 @njit
 def _filter_predict(transition_matrix, transition_covariance,
                     transition_offset, current_filtered_state,
-                    current_filtered_state_covariance):
-    """Calculates the predicted state and its covariance matrix. Prediction
-    is done on whole track chunk with size chunk_size.
+                    current_filtered_state_covariance,
+                    predicted_state, predicted_state_covariance, temp_matrix):
+    """Calculates the predicted state and its covariance matrix for one track.
+    The results are written into predicted_state and predicted_state_covariance.
 
     Parameters
     ----------
-    transition_matrix : [chunk_size, n_dim_state, n_dim_state] array
+    transition_matrix : [n_dim_state, n_dim_state] array
         state transition matrix from time t to t+1.
-    transition_covariance : [chunk_size, n_dim_state, n_dim_state] array
+    transition_covariance : [n_dim_state, n_dim_state] array
         covariance matrix for state transition from time t to t+1.
-    transition_offset : [chunk_size, n_dim_state] array
+    transition_offset : [n_dim_state] array
         offset for state transition from time t to t+1.
-    current_filtered_state: [chunk_size, n_dim_state] array
+    current_filtered_state: [n_dim_state] array
         filtered state at time t.
-    current_filtered_state_covariance: [chunk_size, n_dim_state, n_dim_state] array
+    current_filtered_state_covariance: [n_dim_state, n_dim_state] array
         covariance of filtered state at time t.
-
-    Returns
-    -------
-    predicted_state : [chunk_size, n_dim_state] array
-        predicted state at time t+1.
-    predicted_state_covariance : [chunk_size, n_dim_state, n_dim_state] array
-        covariance matrix of predicted state at time t+1.
+    predicted_state : [n_dim_state] array
+        output, predicted state at time t+1.
+    predicted_state_covariance : [n_dim_state, n_dim_state] array
+        output, covariance matrix of predicted state at time t+1.
+    temp_matrix : [n_dim_state, n_dim_state] array
+        work array.
     """
-    predicted_state = _vec_mul(transition_matrix, current_filtered_state) + transition_offset
-
-    predicted_state_covariance = _mat_mul(transition_matrix,
-                                          _mat_mul(current_filtered_state_covariance,
-                                                   _mat_trans(transition_matrix))) + transition_covariance
-
-    return predicted_state, predicted_state_covariance
+    for i in range(n_dim):
+        value = transition_offset[i]
+        for k in range(n_dim):
+            value += transition_matrix[i, k] * current_filtered_state[k]
+        predicted_state[i] = value
+
+    # temp = F * P
+    for i in range(n_dim):
+        for j in range(n_dim):
+            value = 0.
+            for k in range(n_dim):
+                value += transition_matrix[i, k] * current_filtered_state_covariance[k, j]
+            temp_matrix[i, j] = value
+
+    # P_pred = F * P * F^T + Q
+    for i in range(n_dim):
+        for j in range(n_dim):
+            value = 0.
+            for k in range(n_dim):
+                value += temp_matrix[i, k] * transition_matrix[j, k]
+            predicted_state_covariance[i, j] = value + transition_covariance[i, j]
 
 
+@njit
 def _filter_correct(observation_matrix, observation_covariance,
                     observation_offset, predicted_state,
-                    predicted_state_covariance, observation, mask):
-    r"""Filters a predicted state with the Kalman Filter. Filtering
-    is done on whole track chunk with size chunk_size.
+                    predicted_state_covariance, observation,
+                    filtered_state, filtered_state_covariance,
+                    kalman_gain, temp_obs_matrix, temp_obs_inverse, temp_obs_vector, temp_missing, temp_work):
+    """Filters a predicted state of one track with the Kalman Filter.
+    The results are written into filtered_state and filtered_state_covariance.
 
     Parameters
     ----------
-    observation_matrix : [chunk_size, n_dim_obs, n_dim_obs] array
+    observation_matrix : [n_dim_obs, n_dim_state] array
         observation matrix for time t.
-    observation_covariance : [chunk_size, n_dim_obs, n_dim_obs] array
+    observation_covariance : [n_dim_obs, n_dim_obs] array
         covariance matrix for observation at time t.
-    observation_offset : [chunk_size, n_dim_obs] array
+    observation_offset : [n_dim_obs] array
         offset for observation at time t.
-    predicted_state : [chunk_size, n_dim_state] array
+    predicted_state : [n_dim_state] array
         predicted state at time t.
     predicted_state_covariance : [n_dim_state, n_dim_state] array
         covariance matrix of predicted state at time t.
-    observation : [chunk_size, n_dim_obs] array
-        observation at time t.  If observation is a masked array and any of
-        its values are masked, the observation will be not included in filtering.
-    mask : [chunk_size, n_dim_obs] bool
-        Mask which determines if measurement will be included in filtering step (False, not masked)
-        or will be treated as missing measurement (True, masked).
-
-    Returns
-    -------
-    kalman_gain : [chunk_size, n_dim_state, n_dim_obs] array
-        Kalman gain matrix for time t.
-    filtered_state : [chunk_size, n_dim_state] array
-        filtered state at time t.
-    filtered_state_covariance : [chunk_size, n_dim_state, n_dim_state] array
-        covariance matrix of filtered state at time t.
+    observation : [n_dim_obs] array
+        observation at time t.
+    filtered_state : [n_dim_state] array
+        output, filtered state at time t.
+    filtered_state_covariance : [n_dim_state, n_dim_state] array
+        output, covariance matrix of filtered state at time t.
+    kalman_gain : [n_dim_state, n_dim_obs] array
+        work array, Kalman gain matrix for time t.
+    temp_obs_matrix, temp_obs_inverse : [n_dim_obs, n_dim_obs] array
+        work arrays.
+    temp_obs_vector : [n_dim_obs] array
+        work array.
+    temp_missing, temp_work : array
+        work arrays of _pinv_symmetric.
     """
-    if not np.any(mask):
-        predicted_observation = _vec_mul(observation_matrix, predicted_state) + observation_offset
-
-        predicted_observation_covariance = _mat_mul(observation_matrix,
-                                                    _mat_mul(predicted_state_covariance, _mat_trans(observation_matrix))) + observation_covariance
-
-        kalman_gain = _mat_mul(predicted_state_covariance,
-                               _mat_mul(_mat_trans(observation_matrix),
-                                        _mat_inverse(predicted_observation_covariance)))
-
-        filtered_state = predicted_state + _vec_mul(kalman_gain,
-                                                    observation - predicted_observation)
-
-        filtered_state_covariance = predicted_state_covariance - _mat_mul(kalman_gain,
-                                                                          _mat_mul(observation_matrix,
-                                                                                   predicted_state_covariance))
-    else:
-        n_dim_state = predicted_state_covariance.shape[1]
-        n_dim_obs = observation_matrix.shape[1]
-        chunk_size = observation_matrix.shape[0]
-        kalman_gain = np.zeros((chunk_size, n_dim_state, n_dim_obs))
-
-        filtered_state = predicted_state
-        filtered_state_covariance = predicted_state_covariance
-
-    return kalman_gain, filtered_state, filtered_state_covariance
-
-
-def _filter(alignment, transition_matrices, observation_matrices, transition_covariances,
-            observation_covariances, transition_offsets, observation_offsets,
-            initial_state, initial_state_covariance, observations, mask):
-    """Apply the Kalman Filter. First a prediction of the state is done, then a filtering is
-    done which includes the observations.
-
-    Parameters
-    ----------
-    alignment : array_like or None
-        Aligment data, which contains rotations and translations for each DUT. Needed to take rotations of DUTs into account,
-        in order to get correct transition matrices. If pre-alignment data is used, this is set to None since no rotations have to be
-        taken into account.
-    transition_matrices : [chunk_size, n_timesteps-1, n_dim_state, n_dim_state] array-like
-        matrices to transport states from t to t+1.
-    observation_matrices : [chunk_size, n_timesteps, n_dim_obs, n_dim_state] array-like
-        observation matrices.
-    transition_covariances : [chunk_size, n_timesteps-1, n_dim_state,n_dim_state]  array-like
-        covariance matrices of transition matrices.
-    observation_covariances : [chunk_size, n_timesteps, n_dim_obs, n_dim_obs] array-like
-        covariance matrices of observation matrices.
-    transition_offsets : [chunk_size, n_timesteps-1, n_dim_state] array-like
-        offsets of transition matrices.
-    observation_offsets : [chunk_size, n_timesteps, n_dim_obs] array-like
-        offsets of observations.
-    initial_state : [chunk_size, n_dim_state] array-like
-        initial value of state.
-    initial_state_covariance : [chunk_size, n_dim_state, n_dim_state] array-like
-        initial value for observation covariance matrices.
-    observations : [chunk_size, n_timesteps, n_dim_obs] array
-        observations (measurements) from times [0...n_timesteps-1]. If any of observations is masked,
-        then observations[:, t] will be treated as a missing observation
-        and will not be included in the filtering step.
-
-    Returns
-    -------
-    predicted_states : [chunk_size, n_timesteps, n_dim_state] array
-        predicted states of times [0...t].
-    predicted_state_covariances : [chunk_size, n_timesteps, n_dim_state, n_dim_state] array
-        covariance matrices of predicted states of times [0...t].
-    kalman_gains : [chunk_size, n_timesteps, n_dim_state] array
-        Kalman gain matrices of times [0...t].
-    filtered_states : [chunk_size, n_timesteps, n_dim_state] array
-        filtered states of times [0...t].
-    filtered_state_covariances : [chunk_size, n_timesteps, n_dim_state] array
-        covariance matrices of filtered states of times [0...t].
-    transition_matrices_update : [chunk_size, n_timesteps-1, n_dim_state, n_dim_state] array-like
-        updated transition matrices in case of rotated planes.
-    """
-    chunk_size, n_timesteps, n_dim_obs = observations.shape
-    n_dim_state = transition_covariances.shape[2]
-
-    predicted_states = np.zeros((chunk_size, n_timesteps, n_dim_state))
-    predicted_state_covariances = np.zeros((chunk_size, n_timesteps, n_dim_state, n_dim_state))
-    kalman_gains = np.zeros((chunk_size, n_timesteps, n_dim_state, n_dim_obs))
-    filtered_states = np.zeros((chunk_size, n_timesteps, n_dim_state))
-    filtered_state_covariances = np.zeros((chunk_size, n_timesteps, n_dim_state, n_dim_state))
-    # array where new transition matrices are stored, needed to pass it to kalman smoother
-    transition_matrices_update = np.zeros_like(transition_covariances)
-
-    for t in range(n_timesteps):
-        if t == 0:
-            predicted_states[:, t] = initial_state
-            predicted_state_covariances[:, t] = initial_state_covariance
-        else:
-            if alignment is not None:
-                # get position of plane t - 1 and t
-                dut_position = [np.array([alignment[t - 1]['translation_x'], alignment[t - 1]['translation_y'], alignment[t - 1]['translation_z']]),
-                                np.array([alignment[t]['translation_x'], alignment[t]['translation_y'], alignment[t]['translation_z']])]
-
-                rotation_matrix = [geometry_utils.rotation_matrix(alpha=alignment[t - 1]['alpha'],
-                                                                  beta=alignment[t - 1]['beta'],
-                                                                  gamma=alignment[t - 1]['gamma']),
-                                   geometry_utils.rotation_matrix(alpha=alignment[t]['alpha'],
-                                                                  beta=alignment[t]['beta'],
-                                                                  gamma=alignment[t]['gamma'])]
-
-                basis_global = [rotation_matrix[0].T.dot(np.eye(3)), rotation_matrix[1].T.dot(np.eye(3))]
-                dut_plane_normal = [basis_global[0][2], basis_global[1][2]]
-
-                # slopes (directional vectors))o f the filtered estimates
-                slopes = np.column_stack((filtered_states[:, t - 1, 2], filtered_states[:, t - 1, 3], np.ones((filtered_states.shape[0], 1))))
-
-                # z position of the filtered states
-                z_position = geometry_utils.get_line_intersections_with_plane(line_origins=np.column_stack((filtered_states[:, t - 1, 0],
-                                                                                                            filtered_states[:, t - 1, 1],
-                                                                                                            np.ones(filtered_states[:, t - 1, 1].shape))),
-                                                                              line_directions=np.column_stack((np.zeros((filtered_states[:, t - 1, 1].shape)),
-                                                                                                               np.zeros(filtered_states[:, t - 1, 1].shape),
-                                                                                                               np.ones(filtered_states[:, t - 1, 1].shape))),
-                                                                              position_plane=dut_position[0],
-                                                                              normal_plane=dut_plane_normal[0])[:, -1]
-
-                # offsets (supoort vectors) of the filtered states
-                offsets = np.column_stack((filtered_states[:, t - 1, 0], filtered_states[:, t - 1, 1], z_position))
-
-                # calculate intersection of state which should be predicted (filtered state of plane before) with plane t - 1 and t
-                offsets_rotated = [geometry_utils.get_line_intersections_with_plane(line_origins=offsets,
-                                                                                    line_directions=slopes,
-                                                                                    position_plane=dut_position[0],
-                                                                                    normal_plane=dut_plane_normal[0]),
-                                   geometry_utils.get_line_intersections_with_plane(line_origins=offsets,
-                                                                                    line_directions=slopes,
-                                                                                    position_plane=dut_position[1],
-                                                                                    normal_plane=dut_plane_normal[1])]
-
-                z_diff = offsets_rotated[1][:, 2] - offsets_rotated[0][:, 2]
-
-                # update transition matrix, only need to change these value in case for rotated planes
-                transition_matrices[:, t - 1, 0, 2] = z_diff
-                transition_matrices[:, t - 1, 1, 3] = z_diff
-
-            # store updated transition matrix for smoothing function
-            transition_matrices_update[:, t - 1] = transition_matrices[:, t - 1]
-            transition_matrix = transition_matrices[:, t - 1]
-            transition_covariance = transition_covariances[:, t - 1]
-            transition_offset = transition_offsets[:, t - 1]
-            predicted_states[:, t], predicted_state_covariances[:, t] = _filter_predict(
-                transition_matrix,
-                transition_covariance,
-                transition_offset,
-                filtered_states[:, t - 1],
-                filtered_state_covariances[:, t - 1])
-
-        observation_matrix = observation_matrices[:, t]
-        observation_covariance = observation_covariances[:, t]
-        observation_offset = observation_offsets[:, t]
-        kalman_gains[:, t], filtered_states[:, t], filtered_state_covariances[:, t] = _filter_correct(
-            observation_matrix,
-            observation_covariance,
-            observation_offset,
-            predicted_states[:, t],
-            predicted_state_covariances[:, t],
-            observations[:, t],
-            np.ma.getmask(observations[:, t]))
-
-    return predicted_states, predicted_state_covariances, kalman_gains, filtered_states, filtered_state_covariances, transition_matrices_update
+    # kalman_gain is used to store P_pred * H^T first
+    for i in range(n_dim):
+        for j in range(n_dim):
+            value = 0.
+            for k in range(n_dim):
+                value += predicted_state_covariance[i, k] * observation_matrix[j, k]
+            kalman_gain[i, j] = value
+
+    # predicted observation covariance S = H * P_pred * H^T + R
+    for i in range(n_dim):
+        for j in range(n_dim):
+            value = 0.
+            for k in range(n_dim):
+                value += observation_matrix[i, k] * kalman_gain[k, j]
+            temp_obs_matrix[i, j] = value + observation_covariance[i, j]
+    _pinv_symmetric(temp_obs_matrix, temp_obs_inverse, temp_missing, temp_work)
+
+    # residual of observation and predicted observation: z - (H * x_pred + b)
+    for i in range(n_dim):
+        value = observation_offset[i]
+        for k in range(n_dim):
+            value += observation_matrix[i, k] * predicted_state[k]
+        temp_obs_vector[i] = observation[i] - value
+
+    # K = P_pred * H^T * S^-1, temp_obs_matrix is not needed anymore and is used as row buffer
+    for i in range(n_dim):
+        for j in range(n_dim):
+            temp_obs_matrix[0, j] = kalman_gain[i, j]
+        for j in range(n_dim):
+            value = 0.
+            for k in range(n_dim):
+                value += temp_obs_matrix[0, k] * temp_obs_inverse[k, j]
+            kalman_gain[i, j] = value
+
+    for i in range(n_dim):
+        value = predicted_state[i]
+        for k in range(n_dim):
+            value += kalman_gain[i, k] * temp_obs_vector[k]
+        filtered_state[i] = value
+
+    # P = P_pred - K * H * P_pred, temp_obs_matrix is used to store H * P_pred
+    for i in range(n_dim):
+        for j in range(n_dim):
+            value = 0.
+            for k in range(n_dim):
+                value += observation_matrix[i, k] * predicted_state_covariance[k, j]
+            temp_obs_matrix[i, j] = value
+    for i in range(n_dim):
+        for j in range(n_dim):
+            value = 0.
+            for k in range(n_dim):
+                value += kalman_gain[i, k] * temp_obs_matrix[k, j]
+            filtered_state_covariance[i, j] = predicted_state_covariance[i, j] - value
 
 
 @njit
 def _smooth_update(transition_matrix, filtered_state,
                    filtered_state_covariance, predicted_state,
                    predicted_state_covariance, next_smoothed_state,
-                   next_smoothed_state_covariance):
-    """Smooth a filtered state with a Kalman Smoother. Smoothing
-    is done on whole track chunk with size chunk_size.
+                   next_smoothed_state_covariance,
+                   smoothed_state, smoothed_state_covariance,
+                   kalman_smoothing_gain, temp_matrix, temp_inverse, temp_missing, temp_work):
+    """Smooth a filtered state of one track with a Kalman Smoother.
+    The results are written into smoothed_state and smoothed_state_covariance.
 
     Parameters
     ----------
-    transition_matrix : [chunk_size, n_dim_state, n_dim_state] array
+    transition_matrix : [n_dim_state, n_dim_state] array
         transition matrix to transport state from time t to t+1.
-    filtered_state : [chunk_size, n_dim_state] array
+    filtered_state : [n_dim_state] array
         filtered state at time t.
-    filtered_state_covariance : [chunk_size, n_dim_state, n_dim_state] array
+    filtered_state_covariance : [n_dim_state, n_dim_state] array
         covariance matrix of filtered state at time t.
-    predicted_state : [chunk_size, n_dim_state] array
+    predicted_state : [n_dim_state] array
         predicted state at time t+1.
-    predicted_state_covariance : [chunk_size, n_dim_state, n_dim_state] array
+    predicted_state_covariance : [n_dim_state, n_dim_state] array
         covariance matrix of filtered state at time t+1.
-    next_smoothed_state : [chunk_size, n_dim_state] array
+    next_smoothed_state : [n_dim_state] array
         smoothed state at time t+1.
-    next_smoothed_state_covariance : [chunk_size, n_dim_state, n_dim_state] array
+    next_smoothed_state_covariance : [n_dim_state, n_dim_state] array
         covariance matrix of smoothed state at time t+1.
-
-    Returns
-    -------
-    smoothed_state : [chunk_size, n_dim_state] array
-        smoothed state at time t.
-    smoothed_state_covariance : [chunk_size, n_dim_state, n_dim_state] array
-        covariance matrix of smoothed state at time t.
-    kalman_smoothing_gain : [chunk_size, n_dim_state, n_dim_state] array
-        smoothed Kalman gain matrix at time t.
+    smoothed_state : [n_dim_state] array
+        output, smoothed state at time t.
+    smoothed_state_covariance : [n_dim_state, n_dim_state] array
+        output, covariance matrix of smoothed state at time t.
+    kalman_smoothing_gain, temp_matrix, temp_inverse : [n_dim_state, n_dim_state] array
+        work arrays.
+    temp_missing, temp_work : array
+        work arrays of _pinv_symmetric.
     """
-    kalman_smoothing_gain = _mat_mul(filtered_state_covariance,
-                                     _mat_mul(_mat_trans(transition_matrix),
-                                              _mat_inverse(predicted_state_covariance)))
+    _pinv_symmetric(predicted_state_covariance, temp_inverse, temp_missing, temp_work)
+
+    # temp = F^T * P_pred^-1
+    for i in range(n_dim):
+        for j in range(n_dim):
+            value = 0.
+            for k in range(n_dim):
+                value += transition_matrix[k, i] * temp_inverse[k, j]
+            temp_matrix[i, j] = value
+
+    # G = P_filtered * F^T * P_pred^-1
+    for i in range(n_dim):
+        for j in range(n_dim):
+            value = 0.
+            for k in range(n_dim):
+                value += filtered_state_covariance[i, k] * temp_matrix[k, j]
+            kalman_smoothing_gain[i, j] = value
+
+    for i in range(n_dim):
+        value = filtered_state[i]
+        for k in range(n_dim):
+            value += kalman_smoothing_gain[i, k] * (next_smoothed_state[k] - predicted_state[k])
+        smoothed_state[i] = value
+
+    # temp = (P_smoothed_next - P_pred) * G^T
+    for i in range(n_dim):
+        for j in range(n_dim):
+            value = 0.
+            for k in range(n_dim):
+                value += (next_smoothed_state_covariance[i, k] - predicted_state_covariance[i, k]) * kalman_smoothing_gain[j, k]
+            temp_matrix[i, j] = value
+
+    for i in range(n_dim):
+        for j in range(n_dim):
+            value = filtered_state_covariance[i, j]
+            for k in range(n_dim):
+                value += kalman_smoothing_gain[i, k] * temp_matrix[k, j]
+            smoothed_state_covariance[i, j] = value
+
+
+@njit(error_model='numpy')
+def _pinv_symmetric(X, inv, missing, work):
+    '''Helper function to calculate the pseudo inverse of a symmetric, positive semi-definite matrix.
+    Rows and columns with zero diagonal element are zero for these matrices and stay zero in the inverse.
+    The remaining positive definite sub matrix is inverted by Gauss-Jordan elimination.
+    missing and work are work arrays with shape (n_dim) and (n_dim, 2 * n_dim).
+    '''
+    for i in range(n_dim):
+        missing[i] = X[i, i] == 0.
+        for j in range(n_dim):
+            work[i, j] = X[i, j]
+            work[i, n_dim + j] = 0.
+        if missing[i]:  # decouple zero row and column
+            work[i, i] = 1.
+        work[i, n_dim + i] = 1.
+
+    for col in range(n_dim):
+        value = work[col, col]
+        for j in range(2 * n_dim):
+            work[col, j] /= value
+        for row in range(n_dim):
+            if row != col:
+                factor = work[row, col]
+                for j in range(2 * n_dim):
+                    work[row, j] -= factor * work[col, j]
+
+    for i in range(n_dim):
+        for j in range(n_dim):
+            if missing[i] or missing[j]:
+                inv[i, j] = 0.
+            else:
+                inv[i, j] = work[i, n_dim + j]
 
-    smoothed_state = filtered_state + _vec_mul(kalman_smoothing_gain,
-                                               next_smoothed_state - predicted_state)
 
-    smoothed_state_covariance = filtered_state_covariance + _mat_mul(kalman_smoothing_gain,
-                                                                     _mat_mul((next_smoothed_state_covariance - predicted_state_covariance),
-                                                                              _mat_trans(kalman_smoothing_gain)))
-    return smoothed_state, smoothed_state_covariance, kalman_smoothing_gain
+@njit
+def _line_plane_intersection_z(origin_x, origin_y, origin_z, direction_x, direction_y, direction_z, position_plane, normal_plane):
+    '''Helper function to calculate the z position of the intersection of one line with a plane.
+    Returns nan if the line is parallel to the plane (see geometry_utils.get_line_intersections_with_plane).
+    '''
+    norm_dot_dir = normal_plane[0] * direction_x + normal_plane[1] * direction_y + normal_plane[2] * direction_z
+    if norm_dot_dir == 0.:
+        return np.nan
+    norm_dot_off = (normal_plane[0] * (position_plane[0] - origin_x) +
+                    normal_plane[1] * (position_plane[1] - origin_y) +
+                    normal_plane[2] * (position_plane[2] - origin_z))
+    return origin_z + direction_z * (norm_dot_off / norm_dot_dir)
 
 
 @njit
-def _smooth(transition_matrices, filtered_states,
-            filtered_state_covariances, predicted_states,
-            predicted_state_covariances):
-    """Apply the Kalman Smoother to filtered states. Estimate the smoothed states.
-    Smoothing is done on whole track chunk with size chunk_size.
+def _smooth(use_alignment, dut_positions, dut_plane_normals,
+            transition_matrices, transition_offsets, transition_covariances,
+            observation_matrices, observation_offsets, observation_covariances,
+            initial_state, initial_state_covariance, observations, mask):
+    """Apply the Kalman Filter and the Kalman Smoother track by track. First a prediction of the state is done,
+    then a filtering is done which includes the observations. Afterwards the filtered states are smoothed.
 
     Parameters
     ----------
+    use_alignment : bool
+        If True, the transition matrices are updated before each prediction step in order to take rotations of planes into account.
+    dut_positions : [n_timesteps, 3] array
+        Translation of each plane. Only used if use_alignment is True.
+    dut_plane_normals : [n_timesteps, 3] array
+        Normal vector of each plane. Only used if use_alignment is True.
     transition_matrices : [chunk_size, n_timesteps-1, n_dim_state, n_dim_state] array-like
-        matrices to transport states from t to t+1 of times [0...t-1].
-    filtered_states : [chunk_size, n_timesteps, n_dim_state] array
-        filtered states of times [0...t].
-    filtered_state_covariances : [chunk_size, n_timesteps, n_dim_state] array
-        covariance matrices of filtered states of times [0...t].
-    predicted_states : [chunk_size, n_timesteps, n_dim_state] array
-        predicted states of times [0...t].
-    predicted_state_covariances : [chunk_size, n_timesteps, n_dim_state, n_dim_state] array
-        covariance matrices of predicted states of times [0...t].
+        matrices to transport states from t to t+1.
+    transition_offsets : [chunk_size, n_timesteps-1, n_dim_state] array-like
+        offsets of transition matrices.
+    transition_covariances : [chunk_size, n_timesteps-1, n_dim_state,n_dim_state]  array-like
+        covariance matrices of transition matrices.
+    observation_matrices : [chunk_size, n_timesteps, n_dim_obs, n_dim_state] array-like
+        observation matrices.
+    observation_offsets : [chunk_size, n_timesteps, n_dim_obs] array-like
+        offsets of observations.
+    observation_covariances : [chunk_size, n_timesteps, n_dim_obs, n_dim_obs] array-like
+        covariance matrices of observation matrices.
+    initial_state : [chunk_size, n_dim_state] array-like
+        initial value of state.
+    initial_state_covariance : [chunk_size, n_dim_state, n_dim_state] array-like
+        initial value for observation covariance matrices.
+    observations : [chunk_size, n_timesteps, n_dim_obs] array
+        observations (measurements) from times [0...n_timesteps-1].
+    mask : [chunk_size, n_timesteps] array
+        If True, observations[i, t] is treated as a missing observation of track i
+        and is not included in the filtering step.
 
     Returns
     -------
@@ -314,83 +316,87 @@ def _smooth(transition_matrices, filtered_states,
         smoothed states for times [0...n_timesteps-1].
     smoothed_state_covariances : [chunk_size, n_timesteps, n_dim_state, n_dim_state] array
         covariance matrices of smoothed states for times [0...n_timesteps-1].
-    kalman_smoothing_gains : [chunk_size, n_timesteps-1, n_dim_state] array
-        smoothed kalman gain matrices fot times [0...n_timesteps-2].
     """
-    chunk_size, n_timesteps, n_dim_state = filtered_states.shape
-    smoothed_states = np.zeros((chunk_size, n_timesteps, n_dim_state))
-    smoothed_state_covariances = np.zeros((chunk_size, n_timesteps, n_dim_state, n_dim_state))
-    kalman_smoothing_gains = np.zeros((chunk_size, n_timesteps - 1, n_dim_state, n_dim_state))
-
-    smoothed_states[:, -1] = filtered_states[:, -1]
-    smoothed_state_covariances[:, -1] = filtered_state_covariances[:, -1]
-
-    for i in range(n_timesteps - 1):
-        t = (n_timesteps - 2) - i  # reverse order
-        transition_matrix = transition_matrices[:, t]
-        smoothed_states[:, t], smoothed_state_covariances[:, t], kalman_smoothing_gains[:, t] = _smooth_update(
-            transition_matrix,
-            filtered_states[:, t],
-            filtered_state_covariances[:, t],
-            predicted_states[:, t + 1],
-            predicted_state_covariances[:, t + 1],
-            smoothed_states[:, t + 1],
-            smoothed_state_covariances[:, t + 1])
-
-    return smoothed_states, smoothed_state_covariances, kalman_smoothing_gains
-
-
-@njit
-def _mat_mul(X, Y):
-    '''Helper function to multiply two 3D matrices. Multiplication is done on last two axes.
-    '''
-    result = np.zeros(X.shape)
-    for l in range(X.shape[0]):
-        # iterate through rows of X
-        for i in range(X.shape[1]):
-            # iterate through columns of Y
-            for j in range(Y.shape[2]):
-                # iterate through rows of Y
-                for k in range(Y.shape[1]):
-                    result[l][i][j] += X[l][i][k] * Y[l][k][j]
-    return result
-
-
-@njit
-def _vec_mul(X, Y):
-    '''Helper function to multiply 3D matrix with 3D vector. Multiplication is done on last two axes.
-    '''
-    result = np.zeros(Y.shape)
-    for l in range(X.shape[0]):
-        # iterate through rows of X
-        for i in range(X.shape[1]):
-            # iterate through columns of Y
-            for k in range(Y.shape[1]):
-                result[l][i] += X[l][i][k] * Y[l][k]
-    return result
-
-
-@njit
-def _mat_trans(X):
-    '''Helper function to calculate transpose of 3D matrix. Transposition is done on last two axes.
-    '''
-    result = np.zeros((X.shape[0], X.shape[1], X.shape[2]))
-    for l in range(X.shape[0]):
-        for i in range(X.shape[1]):
-            for j in range(X.shape[2]):
-                result[l][i][j] = X[l][j][i]
-
-    return result
-
-
-@njit
-def _mat_inverse(X):
-    '''Helper function to calculate inverese of 3D matrix. Inversion is done on last two axes.
-    '''
-    inv = np.zeros((X.shape))
-    for i in range(X.shape[0]):
-            inv[i] = linalg.pinv(X[i])
-    return inv
+    chunk_size, n_timesteps = observations.shape[0], observations.shape[1]
+
+    smoothed_states = np.zeros((chunk_size, n_timesteps, n_dim))
+    smoothed_state_covariances = np.zeros((chunk_size, n_timesteps, n_dim, n_dim))
+
+    # Arrays of one track, reused for all tracks
+    predicted_states = np.zeros((n_timesteps, n_dim))
+    predicted_state_covariances = np.zeros((n_timesteps, n_dim, n_dim))
+    filtered_states = np.zeros((n_timesteps, n_dim))
+    filtered_state_covariances = np.zeros((n_timesteps, n_dim, n_dim))
+    # updated transition matrices in case of rotated planes, needed for smoothing
+    transition_matrices_update = np.zeros((max(n_timesteps - 1, 1), n_dim, n_dim))
+    kalman_gain = np.zeros((n_dim, n_dim))
+    kalman_smoothing_gain = np.zeros((n_dim, n_dim))
+    temp_matrix = np.zeros((n_dim, n_dim))
+    temp_inverse = np.zeros((n_dim, n_dim))
+    temp_obs_matrix = np.zeros((n_dim, n_dim))
+    temp_obs_inverse = np.zeros((n_dim, n_dim))
+    temp_obs_vector = np.zeros(n_dim)
+    temp_missing = np.zeros(n_dim, dtype=np.bool_)
+    temp_work = np.zeros((n_dim, 2 * n_dim))
+
+    for track in range(chunk_size):
+        for t in range(n_timesteps):
+            if t == 0:
+                predicted_states[t] = initial_state[track]
+                predicted_state_covariances[t] = initial_state_covariance[track]
+            else:
+                transition_matrices_update[t - 1] = transition_matrices[track, t - 1]
+                if use_alignment:
+                    x, y, slope_x, slope_y = filtered_states[t - 1, 0], filtered_states[t - 1, 1], filtered_states[t - 1, 2], filtered_states[t - 1, 3]
+                    # z position of the filtered state on plane t - 1
+                    z_position = _line_plane_intersection_z(x, y, 1., 0., 0., 1., dut_positions[t - 1], dut_plane_normals[t - 1])
+                    # calculate intersection of state which should be predicted (filtered state of plane before) with plane t - 1 and t
+                    z_diff = (_line_plane_intersection_z(x, y, z_position, slope_x, slope_y, 1., dut_positions[t], dut_plane_normals[t]) -
+                              _line_plane_intersection_z(x, y, z_position, slope_x, slope_y, 1., dut_positions[t - 1], dut_plane_normals[t - 1]))
+                    # update transition matrix, only need to change these value in case for rotated planes
+                    transition_matrices_update[t - 1, 0, 2] = z_diff
+                    transition_matrices_update[t - 1, 1, 3] = z_diff
+
+                _filter_predict(transition_matrices_update[t - 1],
+                                transition_covariances[track, t - 1],
+                                transition_offsets[track, t - 1],
+                                filtered_states[t - 1],
+                                filtered_state_covariances[t - 1],
+                                predicted_states[t],
+                                predicted_state_covariances[t],
+                                temp_matrix)
+
+            if mask[track, t]:  # missing observation, state is not updated
+                filtered_states[t] = predicted_states[t]
+                filtered_state_covariances[t] = predicted_state_covariances[t]
+            else:
+                _filter_correct(observation_matrices[track, t],
+                                observation_covariances[track, t],
+                                observation_offsets[track, t],
+                                predicted_states[t],
+                                predicted_state_covariances[t],
+                                observations[track, t],
+                                filtered_states[t],
+                                filtered_state_covariances[t],
+                                kalman_gain, temp_obs_matrix, temp_obs_inverse, temp_obs_vector, temp_missing, temp_work)
+
+        smoothed_states[track, -1] = filtered_states[-1]
+        smoothed_state_covariances[track, -1] = filtered_state_covariances[-1]
+
+        for i in range(n_timesteps - 1):
+            t = (n_timesteps - 2) - i  # reverse order
+            _smooth_update(transition_matrices_update[t],
+                           filtered_states[t],
+                           filtered_state_covariances[t],
+                           predicted_states[t + 1],
+                           predicted_state_covariances[t + 1],
+                           smoothed_states[track, t + 1],
+                           smoothed_state_covariances[track, t + 1],
+                           smoothed_states[track, t],
+                           smoothed_state_covariances[track, t],
+                           kalman_smoothing_gain, temp_matrix, temp_inverse, temp_missing, temp_work)
+
+    return smoothed_states, smoothed_state_covariances
 
 
 class KalmanFilter():
@@ -423,8 +429,8 @@ class KalmanFilter():
         initial_state_covariance : [chunk_size, n_dim_state, n_dim_state] array-like
             initial value for observation covariance matrices.
         observations : [chunk_size, n_timesteps, n_dim_obs] array
-            observations (measurements) from times [0...n_timesteps-1]. If any of observations is masked,
-            then observations[:, t] will be treated as a missing observation
+            observations (measurements) from times [0...n_timesteps-1]. If any of observations[i, t] is masked,
+            then observations[i, t] will be treated as a missing observation of track i
             and will not be included in the filtering step.
 
         Returns
@@ -434,16 +440,27 @@ class KalmanFilter():
         smoothed_state_covariances : [chunk_size, n_timesteps, n_dim_state, n_dim_state] array
             covariance matrices of smoothed states for times [0...n_timesteps-1].
         """
-        predicted_states, predicted_state_covariances, _, filtered_states, filtered_state_covariances, transition_matrices = _filter(
-            alignment, transition_matrices, observation_matrices,
-            transition_covariance, observation_covariances,
-            transition_offsets, observation_offsets,
-            initial_state, initial_state_covariance, observations,
-            observations.mask)
-
-        smoothed_states, smoothed_state_covariances, _ = _smooth(
-            transition_matrices, filtered_states,
-            filtered_state_covariances, predicted_states,
-            predicted_state_covariances)
-
-        return smoothed_states, smoothed_state_covariances
+        n_timesteps = observations.shape[1]
+        if initial_state.shape[1] != n_dim or observations.shape[2] != n_dim:
+            raise ValueError('The state and the observations must have %d dimensions' % n_dim)
+
+        # Position and normal vector of the planes, needed to update the transition matrices for rotated planes
+        dut_positions = np.zeros((n_timesteps, 3))
+        dut_plane_normals = np.zeros((n_timesteps, 3))
+        if alignment is not None:
+            for t in range(n_timesteps):
+                dut_positions[t] = np.array([alignment[t]['translation_x'], alignment[t]['translation_y'], alignment[t]['translation_z']])
+                rotation_matrix = geometry_utils.rotation_matrix(alpha=alignment[t]['alpha'],
+                                                                 beta=alignment[t]['beta'],
+                                                                 gamma=alignment[t]['gamma'])
+                basis_global = rotation_matrix.T.dot(np.eye(3))
+                dut_plane_normals[t] = basis_global[2]
+
+        # A track has a missing observation at plane t if any of its observation values is masked
+        mask = np.any(np.ma.getmaskarray(observations), axis=2)
+
+        return _smooth(alignment is not None, dut_positions, dut_plane_normals,
+                       transition_matrices, transition_offsets, transition_covariance,
+                       observation_matrices, observation_offsets, observation_covariances,
+                       initial_state, initial_state_covariance,
+                       np.ma.getdata(observations).astype(np.float64), mask)
@@ -203,7 +203,7 @@ def plot_cluster_size(input_cluster_file, dut_name=None, output_pdf_file=None, c
         return figs
 
 
-def plot_tracks_per_event(input_tracks_file, output_pdf_file=None, gui=False):
+def plot_tracks_per_event(input_tracks_file, output_pdf_file=None, gui=False, chunk_size=1000000):
     """Plotting tracks per event
     Parameters
     ----------
@@ -232,16 +232,24 @@ def plot_tracks_per_event(input_tracks_file, output_pdf_file=None, gui=False):
 
             for node in input_file_h5.root:
 
-                table_events = node[:]['event_number']
-
-                events, event_count = np.unique(table_events, return_counts=True)
-                tracks_per_event, tracks_count = np.unique(event_count, return_counts=True)
+                # Histogram the number of tracks per event chunk wise, events are not split between chunks
+                n_events = 0
+                tracks_per_event_hist = np.zeros(shape=(0,), dtype=np.int64)
+                for tracks_chunk, _ in testbeam_analysis.tools.analysis_utils.data_aligned_at_events(node, chunk_size=chunk_size):
+                    _, event_count = np.unique(tracks_chunk['event_number'], return_counts=True)
+                    n_events += event_count.shape[0]
+                    actual_hist = np.bincount(event_count)
+                    if actual_hist.shape[0] > tracks_per_event_hist.shape[0]:
+                        tracks_per_event_hist = np.append(tracks_per_event_hist, np.zeros(shape=(actual_hist.shape[0] - tracks_per_event_hist.shape[0],), dtype=np.int64))
+                    tracks_per_event_hist[:actual_hist.shape[0]] += actual_hist
+                tracks_per_event = np.nonzero(tracks_per_event_hist)[0]
+                tracks_count = tracks_per_event_hist[tracks_per_event]
 
                 if not fitted_tracks:
-                    title = 'Track candidates per event number\n for %d events' % events.shape[0]
+                    title = 'Track candidates per event number\n for %d events' % n_events
                 else:
                     title = 'Tracks per event number of Tel_%s\n for %d events' % \
-                            (str(node.name).split('_')[-1], events.shape[0])
+                            (str(node.name).split('_')[-1], n_events)
 
                 xlabel = 'Track candidates per event' if not fitted_tracks else 'Tracks per event'
 
@@ -866,11 +874,9 @@ def plot_events(input_tracks_file, event_range=(0, 100), dut=None, n_tracks=None
                     if node.name != 'Tracks_DUT_%d' % dut:
                         continue
 
-                table = node[:]
-
-                n_duts = sum(['charge' in col for col in table.dtype.names])
-                array = table[:]
+                n_duts = sum(['charge' in col for col in node.dtype.names])
                 if n_tracks is not None:
+                    array = node.read(start=0, stop=n_tracks + 1)  # only the first tracks are needed
                     index_stop = 0
                     event_start = array['event_number'][0]
                     while index_stop <= n_tracks:
@@ -882,8 +888,10 @@ def plot_events(input_tracks_file, event_range=(0, 100), dut=None, n_tracks=None
                                 index_stop -= 1
                             break
                     tracks = testbeam_analysis.tools.analysis_utils.get_data_in_event_range(array, event_start, event_stop)
-                else:
-                    tracks = testbeam_analysis.tools.analysis_utils.get_data_in_event_range(array, event_range[0], event_range[-1])
+                else:  # Read only the tracks of the event range, search the event range in the table
+                    start_index = testbeam_analysis.tools.analysis_utils.searchsorted_event_number(node, event_range[0], side='left')
+                    stop_index = testbeam_analysis.tools.analysis_utils.searchsorted_event_number(node, event_range[-1], side='left', start_index=start_index)
+                    tracks = node.read(start=start_index, stop=stop_index)
                 if tracks.shape[0] == 0:
                     logging.warning('No tracks in event selection, cannot plot events!')
                     return
@@ -1029,7 +1037,7 @@ def plot_residuals_vs_position(hist, xedges, yedges, xlabel, ylabel, res_mean=No
         output_pdf.savefig(fig)
 
 
-def plot_track_density(input_tracks_file, z_positions, dim_x, dim_y, pixel_size, mask_zero=True, use_duts=None, max_chi2=None, output_pdf_file=None, gui=False):
+def plot_track_density(input_tracks_file, z_positions, dim_x, dim_y, pixel_size, mask_zero=True, use_duts=None, max_chi2=None, output_pdf_file=None, gui=False, chunk_size=1000000):
     '''Takes the tracks and calculates the track density projected on selected DUTs.
 
     Parameters
@@ -1052,6 +1060,8 @@ def plot_track_density(input_tracks_file, z_positions, dim_x, dim_y, pixel_size,
         Filename of the output PDF file. If None, the filename is derived from the input file.
     gui: bool
         Determines whether to plot directly onto gui
+    chunk_size : int
+        Chunk size of the data when reading from file.
     '''
 
     logging.info('Plotting track density')
@@ -1081,14 +1091,25 @@ def plot_track_density(input_tracks_file, z_positions, dim_x, dim_y, pixel_size,
                     continue
                 logging.info('Plot track density for DUT%d', actual_dut)
 
-                track_array = node[:]
+                # Histogram the tracks chunk wise
+                heatmap = np.zeros(shape=(bin_x, bin_y), dtype=np.float)
+                heatmap_hits = np.zeros(shape=(bin_x, bin_y), dtype=np.float)
+                heatmap_ref_hits = np.zeros(shape=(bin_x, bin_y), dtype=np.float)
+                for track_array, _ in testbeam_analysis.tools.analysis_utils.data_aligned_at_events(node, chunk_size=chunk_size):
+                    # If set, select only converged fits
+                    if max_chi2:
+                        track_array = track_array[track_array['track_chi2'] <= max_chi2]
 
-                # If set, select only converged fits
-                if max_chi2:
-                    track_array = track_array[track_array['track_chi2'] <= max_chi2]
+                    if plot_ref_dut:  # Plot first and last device
+                        heatmap_ref_hits += np.histogram2d(track_array['x_dut_0'], track_array['y_dut_0'], bins=(bin_x, bin_y), range=[[1.5, dimensions[index][0] + 0.5], [1.5, dimensions[index][1] + 0.5]])[0]
+
+                    offset, slope = np.column_stack((track_array['offset_0'], track_array['offset_1'], track_array['offset_2'])), np.column_stack((track_array['slope_0'], track_array['slope_1'], track_array['slope_2']))
+                    intersection = offset + slope / slope[:, 2, np.newaxis] * (z_positions[actual_dut] - offset[:, 2, np.newaxis])  # intersection track with DUT plane
+
+                    heatmap += np.histogram2d(intersection[:, 0], intersection[:, 1], bins=(bin_x, bin_y), range=[[1.5, dimensions[index][0] + 0.5], [1.5, dimensions[index][1] + 0.5]])[0]
+                    heatmap_hits += np.histogram2d(track_array['x_dut_%d' % actual_dut], track_array['y_dut_%d' % actual_dut], bins=(bin_x, bin_y), range=[[1.5, dimensions[index][0] + 0.5], [1.5, dimensions[index][1] + 0.5]])[0]
 
                 if plot_ref_dut:  # Plot first and last device
-                    heatmap_ref_hits, _, _ = np.histogram2d(track_array['x_dut_0'], track_array['y_dut_0'], bins=(bin_x, bin_y), range=[[1.5, dimensions[index][0] + 0.5], [1.5, dimensions[index][1] + 0.5]])
                     if mask_zero:
                         heatmap_ref_hits = np.ma.array(heatmap_ref_hits, mask=(heatmap_ref_hits == 0))
 
@@ -1104,12 +1125,6 @@ def plot_track_density(input_tracks_file, z_positions, dim_x, dim_y, pixel_size,
 
                     plot_ref_dut = False
 
-                offset, slope = np.column_stack((track_array['offset_0'], track_array['offset_1'], track_array['offset_2'])), np.column_stack((track_array['slope_0'], track_array['slope_1'], track_array['slope_2']))
-                intersection = offset + slope / slope[:, 2, np.newaxis] * (z_positions[actual_dut] - offset[:, 2, np.newaxis])  # intersection track with DUT plane
-
-                heatmap, _, _ = np.histogram2d(intersection[:, 0], intersection[:, 1], bins=(bin_x, bin_y), range=[[1.5, dimensions[index][0] + 0.5], [1.5, dimensions[index][1] + 0.5]])
-                heatmap_hits, _, _ = np.histogram2d(track_array['x_dut_%d' % actual_dut], track_array['y_dut_%d' % actual_dut], bins=(bin_x, bin_y), range=[[1.5, dimensions[index][0] + 0.5], [1.5, dimensions[index][1] + 0.5]])
-
                 # For better readability allow masking of entries that are zero
                 if mask_zero:
                     heatmap = np.ma.array(heatmap, mask=(heatmap == 0))
@@ -1145,7 +1160,7 @@ def plot_track_density(input_tracks_file, z_positions, dim_x, dim_y, pixel_size,
         return figs
 
 
-def plot_charge_distribution(input_track_candidates_file, dim_x, dim_y, pixel_size, mask_zero=True, use_duts=None, output_pdf_file=None):
+def plot_charge_distribution(input_track_candidates_file, dim_x, dim_y, pixel_size, mask_zero=True, use_duts=None, output_pdf_file=None, chunk_size=1000000):
     '''Takes the data and plots the charge distribution for selected DUTs.
 
     Parameters
@@ -1162,6 +1177,8 @@ def plot_charge_distribution(input_track_candidates_file, dim_x, dim_y, pixel_si
         DUTs that will be used for plotting. If None, all DUTs are used.
     output_pdf_file : string
         Filename of the output PDF file. If None, the filename is derived from the input file.
+    chunk_size : int
+        Chunk size of the data when reading from file.
     '''
     logging.info('Plotting charge distribution')
     if not output_pdf_file:
@@ -1192,13 +1209,19 @@ def plot_charge_distribution(input_track_candidates_file, dim_x, dim_y, pixel_si
                         continue
                     logging.info('Plot charge distribution for DUT%d', actual_dut)
 
-                    track_array = in_file_h5.root.TrackCandidates[:]
+                    # Get the charge range in a first pass, then histogram chunk wise
+                    n_bins_charge = int(np.amax([np.amax(track_array['charge_dut_%d' % actual_dut]) for track_array, _ in testbeam_analysis.tools.analysis_utils.data_aligned_at_events(in_file_h5.root.TrackCandidates, chunk_size=chunk_size)]))
 
-                    n_bins_charge = int(np.amax(track_array['charge_dut_%d' % actual_dut]))
-
-                    x_y_charge = np.column_stack((track_array['column_dut_%d' % actual_dut], track_array['row_dut_%d' % actual_dut], track_array['charge_dut_%d' % actual_dut]))
-                    hit_hist, _, _ = np.histogram2d(track_array['column_dut_%d' % actual_dut], track_array['row_dut_%d' % actual_dut], bins=(n_bin_x, n_bin_y), range=[[1.5, dimensions[index][0] + 0.5], [1.5, dimensions[index][1] + 0.5]])
-                    charge_distribution = np.histogramdd(x_y_charge, bins=(n_bin_x, n_bin_y, n_bins_charge), range=[[1.5, dimensions[index][0] + 0.5], [1.5, dimensions[index][1] + 0.5], [0, n_bins_charge]])[0]
+                    hit_hist, charge_distribution = None, None
+                    for track_array, _ in testbeam_analysis.tools.analysis_utils.data_aligned_at_events(in_file_h5.root.TrackCandidates, chunk_size=chunk_size):
+                        x_y_charge = np.column_stack((track_array['column_dut_%d' % actual_dut], track_array['row_dut_%d' % actual_dut], track_array['charge_dut_%d' % actual_dut]))
+                        actual_hit_hist, _, _ = np.histogram2d(track_array['column_dut_%d' % actual_dut], track_array['row_dut_%d' % actual_dut], bins=(n_bin_x, n_bin_y), range=[[1.5, dimensions[index][0] + 0.5], [1.5, dimensions[index][1] + 0.5]])
+                        actual_charge_distribution = np.histogramdd(x_y_charge, bins=(n_bin_x, n_bin_y, n_bins_charge), range=[[1.5, dimensions[index][0] + 0.5], [1.5, dimensions[index][1] + 0.5], [0, n_bins_charge]])[0]
+                        if hit_hist is None:
+                            hit_hist, charge_distribution = actual_hit_hist, actual_charge_distribution
+                        else:
+                            hit_hist += actual_hit_hist
+                            charge_distribution += actual_charge_distribution
 
                     charge_density = np.average(charge_distribution, axis=2, weights=range(0, n_bins_charge)) * sum(range(0, n_bins_charge)) / hit_hist.astype(float)
                     charge_density = np.ma.masked_invalid(charge_density)
@@ -1327,6 +1350,61 @@ def efficiency_plots(hit_hist, track_density, track_density_with_DUT_hit, effici
         logging.warning('Cannot create efficiency plots, all pixels are masked')
 
 
+def purity_plots(pure_hit_hist, hit_hist, purity, actual_dut, minimum_hit_density, plot_range, cut_distance, mask_zero=True, output_pdf=None):
+    if not output_pdf:
+        return
+
+    # get number of entries for every histogram
+    n_pure_hit_hist = np.count_nonzero(pure_hit_hist)
+    n_hits_hit_hist = np.count_nonzero(hit_hist)
+    n_hits_purity = np.count_nonzero(purity)
+
+    # for better readability allow masking of entries that are zero
+    if mask_zero:
+        pure_hit_hist = np.ma.array(pure_hit_hist, mask=(pure_hit_hist == 0))
+        hit_hist = np.ma.array(hit_hist, mask=(hit_hist == 0))
+
+    fig = Figure()
+    _ = FigureCanvas(fig)
+    ax = fig.add_subplot(111)
+    plot_2d_pixel_hist(fig, ax, hit_hist.T, plot_range, title='Hit density for DUT%d (%d Hits)' % (actual_dut, n_hits_hit_hist), x_axis_title="column [um]", y_axis_title="row [um]")
+    fig.tight_layout()
+    output_pdf.savefig(fig)
+
+    fig = Figure()
+    _ = FigureCanvas(fig)
+    ax = fig.add_subplot(111)
+    plot_2d_pixel_hist(fig, ax, pure_hit_hist.T, plot_range, title='Pure hit density for DUT%d (%d Pure Hits, cut distance %d um)' % (actual_dut, n_pure_hit_hist, cut_distance), x_axis_title="column [um]", y_axis_title="row [um]")
+    fig.tight_layout()
+    output_pdf.savefig(fig)
+
+    if np.any(~purity.mask):
+        fig = Figure()
+        _ = FigureCanvas(fig)
+        ax = fig.add_subplot(111)
+        z_min = np.ma.min(purity)
+        if z_min == 100.:  # One cannot plot with 0 z axis range
+            z_min = 90.
+        plot_2d_pixel_hist(fig, ax, purity.T, plot_range, title='Purity for DUT%d (%d Entries)' % (actual_dut, n_hits_purity), x_axis_title="column [um]", y_axis_title="row [um]", z_min=z_min, z_max=100.)
+        fig.tight_layout()
+        output_pdf.savefig(fig)
+
+        fig = Figure()
+        _ = FigureCanvas(fig)
+        ax = fig.add_subplot(111)
+        ax.grid()
+        ax.set_title('Purity per pixel for DUT%d: %1.4f +- %1.4f' % (actual_dut, np.ma.mean(purity), np.ma.std(purity)))
+        ax.set_xlabel('Purity [%]')
+        ax.set_ylabel('#')
+        ax.set_yscale('log')
+        ax.set_xlim([-0.5, 101.5])
+        ax.hist(purity.ravel()[purity.ravel().mask != 1], bins=101, range=(0, 100))  # Histogram not masked pixel purity
+        fig.tight_layout()
+        output_pdf.savefig(fig)
+    else:
+        logging.warning('Cannot create purity plots, all pixels with less than %d hits are masked', minimum_hit_density)
+
+
 def plot_track_angle(input_track_angle_file, output_pdf_file=None, dut_names=None):
     ''' Plot track slopes.
 
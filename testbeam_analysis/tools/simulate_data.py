@@ -19,9 +19,12 @@ import logging
 import progressbar
 from numba import njit
 import math
+from multiprocessing import Pool, cpu_count
 import pylandau
 
 from testbeam_analysis.tools import geometry_utils
+from testbeam_analysis.tools import smc
+from testbeam_analysis.tools import storage
 
 
 logging.basicConfig(
@@ -428,7 +431,27 @@ class SimulateData(object):
         self._hit_files = None
 
     def create_data_and_store(self, base_file_name, n_events,
-                              chunk_size=100000):
+                              chunk_size=100000, parallel=False, n_cores=None):
+        ''' Simulates n_events and stores the hits of each DUT into a file.
+
+        Parameters
+        ----------
+        base_file_name : string
+            Base file name of the output files, the suffix _DUTn.h5 is added.
+        n_events : int
+            Number of events to simulate.
+        chunk_size : int
+            Number of events simulated at once.
+        parallel : bool
+            If True, the event chunks are simulated on a process pool. Each
+            chunk uses its own random number stream derived from the random
+            seed and the chunk index. Thus the result only depends on the seed
+            and the chunk size and not on the number of cores, but differs from
+            the serial simulation.
+        n_cores : int, None
+            Number of processes for the parallel simulation.
+            If None use all available cores.
+        '''
         logging.info('Simulate %d events with %d DUTs', n_events, self._n_duts)
 
         # Special case: all events can be created at once
@@ -438,38 +461,65 @@ class SimulateData(object):
         # Create output h5 files with emtpy hit ta
         output_files = []
         hit_tables = []
-        for dut_index in range(self._n_duts):
-            output_files.append(
-                tb.open_file(base_file_name + '_DUT%d.h5' % dut_index, 'w'))
-            hit_tables.append(output_files[dut_index].create_table(output_files[dut_index].root, name='Hits', description=self._hit_dtype,
-                                                                   title='Simulated hits for test beam analysis', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False)))
-
-        if n_events * self.tracks_per_event > 100000:
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(
-                marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=len(range(0, n_events, chunk_size)), term_width=80)
-            progress_bar.start()
-        # Fill output files in chunks
-        for chunk_index, _ in enumerate(range(0, n_events, chunk_size)):
-            actual_events, actual_digitized_hits = self._create_data(
-                start_event_number=chunk_index * chunk_size, n_events=chunk_size)
+        pool = None
+        try:
             for dut_index in range(self._n_duts):
-                actual_dut_events, actual_dut_hits = actual_events[
-                    dut_index], actual_digitized_hits[dut_index]
-                actual_hits = np.zeros(
-                    shape=actual_dut_events.shape[0], dtype=self._hit_dtype)
-                actual_hits['event_number'] = actual_dut_events
-                actual_hits['column'] = actual_dut_hits.T[0]
-                actual_hits['row'] = actual_dut_hits.T[1]
-                actual_hits['charge'] = actual_dut_hits.T[
-                    2] / 10.  # One charge LSB corresponds to 10 electrons
-                hit_tables[dut_index].append(actual_hits)
-            if n_events * self.tracks_per_event > 100000:
-                progress_bar.update(chunk_index)
-        if n_events * self.tracks_per_event > 100000:
-            progress_bar.finish()
+                output_files.append(
+                    tb.open_file(base_file_name + '_DUT%d.h5' % dut_index, 'w'))
+                hit_tables.append(output_files[dut_index].create_table(output_files[dut_index].root, name='Hits', description=self._hit_dtype,
+                                                                       title='Simulated hits for test beam analysis', filters=storage.get_filters('hits'), chunkshape=storage.get_chunkshape('hits')))
 
-        for output_file in output_files:
-            output_file.close()
+            if n_events * self.tracks_per_event > 100000:
+                progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(
+                    marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=len(range(0, n_events, chunk_size)), term_width=80)
+                progress_bar.start()
+            # Fill output files in chunks
+            if not parallel:
+                chunks = ((chunk_index, self._create_hits(start_event_number=chunk_index * chunk_size, n_events=chunk_size))
+                          for chunk_index, _ in enumerate(range(0, n_events, chunk_size)))
+            else:  # Simulate the chunks in parallel, the hits are stored in the order of the chunks while the next chunks are simulated
+                pool = Pool(n_cores)
+                n_pending = n_cores if n_cores else cpu_count()
+                chunks = ((chunk_index, chunk_hits.get()) for chunk_index, chunk_hits in smc.pipelined(items=range(len(range(0, n_events, chunk_size))),
+                                                                                                         submit=lambda chunk_index: pool.apply_async(_create_hits_chunk, (self, chunk_index, chunk_size)),
+                                                                                                         n_pending=n_pending))
+            for chunk_index, actual_hits in chunks:
+                for dut_index in range(self._n_duts):
+                    hit_tables[dut_index].append(actual_hits[dut_index])
+                if n_events * self.tracks_per_event > 100000:
+                    progress_bar.update(chunk_index)
+            if n_events * self.tracks_per_event > 100000:
+                progress_bar.finish()
+        except Exception:
+            if pool is not None:  # Do not wait for the pending chunks
+                pool.terminate()
+                pool.join()
+                pool = None
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            for output_file in output_files:
+                output_file.close()
+
+    def _create_hits(self, start_event_number, n_events, shuffle_seed=None):
+        ''' Creates the hit tables of all DUTs for n_events starting at start_event_number '''
+        actual_events, actual_digitized_hits = self._create_data(
+            start_event_number=start_event_number, n_events=n_events, shuffle_seed=shuffle_seed)
+        hits = []
+        for dut_index in range(self._n_duts):
+            actual_dut_events, actual_dut_hits = actual_events[
+                dut_index], actual_digitized_hits[dut_index]
+            actual_hits = np.zeros(
+                shape=actual_dut_events.shape[0], dtype=self._hit_dtype)
+            actual_hits['event_number'] = actual_dut_events
+            actual_hits['column'] = actual_dut_hits.T[0]
+            actual_hits['row'] = actual_dut_hits.T[1]
+            actual_hits['charge'] = actual_dut_hits.T[
+                2] / 10.  # One charge LSB corresponds to 10 electrons
+            hits.append(actual_hits)
+        return hits
 
     def _create_tracks(self, n_tracks):
         '''Creates tracks with gaussian distributed angles at gaussian distributed positions at z=0.
@@ -781,7 +831,7 @@ class SimulateData(object):
 
         return (event_numbers, digitized_hits)
 
-    def _create_data(self, start_event_number=0, n_events=10000):
+    def _create_data(self, start_event_number=0, n_events=10000, shuffle_seed=None):
         # Calculate the number of tracks per event
         if self.tracks_per_event_sigma > 0:
             n_tracks_per_event = np.random.normal(
@@ -814,10 +864,12 @@ class SimulateData(object):
 
         # Suffle event hits to simulate unordered hit data per trigger
         if self.digitization_shuffle_hits:
+            if shuffle_seed is None:
+                shuffle_seed = self.random_seed
             for index, actual_dut_hits in enumerate(hits):
                 # + Index is a trick to shuffle different for each device
                 hits[index] = shuffle_event_hits(
-                    event_number, n_tracks_per_event, actual_dut_hits, self.random_seed + index)
+                    event_number, n_tracks_per_event, actual_dut_hits, shuffle_seed + index)
 
         # Create detector response: digitized hits
         hits_digitized = self._digitize_hits(event_number, hits)
@@ -859,6 +911,19 @@ class SimulateData(object):
             return 0
         return 13.6 / self.beam_momentum * charge_number * np.sqrt(material_budget) * (1 + 0.038 * np.log(material_budget))
 
+
+def _create_hits_chunk(simulate_data, chunk_index, chunk_size):
+    ''' Creates the hits of one event chunk in a worker process.
+
+    The random number stream is seeded from the random seed and the chunk index,
+    thus the result does not depend on the process or on the other chunks.
+    '''
+    np.random.seed([simulate_data.random_seed, chunk_index])
+    # Seed for the jitted hit shuffling, that uses its own random state
+    shuffle_seed = np.random.randint(0, 2 ** 31 - simulate_data.n_duts)
+    return simulate_data._create_hits(start_event_number=chunk_index * chunk_size, n_events=chunk_size, shuffle_seed=shuffle_seed)
+
+
 if __name__ == '__main__':
     simulate_data = SimulateData(0)
     simulate_data.dut_material_budget = [0] * simulate_data.n_duts
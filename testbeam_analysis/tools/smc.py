@@ -4,13 +4,14 @@ from __future__ import division
 import os
 import shutil
 import tempfile
-from collections import Iterable
+from collections import Iterable, deque
 from multiprocessing import Pool, cpu_count
 
 import dill
-import numpy as np
 import tables as tb
 
+from testbeam_analysis.tools import analysis_utils
+
 
 def apply_async(pool, fun, args=None, **kwargs):
     ''' Run fun(*args, **kwargs) in different process.
@@ -35,6 +36,37 @@ def _run_with_dill(payload):
         return fun(**kwargs)
 
 
+def pipelined(items, submit, n_pending=1):
+    ''' Submits items for asynchronous processing and yields them in order with their pending results.
+
+    While the caller handles the result of one item (e.g. writes it to file)
+    the next n_pending items are already submitted (e.g. read from file and
+    processed on a pool). Thus reading, processing and writing overlap, while
+    the number of items held in memory is bounded.
+
+    Parameters
+    ----------
+    items : iterable
+        Items to process, e.g. chunks read from a table. Consumed lazily.
+    submit : function
+        Called with each item, returns the pending result (e.g. a
+        multiprocessing AsyncResult).
+    n_pending : int
+        Number of items submitted ahead of the item yielded to the caller.
+
+    Returns
+    -------
+    Generator of (item, pending result) tuples in the order of the items.
+    '''
+    pending = deque()
+    for item in items:
+        pending.append((item, submit(item)))
+        if len(pending) > n_pending:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
 class SMC(object):
 
     def __init__(self, table_file_in, file_out,
@@ -77,16 +109,26 @@ class SMC(object):
             chunk_size : int
                 Chunk size of the data when reading from file.
 
+            Attributes:
+            -----------
+            aux_data : array, None
+                If the function returns a tuple (data, histogram) the data
+                is stored as usual and the histograms of all chunks are
+                added up. The resulting histogram is accessible here.
+                Allows to fill a histogram in the same pass the table is
+                created. None if the function returns no histogram.
+
             Notes:
             ------
             It follows the split, apply, combine paradigm:
             - split: data is splitted into chunks for multiple processes for
               speed increase
-            - map: the function is called on each chunk. If the chunk per core
-              is still too large to fit in memory it is chunked further. The
-              result is written to a table per core.
-            - combine: the tables are merged into one result table or one
+            - map: the function is called on each chunk. The result is
+              returned to the main process.
+            - combine: the results are written into one result table or one
                        result histogram depending on the output data format
+                       while the next chunks are processed. No temporary
+                       files are needed.
             '''
 
         # Set parameters
@@ -95,9 +137,10 @@ class SMC(object):
         self.n_cores = n_cores
         self.align_at = align_at
         self.func = func
-        self.node_desc = node_desc
+        self.node_desc = dict(node_desc)  # Copy, the defaults are added below
         self.chunk_size = chunk_size
         self.func_kwargs = func_kwargs
+        self.aux_data = None
 
         if self.align_at and self.align_at != 'event_number':
             raise NotImplementedError('Data alignment is only supported '
@@ -141,205 +184,119 @@ class SMC(object):
             if self.n_rows < 2. * self.chunk_size:
                 self.n_cores = 1
 
-        # The three main steps
+        # The three main steps, the results are combined while mapping
         self._split()
         self._map()
-        self._combine()
 
     def _split(self):
         self.start_i, self.stop_i = self._get_split_indeces()
         assert len(self.start_i) == len(self.stop_i)
 
     def _map(self):
-        chunk_size_per_core = int(self.chunk_size / self.n_cores)
+        # The results are written to a temporary file if the output file is
+        # the input file, since the input table is read during the map step
+        in_place = os.path.abspath(self.file_out) == os.path.abspath(self.table_file_in)
+        if in_place:
+            output_file = tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(os.path.abspath(self.file_out)))
+            output_file.close()
+            file_out = output_file.name
+        else:
+            file_out = self.file_out
+
         if self.n_cores == 1:
-            self.tmp_files = [self._work(self.table_file_in,
-                                         self.node_name,
-                                         self.func,
-                                         self.func_kwargs,
-                                         self.node_desc,
-                                         self.start_i[0],
-                                         self.stop_i[0],
-                                         chunk_size_per_core)]
+            _init_worker(dill.dumps((self.func, self.func_kwargs)))
+            results = (_work(self.table_file_in, self.node_name, start_i, stop_i) for start_i, stop_i in zip(self.start_i, self.stop_i))
+            self._combine(results, file_out)
         else:
-            # Run function in parallel
-            pool = Pool(self.n_cores)
-
-            jobs = []
-            for i in range(self.n_cores):
-                job = apply_async(pool=pool,
-                                  fun=self._work,
-                                  table_file_in=self.table_file_in,
-                                  node_name=self.node_name,
-                                  func=self.func,
-                                  func_kwargs=self.func_kwargs,
-                                  node_desc=self.node_desc,
-                                  start_i=self.start_i[i],
-                                  stop_i=self.stop_i[i],
-                                  chunk_size=chunk_size_per_core
-                                  )
-                jobs.append(job)
-
-            # Gather results
-            self.tmp_files = []
-            for job in jobs:
-                self.tmp_files.append(job.get())
+            # Run function in parallel, the function is send once to each
+            # worker and not with every chunk
+            pool = Pool(self.n_cores,
+                        initializer=_init_worker,
+                        initargs=(dill.dumps((self.func, self.func_kwargs)),))
+            # Results are returned in the order of the chunks and are
+            # written while the next chunks are processed, one chunk per
+            # core is processed ahead to limit the memory of pending results
+            chunks = pipelined(items=zip(self.start_i, self.stop_i),
+                               submit=lambda indeces: pool.apply_async(_work, (self.table_file_in, self.node_name) + tuple(indeces)),
+                               n_pending=self.n_cores)
+            results = (result.get() for _, result in chunks)
+            self._combine(results, file_out)
 
             pool.close()
             pool.join()
 
             del pool
 
-    def _work(self, table_file_in, node_name, func, func_kwargs,
-              node_desc, start_i, stop_i, chunk_size):
-        ''' Defines the work per worker.
+        if in_place:
+            shutil.move(file_out, self.file_out)
 
-        Reads data, applies the function and stores data in chunks into a table
-        or a histogram.
-        '''
+    def _combine(self, results, file_out):
+        ''' Stores the results of all chunks into one table or one histogram.
 
-        with tb.open_file(table_file_in, 'r') as in_file:
-            node = in_file.get_node(in_file.root, node_name)
-
-            output_file = tempfile.NamedTemporaryFile(delete=False, dir=os.getcwd())
-            with tb.open_file(output_file.name, 'w') as out_file:
-                # Create result table with specified data format
-                # From given pytables tables description
-                if 'description' in node_desc:
-                    table_out = out_file.create_table(out_file.root,
-                                                      **node_desc)
-                # Data format unknown and has to be determined later
-                # and thus the table has to be created later
-                else:
-                    table_out = None
-                # Create result histogram
-                hist_out = None
-
-                for data, _ in self._chunks_at_event(table=node,
-                                                     start_index=start_i,
-                                                     stop_index=stop_i,
-                                                     chunk_size=chunk_size):
-
-                    data_ret = func(data, **func_kwargs)
-                    # Create table if not existing
-                    # Extract table description from returned data
-                    if not table_out:
-                        if data_ret.dtype.names:  # Recarray thus table needed
-                            dcr = data_ret.dtype
-                            table_out = out_file.create_table(out_file.root,
-                                                              description=dcr,
-                                                              **node_desc)
-                        # Create histogram if data is not a table
-                        elif hist_out is None:
-                            # Copy needed for reshape
-                            hist_out = data_ret.copy()
-                            continue
-
-                    if table_out is not None:
-                        table_out.append(data_ret)  # Tables are appended
+        The results are appended to the table in the order of the chunks.
+        Histograms and additional histograms are added up.
+        '''
+        with tb.open_file(file_out, 'w') as out_file:
+            # Create result table with specified data format
+            # From given pytables tables description
+            if 'description' in self.node_desc:
+                table_out = out_file.create_table(out_file.root,
+                                                  **self.node_desc)
+            # Data format unknown and has to be determined later
+            # and thus the table has to be created later
+            else:
+                table_out = None
+            # Create result histogram
+            hist_out = None
+
+            for data_ret, aux_ret in results:
+                # Add up additional histograms
+                if aux_ret is not None:
+                    if self.aux_data is None:
+                        # Copy needed for reshape
+                        self.aux_data = aux_ret.copy()
                     else:
-                        # Check if array needs to be enlarged
-                        shape = []
-                        # Loop over dimension
-                        for i in range(len(hist_out.shape)):
-                            if hist_out.shape[i] < data_ret.shape[i]:
-                                shape.append(data_ret.shape[i])
-                            else:
-                                shape.append(hist_out.shape[i])
-
-                        hist_out.resize(shape)
-
-                        # Add array, ignore size
-                        data_ret.resize(hist_out.shape)
-                        hist_out += data_ret
-
-                if hist_out is not None:
-                    # Store histogram to file
-                    dt = hist_out.dtype
-                    out = out_file.create_carray(out_file.root,
-                                                 atom=tb.Atom.from_dtype(dt),
-                                                 shape=hist_out.shape,
-                                                 **node_desc)
-                    out[:] = hist_out
-
-        return output_file.name
-
-    def _combine(self):
-        # Try to set output node name if defined
-        try:
-            node_name = self.node_desc['name']
-        except KeyError:
-            # Output node name set to input node name
-            node_name = self.node_name
-
-        # Check data type to decide on combine procedure
-        data_type = 'table'
-        with tb.open_file(self.tmp_files[0], 'r') as in_file:
-            node = in_file.get_node(in_file.root, node_name)
-            if type(node) is tb.carray.CArray:
-                data_type = 'array'
-
-        if data_type == 'table':
-            # Use first tmp file as result file
-            shutil.move(self.tmp_files[0], self.file_out)
-
-            with tb.open_file(self.file_out, 'r+') as out_file:
-                node = out_file.get_node(out_file.root, node_name)
-                for f in self.tmp_files[1:]:
-                    with tb.open_file(f) as in_file:
-                        tmp_node = in_file.get_node(in_file.root, node_name)
-                        for i in range(0, tmp_node.shape[0], self.chunk_size):
-                            node.append(tmp_node[i: i + self.chunk_size])
-                    os.remove(f)
-        else:  # TODO: solution without having all hists in RAM
-            # Only one file, merging not needed
-            if len(self.tmp_files) == 1:
-                shutil.move(self.tmp_files[0], self.file_out)
-            else:  # Several files, merge them by adding up
-                with tb.open_file(self.file_out, 'w') as out_file:
-                    hist_data = None
-                    for f in self.tmp_files:
-                        with tb.open_file(f) as in_file:
-                            tmp_data = in_file.get_node(in_file.root, node_name)[:]
-                            if hist_data is None:
-                                # Copy needed for reshape
-                                hist_data = tmp_data.copy()
-                            else:
-                                # Check if array needs to be enlarged
-                                shape = []
-                                # Loop over dimension
-                                for i in range(len(hist_data.shape)):
-                                    if hist_data.shape[i] < tmp_data.shape[i]:
-                                        shape.append(tmp_data.shape[i])
-                                    else:
-                                        shape.append(hist_data.shape[i])
-
-                                hist_data.resize(shape)
-
-                                # Add array, ignore size
-                                tmp_data.resize(hist_data.shape)
-                                hist_data += tmp_data
-                        os.remove(f)
-
-                    dt = hist_data.dtype
-                    out = out_file.create_carray(out_file.root,
-                                                 atom=tb.Atom.from_dtype(dt),
-                                                 shape=hist_data.shape,
-                                                 **self.node_desc)
-                    out[:] = hist_data
+                        self.aux_data = _add_hist(self.aux_data, aux_ret)
+                # Create table if not existing
+                # Extract table description from returned data
+                if not table_out:
+                    if data_ret.dtype.names:  # Recarray thus table needed
+                        dcr = data_ret.dtype
+                        table_out = out_file.create_table(out_file.root,
+                                                          description=dcr,
+                                                          **self.node_desc)
+                    # Create histogram if data is not a table
+                    elif hist_out is None:
+                        # Copy needed for reshape
+                        hist_out = data_ret.copy()
+                        continue
+
+                if table_out is not None:
+                    table_out.append(data_ret)  # Tables are appended
+                else:
+                    hist_out = _add_hist(hist_out, data_ret)
+
+            if hist_out is not None:
+                # Store histogram to file
+                dt = hist_out.dtype
+                out = out_file.create_carray(out_file.root,
+                                             atom=tb.Atom.from_dtype(dt),
+                                             shape=hist_out.shape,
+                                             **self.node_desc)
+                out[:] = hist_out
 
     def _get_split_indeces(self):
-        ''' Calculates the data range for each core.
+        ''' Calculates the data range for each chunk.
 
             Return two lists with start/stop indeces.
             Stop indeces are exclusive.
         '''
 
-        core_chunk_size = self.n_rows // self.n_cores
+        # Memory usage is the same as reading chunk_size rows in one process
+        chunk_size_per_core = max(1, self.chunk_size // self.n_cores)
         start_indeces = list(range(0,
                                    self.n_rows,
-                                   core_chunk_size)
-                             [:self.n_cores])
+                                   chunk_size_per_core))
 
         if not self.align_at:
             stop_indeces = start_indeces[1:]
@@ -349,95 +306,73 @@ class SMC(object):
 
         stop_indeces.append(self.n_rows)  # Last index always table size
 
-        assert len(stop_indeces) == self.n_cores
-        assert len(start_indeces) == self.n_cores
-
         return start_indeces, stop_indeces
 
     def _get_next_index(self, indeces):
         ''' Get closest index where the alignment column changes '''
 
         next_indeces = []
-        for index in indeces[1:]:
-            with tb.open_file(self.table_file_in) as in_file:
-                node = in_file.get_node(in_file.root, self.node_name)
-                values = node[index:index + self.chunk_size][self.align_at]
-                value = values[0]
-                for i, v in enumerate(values):
-                    if v != value:
-                        next_indeces.append(index + i)
-                        break
-                    value = v
+        with tb.open_file(self.table_file_in) as in_file:
+            node = in_file.get_node(in_file.root, self.node_name)
+            for index in indeces[1:]:
+                if next_indeces and next_indeces[-1] > index:  # Event spans more than one chunk
+                    continue
+                value = node.read(start=index, stop=index + 1)[self.align_at][0]
+                # Binary search for the first index with a larger value
+                next_index = analysis_utils.searchsorted_event_number(node, value, side='right', start_index=index)
+                if next_index < self.n_rows:
+                    next_indeces.append(next_index)
 
         return next_indeces
 
-    def _chunks_at_event(self, table, start_index=None, stop_index=None,
-                         chunk_size=1000000):
-        '''Takes the table with a event_number column and returns chunks.
-
-        The chunks are chosen in a way that the events are not splitted.
-        Start and the stop indices limiting the table size can be specified to
-        improve performance. The event_number column must be sorted.
-
-        Parameters
-        ----------
-        table : pytables.table
-            The data.
-        start_index : int
-            Start index of data. If None, no limit is set.
-        stop_index : int
-            Stop index of data. If None, no limit is set.
-        chunk_size : int
-            Maximum chunk size per read.
-
-        Returns
-        -------
-        Iterator of tuples
-            Data of the actual data chunk and start index for the next chunk.
-
-        Example
-        -------
-        for data, index in chunk_aligned_at_events(table):
-            do_something(data)
-            show_progress(index)
-        '''
 
-        # Initialize variables
-        if not start_index:
-            start_index = 0
-        if not stop_index:
-            stop_index = table.shape[0]
-
-        # Limit max index
-        if stop_index > table.shape[0]:
-            stop_index = table.shape[0]
-
-        # Special case, one read is enough, data not bigger than one chunk and
-        # the indices are known
-        if start_index + chunk_size >= stop_index:
-            yield table.read(start=start_index, stop=stop_index), stop_index
-        else:  # Read data in chunks, chunks do not divide events
-            current_start_index = start_index
-            while current_start_index < stop_index:
-                current_stop_index = min(current_start_index + chunk_size,
-                                         stop_index)
-                chunk = table[current_start_index:current_stop_index]
-                if current_stop_index == stop_index:  # Last chunk
-                    yield chunk, stop_index
-                    break
-
-                # Find maximum non event number splitting index
-                event_numbers = chunk["event_number"]
-                last_event = event_numbers[-1]
-
-                # Search for next event number
-                chunk_stop_i = np.searchsorted(event_numbers,
-                                               last_event,
-                                               side="left")
-
-                yield chunk[:chunk_stop_i], current_start_index + chunk_stop_i
-
-                current_start_index += chunk_stop_i
+def _init_worker(payload):
+    ''' Sets the function and the function kwargs of the worker.
+
+    The payload is the dill pickled function plus keyword arguments.
+    '''
+    global _worker_func, _worker_func_kwargs
+    _worker_func, _worker_func_kwargs = dill.loads(payload)
+
+
+def _work(table_file_in, node_name, start_i, stop_i):
+    ''' Defines the work per chunk.
+
+    Reads data, applies the function and returns the result and an
+    additional histogram (None if not returned by the function).
+    '''
+    with tb.open_file(table_file_in, 'r') as in_file:
+        node = in_file.get_node(in_file.root, node_name)
+        data = node.read(start=start_i, stop=stop_i)
+
+    data_ret = _worker_func(data, **_worker_func_kwargs)
+    # Additional histogram returned
+    if isinstance(data_ret, tuple):
+        return data_ret
+    return data_ret, None
+
+
+def _add_hist(hist, other_hist):
+    ''' Adds two histograms of possibly different shapes.
+
+    The first histogram is enlarged if needed and returned.
+    '''
+    # Check if array needs to be enlarged
+    shape = []
+    # Loop over dimension
+    for i in range(len(hist.shape)):
+        if hist.shape[i] < other_hist.shape[i]:
+            shape.append(other_hist.shape[i])
+        else:
+            shape.append(hist.shape[i])
+
+    hist.resize(shape)
+
+    # Add array, ignore size
+    other_hist = other_hist.copy()
+    other_hist.resize(hist.shape)
+    hist += other_hist
+    return hist
 
 
 if __name__ == '__main__':
@@ -0,0 +1,156 @@
+''' Storage settings of the tables and arrays created by the analysis.
+
+All analysis functions take the compression filters and the chunk shapes of the nodes they create
+from the active storage policy. The policy sets a compression preset per node type, e.g. fast
+compression for the tracklets and track candidates that are only needed once and high compression
+for the fitted tracks that are kept. The default policy uses blosc with compression level 5 for all nodes.
+'''
+from __future__ import division
+
+import os
+import logging
+import shutil
+import tempfile
+import time
+
+import tables as tb
+
+# Compression presets, the values are pytables filter settings
+PRESETS = {
+    'default': {'complib': 'blosc', 'complevel': 5, 'shuffle': True},
+    'scratch': {'complib': 'blosc:lz4', 'complevel': 1, 'shuffle': True},  # Fast compression for files that are read only once
+    'uncompressed': {'complib': 'blosc', 'complevel': 0, 'shuffle': False},
+    'archive': {'complib': 'blosc:zstd', 'complevel': 9, 'shuffle': True}  # Small files for long term storage
+}
+
+# Node types of the analysis
+NODE_TYPES = ('hits', 'cluster', 'merged', 'tracklets', 'track_candidates', 'tracks', 'alignment', 'histogram')
+
+
+class StoragePolicy(object):
+    ''' Compression and chunk shape settings per node type.
+
+    Parameters
+    ----------
+    preset : string, dict
+        The compression preset of all node types without own preset. A name of PRESETS or a dict with pytables filter settings.
+    presets : dict
+        The compression preset (name or dict) per node type, e.g. {'tracklets': 'scratch', 'tracks': 'archive'}.
+    chunkshapes : dict
+        The chunk shape (number of rows) of the tables per node type. Not given node types use the pytables default.
+    blosc_threads : int
+        Number of threads blosc uses to compress and decompress. If None, the pytables default is used.
+    '''
+
+    def __init__(self, preset='default', presets=None, chunkshapes=None, blosc_threads=None):
+        self.preset = preset
+        self.presets = presets if presets else {}
+        self.chunkshapes = chunkshapes if chunkshapes else {}
+        self.blosc_threads = blosc_threads
+        for node_type in list(self.presets) + list(self.chunkshapes):
+            if node_type not in NODE_TYPES:
+                raise ValueError('Node type "%s" not recognized!' % node_type)
+        for actual_preset in [self.preset] + list(self.presets.values()):
+            if not isinstance(actual_preset, dict) and actual_preset not in PRESETS:
+                raise ValueError('Preset "%s" not recognized!' % actual_preset)
+
+    def get_filters(self, node_type):
+        ''' Returns the pytables filters of a node type. '''
+        preset = self.presets.get(node_type, self.preset)
+        if not isinstance(preset, dict):
+            preset = PRESETS[preset]
+        return tb.Filters(fletcher32=False, **preset)
+
+    def get_chunkshape(self, node_type):
+        ''' Returns the chunk shape of the tables of a node type. None means the pytables default. '''
+        return self.chunkshapes.get(node_type, None)
+
+
+_storage_policy = StoragePolicy()
+
+
+def set_storage_policy(storage_policy):
+    ''' Sets the storage policy used for all nodes created afterwards. If None, the default policy is used. '''
+    global _storage_policy
+    _storage_policy = storage_policy if storage_policy is not None else StoragePolicy()
+    if _storage_policy.blosc_threads is not None:
+        tb.set_blosc_max_threads(_storage_policy.blosc_threads)
+
+
+def get_storage_policy():
+    ''' Returns the active storage policy. '''
+    return _storage_policy
+
+
+def get_filters(node_type):
+    ''' Returns the pytables filters of a node type from the active storage policy. '''
+    return _storage_policy.get_filters(node_type)
+
+
+def get_chunkshape(node_type):
+    ''' Returns the chunk shape of the tables of a node type from the active storage policy. '''
+    return _storage_policy.get_chunkshape(node_type)
+
+
+def benchmark_presets(input_file, node_name=None, presets=None, chunkshape=None, max_rows=10000000, chunk_size=1000000):
+    '''Measures the write and read throughput and the compression ratio of compression presets on a table.
+
+    The table is written with each preset to a temporary file and read back in chunks.
+
+    Parameters
+    ----------
+    input_file : string
+        Filename of the file with the table, e.g. a track candidates file.
+    node_name : string
+        Name of the table. If None, the first table in the file is used.
+    presets : iterable
+        Names of PRESETS or dicts with pytables filter settings. If None, all PRESETS are benchmarked.
+    chunkshape : int
+        The chunk shape of the written tables. If None, the pytables default is used.
+    max_rows : int
+        Maximum number of rows to benchmark with.
+    chunk_size : int
+        Number of rows that are written and read at once.
+
+    Returns
+    -------
+    list of dicts
+        The preset, the write and read speed in MB/s of uncompressed data and the compression ratio for each preset.
+    '''
+    if presets is None:
+        presets = sorted(PRESETS)
+
+    with tb.open_file(input_file, mode='r') as in_file_h5:
+        node = in_file_h5.get_node(in_file_h5.root, node_name) if node_name else next(iter(in_file_h5.walk_nodes(in_file_h5.root, classname='Table')))
+        data = node.read(0, max_rows)
+    n_bytes = data.nbytes
+
+    results = []
+    tmp_folder = tempfile.mkdtemp()
+    try:
+        for preset in presets:
+            tmp_file = os.path.join(tmp_folder, 'benchmark.h5')
+            filters = StoragePolicy(preset=preset).get_filters(None)
+            start_time = time.time()
+            with tb.open_file(tmp_file, mode='w') as out_file_h5:
+                table = out_file_h5.create_table(out_file_h5.root, name='Table', description=data.dtype, filters=filters, chunkshape=chunkshape, expectedrows=data.shape[0])
+                for index in range(0, data.shape[0], chunk_size):
+                    table.append(data[index:index + chunk_size])
+            write_time = time.time() - start_time
+            start_time = time.time()
+            with tb.open_file(tmp_file, mode='r') as out_file_h5:
+                for index in range(0, data.shape[0], chunk_size):
+                    out_file_h5.root.Table.read(index, index + chunk_size)
+            read_time = time.time() - start_time
+            results.append({'preset': preset,
+                            'write_speed': n_bytes / 1e6 / max(write_time, 1e-9),
+                            'read_speed': n_bytes / 1e6 / max(read_time, 1e-9),
+                            'compression_ratio': n_bytes / os.path.getsize(tmp_file)})
+            os.remove(tmp_file)
+    finally:
+        shutil.rmtree(tmp_folder)
+
+    for result in results:
+        logging.info('%-20s write %8.1f MB/s, read %8.1f MB/s, compression ratio %5.1f', result['preset'], result['write_speed'], result['read_speed'], result['compression_ratio'])
+
+    return results
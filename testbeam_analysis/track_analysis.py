@@ -20,9 +20,10 @@ from testbeam_analysis.tools import smc
 from testbeam_analysis.tools import analysis_utils
 from testbeam_analysis.tools import geometry_utils
 from testbeam_analysis.tools import kalman
+from testbeam_analysis.tools import storage
 
 
-def find_tracks(input_tracklets_file, input_alignment_file, output_track_candidates_file, min_cluster_distance=False, chunk_size=1000000):
+def find_tracks(input_tracklets_file, input_alignment_file, output_track_candidates_file, min_cluster_distance=False, use_grid=False, chunk_size=1000000):
     '''Takes first DUT track hit and tries to find matching hits in subsequent DUTs.
     The output is the same array with resorted hits into tracks. A track quality is set to
     be able to cut on good (less scattered) tracks.
@@ -47,6 +48,10 @@ def find_tracks(input_tracklets_file, input_alignment_file, output_track_candida
         e.g.: For two devices: min_cluster_distance = (50, 250)
         If false the cluster distance is not considered.
         The events where any plane does have hits < min_cluster_distance is flagged with n_tracks = -1
+    use_grid : bool
+        If True, the closest DUT hit of each track is searched in a grid of the DUT hit positions with cells of two
+        correlation sigmas instead of comparing all hits of an event. Only hits within two sigma are assigned to tracks then.
+        Much faster for events with many tracks (e.g. Mimosa26 telescopes at high rates).
     chunk_size : uint
         Chunk size of the data when reading from file.
     '''
@@ -80,55 +85,46 @@ def find_tracks(input_tracklets_file, input_alignment_file, output_track_candida
 
     def work(tracklets_data_chunk):
         ''' Track finding per cpu core '''
-        # Prepare hit data for track finding, create temporary arrays for x, y, z position and charge data
+        # Prepare hit data for track finding, get arrays with shape (n_rows, n_duts) for x, y, z position and charge data
         # This is needed to call a numba jitted function, since the number of DUTs is not fixed and thus the data format
-        x = tracklets_data_chunk['x_dut_0']
-        y = tracklets_data_chunk['y_dut_0']
-        z = tracklets_data_chunk['z_dut_0']
-        x_err = tracklets_data_chunk['xerr_dut_0']
-        y_err = tracklets_data_chunk['yerr_dut_0']
-        z_err = tracklets_data_chunk['zerr_dut_0']
-        charge = tracklets_data_chunk['charge_dut_0']
-        n_hits = tracklets_data_chunk['n_hits_dut_0']
-        for dut_index in range(1, n_duts):
-            x = np.column_stack((x, tracklets_data_chunk['x_dut_%d' % (dut_index)]))
-            y = np.column_stack((y, tracklets_data_chunk['y_dut_%d' % (dut_index)]))
-            z = np.column_stack((z, tracklets_data_chunk['z_dut_%d' % (dut_index)]))
-            x_err = np.column_stack((x_err, tracklets_data_chunk['xerr_dut_%d' % (dut_index)]))
-            y_err = np.column_stack((y_err, tracklets_data_chunk['yerr_dut_%d' % (dut_index)]))
-            z_err = np.column_stack((z_err, tracklets_data_chunk['zerr_dut_%d' % (dut_index)]))
-            charge = np.column_stack((charge, tracklets_data_chunk['charge_dut_%d' % (dut_index)]))
-            n_hits = np.column_stack((n_hits, tracklets_data_chunk['n_hits_dut_%d' % (dut_index)]))
+        # For tracklets with DUT arrays these are views of the data and the hits are resorted in place
+        x, y, z, x_err, y_err, z_err, charge, n_hits = [analysis_utils.get_dut_data(tracklets_data_chunk, field) for field in ('x', 'y', 'z', 'xerr', 'yerr', 'zerr', 'charge', 'n_hits')]
 
         event_number = tracklets_data_chunk['event_number']
         track_quality = np.zeros_like(tracklets_data_chunk['track_quality'])
         n_tracks = tracklets_data_chunk['n_tracks']
 
         # Perform the track finding with jitted loop
-        _find_tracks_loop(event_number=event_number,
-                          x=x,
-                          y=y,
-                          z=z,
-                          x_err=x_err,
-                          y_err=y_err,
-                          z_err=z_err,
-                          charge=charge,
-                          n_hits=n_hits,
-                          track_quality=track_quality,
-                          n_tracks=n_tracks,
-                          column_sigma=column_sigma,
-                          row_sigma=row_sigma,
-                          min_cluster_distance=min_cluster_distance)
-
-        # Merge result data from arrays into one recarray
-        combined = np.column_stack((event_number, x, y, z, charge, n_hits, track_quality, n_tracks, x_err, y_err, z_err))
-        return np.core.records.fromarrays(combined.transpose(), dtype=tracklets_data_chunk.dtype)
+        find_tracks_loop = _find_tracks_loop_grid if use_grid else _find_tracks_loop
+        find_tracks_loop(event_number=event_number,
+                         x=x,
+                         y=y,
+                         z=z,
+                         x_err=x_err,
+                         y_err=y_err,
+                         z_err=z_err,
+                         charge=charge,
+                         n_hits=n_hits,
+                         track_quality=track_quality,
+                         n_tracks=n_tracks,
+                         column_sigma=column_sigma,
+                         row_sigma=row_sigma,
+                         min_cluster_distance=min_cluster_distance)
+
+        # Store result data in the tracklets data
+        if not analysis_utils.has_dut_arrays(tracklets_data_chunk):
+            for field, values in (('x', x), ('y', y), ('z', z), ('xerr', x_err), ('yerr', y_err), ('zerr', z_err), ('charge', charge), ('n_hits', n_hits)):
+                analysis_utils.set_dut_data(tracklets_data_chunk, field, values)
+        tracklets_data_chunk['track_quality'] = track_quality
+        return tracklets_data_chunk
 
     smc.SMC(table_file_in=input_tracklets_file,
             file_out=output_track_candidates_file,
             func=work,
             node_desc={'name':'TrackCandidates',
-                        'title':'Track candidates'},
+                        'title':'Track candidates',
+                        'filters': storage.get_filters('track_candidates'),
+                        'chunkshape': storage.get_chunkshape('track_candidates')},
             # Apply track finding on tracklets or track candidates
             table=['Tracklets', 'TrackCandidates'],
             align_at='event_number',
@@ -332,16 +328,17 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
         same_tracks_for_all_duts = False
 
     def create_results_array(good_track_candidates, slopes, offsets, chi2s, n_duts, good_track_selection, track_candidates_chunk, track_estimates_chunk_full=None):
-        # Define description
+        # Define description, the hits keep the precision of the track candidates
+        hit_float_type = analysis_utils.get_dut_data(track_candidates_chunk, 'x', 0).dtype
         description = [('event_number', np.int64)]
         for index in range(n_duts):
-            description.append(('x_dut_%d' % index, np.float))
+            description.append(('x_dut_%d' % index, hit_float_type))
         for index in range(n_duts):
-            description.append(('y_dut_%d' % index, np.float))
+            description.append(('y_dut_%d' % index, hit_float_type))
         for index in range(n_duts):
-            description.append(('z_dut_%d' % index, np.float))
+            description.append(('z_dut_%d' % index, hit_float_type))
         for index in range(n_duts):
-            description.append(('charge_dut_%d' % index, np.float))
+            description.append(('charge_dut_%d' % index, hit_float_type))
         for index in range(n_duts):
             description.append(('n_hits_dut_%d' % index, np.int8))
         for dimension in range(3):
@@ -363,11 +360,11 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
                 description.append(('slope_z_dut_%d' % index, np.float))
         description.extend([('track_chi2', np.uint32), ('track_quality', np.uint32), ('n_tracks', np.int8)])
         for index in range(n_duts):
-            description.append(('xerr_dut_%d' % index, np.float))
+            description.append(('xerr_dut_%d' % index, hit_float_type))
         for index in range(n_duts):
-            description.append(('yerr_dut_%d' % index, np.float))
+            description.append(('yerr_dut_%d' % index, hit_float_type))
         for index in range(n_duts):
-            description.append(('zerr_dut_%d' % index, np.float))
+            description.append(('zerr_dut_%d' % index, hit_float_type))
 
         # Select only fitted tracks (keep data = False) or keep all track candidates (keep data = True)
         if keep_data:
@@ -381,16 +378,9 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
         tracks_array['event_number'] = track_candidates_chunk['event_number']
         tracks_array['track_quality'] = track_candidates_chunk['track_quality']
         tracks_array['n_tracks'] = track_candidates_chunk['n_tracks']
-        for index in range(n_duts):
-            # print track_candidates_chunk['x_dut_%d' % index]
-            tracks_array['x_dut_%d' % index] = track_candidates_chunk['x_dut_%d' % index]
-            tracks_array['y_dut_%d' % index] = track_candidates_chunk['y_dut_%d' % index]
-            tracks_array['z_dut_%d' % index] = track_candidates_chunk['z_dut_%d' % index]
-            tracks_array['xerr_dut_%d' % index] = track_candidates_chunk['xerr_dut_%d' % index]
-            tracks_array['yerr_dut_%d' % index] = track_candidates_chunk['yerr_dut_%d' % index]
-            tracks_array['zerr_dut_%d' % index] = track_candidates_chunk['zerr_dut_%d' % index]
-            tracks_array['charge_dut_%d' % index] = track_candidates_chunk['charge_dut_%d' % index]
-            tracks_array['n_hits_dut_%d' % index] = track_candidates_chunk['n_hits_dut_%d' % index]
+        for index in range(n_duts):  # Track candidates can have both layouts, the tracks have one column per DUT
+            for field in ('x', 'y', 'z', 'xerr', 'yerr', 'zerr', 'charge', 'n_hits'):
+                tracks_array['%s_dut_%d' % (field, index)] = analysis_utils.get_dut_data(track_candidates_chunk, field, index)
 
         # New track fit info
         if keep_data:
@@ -447,7 +437,7 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
         try:  # Check if table exists already, than append data
             tracklets_table = out_file_h5.get_node('/Tracks_DUT_%d' % fit_dut)
         except tb.NoSuchNodeError:  # Table does not exist, thus create new
-            tracklets_table = out_file_h5.create_table(out_file_h5.root, name='Tracks_DUT_%d' % fit_dut, description=np.zeros((1,), dtype=tracks_array.dtype).dtype, title='Tracks fitted for DUT_%d' % fit_dut, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            tracklets_table = out_file_h5.create_table(out_file_h5.root, name='Tracks_DUT_%d' % fit_dut, description=np.zeros((1,), dtype=tracks_array.dtype).dtype, title='Tracks fitted for DUT_%d' % fit_dut, filters=storage.get_filters('tracks'), chunkshape=storage.get_chunkshape('tracks'))
 
         # Remove tracks that are too close when extrapolated to the actual DUT
         # All merged track are signaled by n_tracks = -1
@@ -551,7 +541,7 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
         try:  # Check if table exists already, than append data
             tracklets_table = out_file_h5.get_node('/Kalman_Tracks_DUT_%d' % fit_dut)
         except tb.NoSuchNodeError:  # Table does not exist, thus create new
-            tracklets_table = out_file_h5.create_table(out_file_h5.root, name='Kalman_Tracks_DUT_%d' % fit_dut, description=np.zeros((1,), dtype=tracks_array.dtype).dtype, title='Tracks fitted for DUT_%d_with_Kalman_Filter' % fit_dut, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            tracklets_table = out_file_h5.create_table(out_file_h5.root, name='Kalman_Tracks_DUT_%d' % fit_dut, description=np.zeros((1,), dtype=tracks_array.dtype).dtype, title='Tracks fitted for DUT_%d_with_Kalman_Filter' % fit_dut, filters=storage.get_filters('tracks'), chunkshape=storage.get_chunkshape('tracks'))
 
         # Remove tracks that are too close when extrapolated to the actual DUT
         # All merged track are signaled by n_tracks = -1
@@ -625,6 +615,8 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
                 else:
                     min_track_distance = np.array(min_track_distance)
 
+                # Select the DUTs to fit tracks for and the tracks/hits to use for each of them
+                fit_dut_selections = []
                 for fit_dut_index, actual_fit_dut in enumerate(fit_duts):  # Loop over the DUTs where tracks shall be fitted for
                     logging.info('Fit tracks for DUT%d', actual_fit_dut)
                     dut_selection, dut_fit_selection, track_quality_mask = select_data(fit_dut_index)
@@ -632,12 +624,18 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
                     if n_fit_duts < 2:
                         logging.warning('Insufficient track hits to do the fit (< 2). Omit DUT%d', actual_fit_dut)
                         continue
+                    fit_dut_selections.append((actual_fit_dut, dut_selection, dut_fit_selection, track_quality_mask))
+                    if same_tracks_for_all_duts:  # Fit only once since all DUTs are fitted at once
+                        break
 
-                    progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=in_file_h5.root.TrackCandidates.shape[0], term_width=80)
-                    progress_bar.start()
-
-                    for track_candidates_chunk, index_candidates in analysis_utils.data_aligned_at_events(in_file_h5.root.TrackCandidates, chunk_size=chunk_size):
+                if method == "Kalman" and use_prealignment:
+                    # if prealignment is used, planes are not rotated, thus do not have to correct
+                    # rotation in kalman filter
+                    alignment = None
 
+                def fit_chunk(track_candidates_chunk):  # Select the tracks of all fit DUTs and queue their fits on the pool
+                    chunk_fits = []
+                    for actual_fit_dut, dut_selection, dut_fit_selection, track_quality_mask in fit_dut_selections:
                         # Select tracks based on the dut that are required to have a hit (dut_selection) with a certain quality (track_quality)
                         n_tracks = track_candidates_chunk.shape[0]
                         good_track_selection = (track_candidates_chunk['track_quality'] & track_quality_mask) == track_quality_mask
@@ -681,47 +679,45 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
                         good_track_candidates = track_candidates_chunk[good_track_selection]
 
                         # Prepare track hits array to be fitted
-                        index, n_tracks = 0, good_track_candidates['event_number'].shape[0]  # Index of tmp track hits array
-                        if method == "Fit":
-                            track_hits = np.full((n_tracks, n_fit_duts, 3), np.nan)
-                        elif method == "Kalman":
-                            track_hits = np.full((n_tracks, n_duts, 5), np.inf)
-
-                        for dut_index in range(0, n_duts):  # Fill index loop of new array
-                            if method == "Fit" and ((1 << dut_index) & dut_fit_selection) == (1 << dut_index):  # True if DUT is used in fit
-                                xyz = np.column_stack((good_track_candidates['x_dut_%s' % dut_index],
-                                                       good_track_candidates['y_dut_%s' % dut_index],
-                                                       good_track_candidates['z_dut_%s' % dut_index]))
-                                track_hits[:, index, :] = xyz
-                                index += 1
-                            elif method == "Kalman":
-                                xyz = np.column_stack(np.ma.array((good_track_candidates['x_dut_%s' % dut_index],
-                                                                   good_track_candidates['y_dut_%s' % dut_index],
-                                                                   good_track_candidates['z_dut_%s' % dut_index],
-                                                                   good_track_candidates['xerr_dut_%s' % dut_index],
-                                                                   good_track_candidates['yerr_dut_%s' % dut_index])))
-                                track_hits[:, index, :] = xyz
-                                index += 1
-
-                        # Split data and fit on all available cores
+                        n_tracks = good_track_candidates['event_number'].shape[0]
+                        if method == "Fit":  # Positions of the DUTs used in the fit
+                            hit_duts = [dut_index for dut_index in range(n_duts) if ((1 << dut_index) & dut_fit_selection) == (1 << dut_index)]
+                            fields = ('x', 'y', 'z')
+                        elif method == "Kalman":  # Positions and errors of all DUTs
+                            hit_duts = list(range(n_duts))
+                            fields = ('x', 'y', 'z', 'xerr', 'yerr')
+                        track_hits = np.empty((n_tracks, len(hit_duts), len(fields)))
+                        for index, dut_index in enumerate(hit_duts):  # Read only the data of the needed DUTs
+                            for dimension, field in enumerate(fields):
+                                track_hits[:, index, dimension] = analysis_utils.get_dut_data(good_track_candidates, field, dut_index)
+
+                        # Split data and queue the fit on all available cores, the fits of all fit DUTs run together
                         n_slices = cpu_count()
                         slices = np.array_split(track_hits, n_slices)
                         if method == "Fit":
-                            results = pool.map(_fit_tracks_loop, slices)
+                            results = pool.map_async(_fit_tracks_loop, slices)
                         elif method == "Kalman":
-                            if use_prealignment:
-                                # if prealignment is used, planes are not rotated, thus do not have to correct
-                                # rotation in kalman filter
-                                alignment = None
-                            else:
-                                alignment = alignment
-                            results = pool.map(functools.partial(
+                            results = pool.map_async(functools.partial(
                                 _function_wrapper_fit_tracks_kalman_loop, pixel_size,
                                 n_pixels, dut_fit_selection, z_positions, alignment,
                                 beam_energy, material_budget, add_scattering_plane), slices)
-                        del track_hits
+                        del track_hits, slices
+                        chunk_fits.append((actual_fit_dut, good_track_selection, results))
+                    return chunk_fits
+
+                progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=in_file_h5.root.TrackCandidates.shape[0], term_width=80)
+                progress_bar.start()
+
+                # Each chunk of track candidates is read only once and the tracks for all fit DUTs are fitted in parallel.
+                # The chunks are pipelined: while chunk N is fitted, chunk N - 1 is stored and chunk N + 1 is read
+                for (track_candidates_chunk, index_candidates), chunk_fits in smc.pipelined(items=analysis_utils.data_aligned_at_events(in_file_h5.root.TrackCandidates, chunk_size=chunk_size),
+                                                                                            submit=lambda chunk: fit_chunk(chunk[0])):
+                    # Store results of all fit DUTs, only this process writes to the output file
+                    for actual_fit_dut, good_track_selection, results in chunk_fits:
+                        results = results.get()
+                        good_track_candidates = track_candidates_chunk[good_track_selection]
+                        n_tracks = good_track_candidates.shape[0]
 
-                        # Store results
                         if method == "Fit":
                             offsets = np.concatenate([i[0] for i in results])  # Merge offsets from all cores in results
                             slopes = np.concatenate([i[1] for i in results])  # Merge slopes from all cores in results
@@ -745,10 +741,8 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
                                 for dut_index in fit_duts:
                                     store_track_data_kalman(dut_index, min_track_distance)
 
-                        progress_bar.update(index_candidates)
-                    progress_bar.finish()
-                    if same_tracks_for_all_duts:  # Stop fit Dut loop since all DUTs were fitted at once
-                        break
+                    progress_bar.update(index_candidates)
+                progress_bar.finish()
     pool.close()
     pool.join()
 
@@ -955,6 +949,156 @@ def _find_tracks_loop(event_number, x, y, z, x_err, y_err, z_err, charge, n_hits
                       n_duts=n_duts)
 
 
+@njit
+def _find_tracks_loop_grid(event_number, x, y, z, x_err, y_err, z_err, charge, n_hits, track_quality, n_tracks, column_sigma, row_sigma, min_cluster_distance):
+    ''' Same as _find_tracks_loop(), but the closest DUT hit to the reference hit of a track is searched in a grid
+    of the DUT hit positions of the event. The grid cells have a size of two sigma, thus only the neighbouring cells
+    have to be checked. Only hits within two sigma are assigned to tracks and the best hit is swapped once
+    instead of swapping every closer hit found. The track quality and the number of tracks are set the same way. '''
+    n_duts = x.shape[1]
+    start_index = 0
+
+    while start_index < event_number.shape[0]:  # Loop over events
+        stop_index = start_index + 1
+        while stop_index < event_number.shape[0] and event_number[stop_index] == event_number[start_index]:
+            stop_index += 1
+        n_actual_tracks = stop_index - start_index
+
+        # Create grid of the hits of each DUT: the hits are sorted by the grid cell key, the hit index is the original track index in the event
+        hit_x, hit_y = np.empty((n_duts, n_actual_tracks)), np.empty((n_duts, n_actual_tracks))
+        cell_keys = np.empty((n_duts, n_actual_tracks), dtype=np.int64)
+        sorted_hits = np.empty((n_duts, n_actual_tracks), dtype=np.int64)
+        n_grid_hits = np.zeros(n_duts, dtype=np.int64)
+        hit_of_track = np.full((n_duts, n_actual_tracks), -1, dtype=np.int64)  # The hit that is assigned to each track, -1 is no hit
+        track_of_hit = np.empty((n_duts, n_actual_tracks), dtype=np.int64)
+        if n_actual_tracks > 1:
+            for dut_index in range(n_duts):
+                if column_sigma[dut_index] <= 0 or row_sigma[dut_index] <= 0:  # No correlation window, no search
+                    continue
+                keys = np.empty(n_actual_tracks, dtype=np.int64)
+                n_hits_dut = 0
+                for hit_index in range(n_actual_tracks):
+                    curr_x, curr_y = x[start_index + hit_index][dut_index], y[start_index + hit_index][dut_index]
+                    hit_x[dut_index][hit_index], hit_y[dut_index][hit_index] = curr_x, curr_y
+                    if not np.isnan(curr_x):
+                        hit_of_track[dut_index][hit_index] = hit_index
+                        track_of_hit[dut_index][hit_index] = start_index + hit_index
+                        keys[n_hits_dut] = _get_cell_key(curr_x, curr_y, 2 * column_sigma[dut_index], 2 * row_sigma[dut_index])
+                        sorted_hits[dut_index][n_hits_dut] = hit_index
+                        n_hits_dut += 1
+                order = np.argsort(keys[:n_hits_dut])
+                sorted_hits[dut_index][:n_hits_dut] = sorted_hits[dut_index][:n_hits_dut][order]
+                cell_keys[dut_index][:n_hits_dut] = keys[:n_hits_dut][order]
+                n_grid_hits[dut_index] = n_hits_dut
+
+        for track_index in range(start_index, stop_index):  # Loop over all tracks of the event
+            reference_hit_set = False  # The first real hit (column, row != nan) is the reference hit of the actual track
+
+            for dut_index in range(n_duts):  # loop over all DUTs in the actual track
+                actual_column_sigma, actual_row_sigma = column_sigma[dut_index], row_sigma[dut_index]
+
+                if not reference_hit_set and not np.isnan(x[track_index][dut_index]):  # Search for first DUT that registered a hit
+                    actual_x, actual_y = x[track_index][dut_index], y[track_index][dut_index]
+                    reference_hit_set = True
+                    track_quality[track_index] |= (65793 << dut_index)  # First track hit has best quality by definition
+                elif reference_hit_set:  # First hit found, now find best (closest) DUT hit
+                    if n_grid_hits[dut_index] > 0:
+                        # Calculate the hit distance of the actual assigned DUT hit towards the actual reference hit
+                        actual_hit_distance = sqrt((x[track_index][dut_index] - actual_x)**2 + (y[track_index][dut_index] - actual_y)**2)
+                        if np.isnan(x[track_index][dut_index]):
+                            actual_hit_distance = -1  # Signal no hit
+                        best_track_index, shortest_hit_distance = -1, -1.  # The track index of the closest hit; -1 means not found
+                        cell_size_x, cell_size_y = 2 * actual_column_sigma, 2 * actual_row_sigma
+                        for cell_x_shift in range(-1, 2):  # Loop over the neighbouring cells, the cells of one column are consecutive keys
+                            min_key = _get_cell_key(actual_x + cell_x_shift * cell_size_x, actual_y - cell_size_y, cell_size_x, cell_size_y)
+                            max_key = _get_cell_key(actual_x + cell_x_shift * cell_size_x, actual_y + cell_size_y, cell_size_x, cell_size_y)
+                            first_hit = np.searchsorted(cell_keys[dut_index][:n_grid_hits[dut_index]], min_key)
+                            last_hit = np.searchsorted(cell_keys[dut_index][:n_grid_hits[dut_index]], max_key, side='right')
+                            for sorted_index in range(first_hit, last_hit):
+                                hit_index = sorted_hits[dut_index][sorted_index]
+                                x_distance, y_distance = abs(hit_x[dut_index][hit_index] - actual_x), abs(hit_y[dut_index][hit_index] - actual_y)
+                                if x_distance >= cell_size_x or y_distance >= cell_size_y:  # Only hits within 2 sigma
+                                    continue
+                                hit_distance = sqrt(x_distance**2 + y_distance**2)
+                                hit_track_index = track_of_hit[dut_index][hit_index]
+                                if hit_track_index < track_index:  # Check if hit is already assigned to other track
+                                    first_dut_index = _get_first_dut_index(x, hit_track_index)  # Get reference DUT index of other track
+                                    first_dut_x, first_dut_y = x[hit_track_index][first_dut_index], y[hit_track_index][first_dut_index]
+                                    # Calculate hit distance to reference hit of other track
+                                    hit_distance_old = sqrt((hit_x[dut_index][hit_index] - first_dut_x)**2 + (hit_y[dut_index][hit_index] - first_dut_y)**2)
+                                    if actual_hit_distance >= 0 and actual_hit_distance < hit_distance:  # Check if actual assigned hit is better
+                                        continue
+                                    if hit_distance > hit_distance_old:  # Only take hit if it fits better to actual track; otherwise leave it with other track
+                                        continue
+                                if best_track_index < 0 or hit_distance < shortest_hit_distance or (hit_distance == shortest_hit_distance and hit_track_index < best_track_index):
+                                    best_track_index, shortest_hit_distance = hit_track_index, hit_distance
+                        if best_track_index >= 0 and best_track_index != track_index:  # Hit swapping needed
+                            # Update the assignment of the grid hits
+                            hit_index, other_hit_index = hit_of_track[dut_index][best_track_index - start_index], hit_of_track[dut_index][track_index - start_index]
+                            hit_of_track[dut_index][track_index - start_index], hit_of_track[dut_index][best_track_index - start_index] = hit_index, other_hit_index
+                            track_of_hit[dut_index][hit_index] = track_index
+                            if other_hit_index >= 0:
+                                track_of_hit[dut_index][other_hit_index] = best_track_index
+                            _swap_hits(x=x,
+                                       y=y,
+                                       z=z,
+                                       charge=charge,
+                                       n_hits=n_hits,
+                                       x_err=x_err,
+                                       y_err=y_err,
+                                       z_err=z_err,
+                                       track_index=track_index,
+                                       dut_index=dut_index,
+                                       hit_index=best_track_index,
+                                       swap_x=x[best_track_index][dut_index],
+                                       swap_y=y[best_track_index][dut_index],
+                                       swap_z=z[best_track_index][dut_index],
+                                       swap_charge=charge[best_track_index][dut_index],
+                                       swap_n_hits=n_hits[best_track_index][dut_index],
+                                       swap_x_err=x_err[best_track_index][dut_index],
+                                       swap_y_err=y_err[best_track_index][dut_index],
+                                       swap_z_err=z_err[best_track_index][dut_index])
+                            if track_index > best_track_index:  # Hit was assigned to other track
+                                dut_x, dut_y = x[best_track_index][dut_index], y[best_track_index][dut_index]
+                                first_dut_index = _get_first_dut_index(x, best_track_index)  # Get reference DUT index of other track
+                                first_dut_x, first_dut_y = x[best_track_index][first_dut_index], y[best_track_index][first_dut_index]
+                                _reset_dut_track_quality(dut_x=dut_x,
+                                                         dut_y=dut_y,
+                                                         first_dut_x=first_dut_x,
+                                                         first_dut_y=first_dut_y,
+                                                         track_quality=track_quality,
+                                                         hit_index=best_track_index,
+                                                         dut_index=dut_index,
+                                                         dut_column_sigma=actual_column_sigma,
+                                                         dut_row_sigma=actual_row_sigma)
+                    curr_x, curr_y = x[track_index][dut_index], y[track_index][dut_index]
+                    _set_dut_track_quality(dut_x=actual_x,
+                                           dut_y=actual_y,
+                                           curr_x=curr_x,
+                                           curr_y=curr_y,
+                                           track_quality=track_quality,
+                                           track_index=track_index,
+                                           dut_index=dut_index,
+                                           dut_column_sigma=actual_column_sigma,
+                                           dut_row_sigma=actual_row_sigma)
+
+        _set_n_tracks(x=x,
+                      y=y,
+                      start_index=start_index,
+                      stop_index=stop_index,
+                      n_tracks=n_tracks,
+                      n_actual_tracks=n_actual_tracks,
+                      min_cluster_distance=min_cluster_distance,
+                      n_duts=n_duts)
+        start_index = stop_index
+
+
+@njit
+def _get_cell_key(x, y, cell_size_x, cell_size_y):
+    ''' Returns the key of the grid cell of a position. The cells of one grid column have consecutive keys. '''
+    return np.int64(np.floor(x / cell_size_x)) * 4294967296 + np.int64(np.floor(y / cell_size_y)) + 2147483648
+
+
 @njit
 def _find_merged_tracks(tracks_array, min_track_distance):  # Check if several tracks are less than min_track_distance apart. Then exclude these tracks (set n_tracks = -1)
     i = 0
@@ -980,25 +1124,35 @@ def _find_merged_tracks(tracks_array, min_track_distance):  # Check if several t
 
 
 def _fit_tracks_loop(track_hits):
-    ''' Do 3d line fit and calculate chi2 for each fit. '''
-    def line_fit_3d(hits):
-        # subtract mean for each component (x,y,z) for SVD calculation
-        datamean = hits.mean(axis=0)
-        offset, slope = datamean, np.linalg.svd(hits - datamean, full_matrices=False)[2][0]  # http://stackoverflow.com/questions/2298390/fitting-a-line-in-3d
-        slope_mag = np.sqrt(slope.dot(slope))
-        intersections = offset + slope / slope[2] * (hits.T[2][:, np.newaxis] - offset[2])  # Fitted line and DUT plane intersections (here: points)
-        chi2 = np.sum(np.square(hits - intersections), dtype=np.uint32)  # Chi2 of the fit in um
-        return datamean, slope / slope_mag, chi2
-
-    slope = np.empty((track_hits.shape[0], 3), dtype=np.float)
-    offset = np.empty((track_hits.shape[0], 3), dtype=np.float)
-    chi2 = np.empty((track_hits.shape[0],), dtype=np.float)
-
-    for index, actual_hits in enumerate(track_hits):  # Loop over selected track candidate hits and fit
-        try:
-            offset[index], slope[index], chi2[index] = line_fit_3d(actual_hits)
-        except np.linalg.linalg.LinAlgError:
-            offset[index], slope[index], chi2[index] = np.nan, np.nan, np.nan
+    ''' Do 3d line fit and calculate chi2 for each fit.
+
+    All tracks are fitted at once with stacked linear algebra. Missing hits (nan) are
+    omitted in the fit, tracks with less than two hits are not fitted (nan).
+    '''
+    hit_selection = ~np.any(np.isnan(track_hits), axis=2)  # Missing hits have a weight of 0 in the fit
+    n_hits = np.count_nonzero(hit_selection, axis=1)
+    track_selection = n_hits >= 2  # At least two hits needed for a line fit
+    hits = np.where(hit_selection[:, :, np.newaxis], track_hits, 0.)
+
+    # subtract mean for each component (x,y,z) for SVD calculation
+    offset = hits.sum(axis=1) / n_hits[:, np.newaxis]
+    hits_centered = np.where(np.logical_and(hit_selection, track_selection[:, np.newaxis])[:, :, np.newaxis], hits - offset[:, np.newaxis, :], 0.)
+    try:
+        slope = np.linalg.svd(hits_centered, full_matrices=False)[2][:, 0]  # http://stackoverflow.com/questions/2298390/fitting-a-line-in-3d
+    except np.linalg.linalg.LinAlgError:  # Fit tracks one by one if the SVD does not converge for a track
+        slope = np.empty((track_hits.shape[0], 3), dtype=np.float)
+        for index in range(track_hits.shape[0]):
+            try:
+                slope[index] = np.linalg.svd(hits_centered[index], full_matrices=False)[2][0]
+            except np.linalg.linalg.LinAlgError:
+                slope[index] = np.nan
+                track_selection[index] = False
+
+    intersections = offset[:, np.newaxis, :] + slope[:, np.newaxis, :] / slope[:, np.newaxis, 2:3] * (hits[:, :, 2:3] - offset[:, np.newaxis, 2:3])  # Fitted line and DUT plane intersections (here: points)
+    chi2 = np.sum(np.where(hit_selection[:, :, np.newaxis], np.square(hits - intersections), 0.), axis=(1, 2), dtype=np.uint32).astype(np.float)  # Chi2 of the fit in um
+    slope /= np.sqrt(np.matmul(slope[:, np.newaxis, :], slope[:, :, np.newaxis])[:, 0])  # Same as slope.dot(slope) of each track
+
+    offset[~track_selection], slope[~track_selection], chi2[~track_selection] = np.nan, np.nan, np.nan
 
     return offset, slope, chi2
 
@@ -1061,22 +1215,29 @@ def _kalman_fit_3d(hits, alignment, dut_fit_selection, transition_matrix, transi
     '''
     kf = kalman.KalmanFilter()
 
-    measurements = ma.array(np.append(hits[:, :, 0:2], (np.repeat([np.zeros((hits.shape[1], 2))], hits.shape[0], axis=0)), axis=-1))
+    measurements = np.zeros((hits.shape[0], hits.shape[1], 4))
+    measurements[:, :, 0:2] = hits[:, :, 0:2]
 
-    # mask duts which should not used in fit
+    # mask duts which should not used in fit and missing hits of single tracks
+    mask = np.zeros(measurements.shape[0:2], dtype=np.bool_)
     for dut_index in range(0, measurements.shape[1]):
         if dut_index not in dut_fit_selection:
-            measurements[:, dut_index, ] = ma.masked
+            mask[:, dut_index] = True
 
     # Check for invalid values (NaN)
-    if np.any(np.isnan(measurements)):
-        logging.warning('Not all measurements have valid values (Array contains NANs).')
+    missing_hits = np.logical_and(~mask, np.any(np.isnan(measurements), axis=2))
+    if np.any(missing_hits):
+        logging.warning('Not all measurements have valid values (Array contains NANs). These measurements are treated as missing.')
+        mask |= missing_hits
 
     smoothed_state_estimates, cov = kf.smooth(alignment, transition_matrix, transition_offset, transition_covariance,
                                               observation_matrix, observation_offset, observation_covariance,
-                                              initial_state_mean, initial_state_covariance, measurements)
+                                              initial_state_mean, initial_state_covariance,
+                                              ma.array(measurements, mask=np.repeat(mask[:, :, np.newaxis], measurements.shape[2], axis=2)))
 
-    chi2 = np.sum(np.square(measurements[:, :, 0:2] - smoothed_state_estimates[:, :,  0:2]), dtype=np.uint32, axis=(1, 2))
+    residuals = np.square(measurements[:, :, 0:2] - smoothed_state_estimates[:, :, 0:2])
+    residuals[mask] = 0.
+    chi2 = np.sum(residuals, dtype=np.uint32, axis=(1, 2))
     x_err = np.sqrt(np.diagonal(cov, axis1=3, axis2=2))[:, :, 0]
     y_err = np.sqrt(np.diagonal(cov, axis1=3, axis2=2))[:, :, 1]
 
@@ -1089,8 +1250,8 @@ def _kalman_fit_3d(hits, alignment, dut_fit_selection, transition_matrix, transi
 
 def _fit_tracks_kalman_loop(track_hits, dut_fit_selection, pixel_size, n_pixels, z_positions, alignment, beam_energy, material_budget, add_scattering_plane):
     '''
-    Loop over the selected tracks. In this function all matrices for the Kalman Filter are calculated track by track
-    and the Kalman Filter is started. With dut_fit_selection only the duts which are selected are included in the Kalman Filter.
+    Fit the selected tracks. In this function all matrices for the Kalman Filter are calculated for the whole chunk
+    and the Kalman Filter is started. Matrices which are the same for all tracks are passed as broadcasted read-only views. With dut_fit_selection only the duts which are selected are included in the Kalman Filter.
     Not included DUTs are masked.
 
     Parameters
@@ -1182,34 +1343,6 @@ def _fit_tracks_kalman_loop(track_hits, dut_fit_selection, pixel_size, n_pixels,
     # rms angle of multiple scattering
     theta = np.array(((13.6 / momentum / beta) * np.sqrt(material_budget) * (1. + 0.038 * np.log(material_budget))))
 
-    # express transition covariance matrix
-    transition_covariance = np.zeros((chunk_size, n_duts - 1, 4, 4))
-
-    # express transition matrix
-    transition_matrix = np.zeros((chunk_size, n_duts - 1, 4, 4))
-
-    # express transition and observation offset matrices
-    transition_offset = np.zeros((chunk_size, n_duts - 1, 4))
-    observation_offset = np.zeros((chunk_size, n_duts, 4))
-
-    # express initial state. Contains (x_pos, y_pos, slope_x, slope_y).
-    initial_state_mean = np.zeros((chunk_size, 4))
-
-    # express observatipon matrix
-    observation_matrix = np.zeros((chunk_size, n_duts, 4, 4))
-
-    # express observation covariance matrices
-    observation_covariance = np.zeros((chunk_size, n_duts, 4, 4))
-    # only observe x and y position
-    observation_matrix[:, :, 0, 0] = 1.
-    observation_matrix[:, :, 1, 1] = 1.
-
-    # express initial state covariance matrices: x and y pos have initial error of pixel resolution and x and y slopes have large error
-    initial_state_covariance = np.zeros((chunk_size, 4, 4))
-    # error on initial slope is roughly divergence of beam (5 mrad). Error on initial x-y position depends on fit selection
-    initial_state_covariance[:, 2, 2] = np.square(5e-3)
-    initial_state_covariance[:, 3, 3] = np.square(5e-3)
-
     # create a list of duts which should be included in the fit
     dut_list = np.full(shape=(n_duts), fill_value=np.nan)
     for index in range(n_duts):
@@ -1227,59 +1360,76 @@ def _fit_tracks_kalman_loop(track_hits, dut_fit_selection, pixel_size, n_pixels,
         for i in range(len(index_scatter)):  # need to shift dut fit selection in case of additional scattering plane
                 dut_fit_selection[np.where(dut_fit_selection > (index_scatter[i] - 1))[0][0]:] = dut_fit_selection[np.where(dut_fit_selection > (index_scatter[i] - 1))[0][0]:] + 1
 
-    for index, actual_hits in enumerate(track_hits):  # Loop over selected track candidate hits and fit
-        # cluster hit position error
-        x_err = np.array(actual_hits[:, 3])
-        y_err = np.array(actual_hits[:, 4])
-
-        # Take cluster hit position error as measurement error for duts which have a hit.
-        # For those who have no hit, need no error, since the should not be included in fit via fit selection
-        observation_covariance[index, dut_selection[~np.isnan(x_err)], 0, 0] = np.square(x_err[dut_selection[~np.isnan(x_err)]])
-        observation_covariance[index, dut_selection[~np.isnan(x_err)], 1, 1] = np.square(y_err[dut_selection[~np.isnan(x_err)]])
-
-        if dut_selection[0] in dut_fit_selection:  # first dut is in fit selection
-            # If first dut is used in track building, take first dut hit as initial value and
-            # its corresponding cluster position error as the error on the measurement.
-            initial_state_mean[index] = np.array([actual_hits[0, 0], actual_hits[0, 1], 0., 0.])
-            initial_state_covariance[index, 0, 0] = np.square(x_err[0])
-            initial_state_covariance[index, 1, 1] = np.square(y_err[0])
-        else:  # first dut is not in fit selction
-            # Take hit from first dut which is in fit selection. Cannot take hit from first dut,
-            # since do not want to pass measurement to kalman filter (unbiased).
-            # Due to the fact that this hit position can be very off through multiple scattering,
-            # take whole sensor as error (this error must be very large).
-            initial_state_mean[index] = np.array([actual_hits[dut_fit_selection[0], 0], actual_hits[dut_fit_selection[0], 1], 0., 0.])
-            initial_state_covariance[index, 0, 0] = np.square(n_pixels * pixel_size)[dut_fit_selection[0], 0]
-            initial_state_covariance[index, 1, 1] = np.square(n_pixels * pixel_size)[dut_fit_selection[0], 1]
-
-        # express transition matrices
-        # transition matrices are filled already here. In case of prealignment matrices will not be updated.
-        # If alignment is used, transition matrices are updated (in Kalman Filter) before each prediction step in order to take
-        # rotations of planes into account.
-        transition_matrix[index, sel, :, 0] = np.array([1., 0., 0., 0.])
-        transition_matrix[index, sel, :, 1] = np.array([0., 1., 0., 0.])
-        transition_matrix[index, sel, :, 2] = np.array([(z_diff), np.zeros((len(sel),)),
-                                                        np.ones((len(sel),)), np.zeros((len(sel),))]).T
-        transition_matrix[index, sel, :, 3] = np.array([np.zeros((len(sel),)), (z_diff),
-                                                        np.zeros((len(sel),)), np.ones((len(sel),))]).T
-
-        # express transition covariance matrices, according to http://web-docs.gsi.de/~ikisel/reco/Methods/CovarianceMatrices-NIMA329-1993.pdf
-        transition_covariance[index, sel, :, 0] = np.array([(z_diff)**2 * theta[sel]**2,
-                                                            np.zeros((len(sel),)),
-                                                            -(z_diff) * theta[sel]**2,
-                                                            np.zeros((len(sel),))]).T
-        transition_covariance[index, sel, :, 1] = np.array([np.zeros((len(sel),)),
-                                                            (z_diff)**2 * theta[sel]**2,
-                                                            np.zeros((len(sel),)),
-                                                            -(z_diff) * theta[sel]**2]).T
-        transition_covariance[index, sel, :, 2] = np.array([-(z_diff) * theta[sel]**2,
-                                                            np.zeros((len(sel),)),
-                                                            theta[sel]**2,
-                                                            np.zeros((len(sel),))]).T
-        transition_covariance[index, sel, :, 3] = np.array([np.zeros((len(sel),)),
-                                                            -(z_diff) * theta[sel]**2,
-                                                            np.zeros((len(sel),)),
-                                                            theta[sel]**2]).T
+    # Matrices which only depend on the z positions and the material budget are the same for all tracks.
+    # They are calculated once per DUT and expanded to the chunk size as read-only views (stride 0 along the track axis).
+
+    # express transition matrices
+    # transition matrices are filled already here. In case of prealignment matrices will not be updated.
+    # If alignment is used, transition matrices are updated (in Kalman Filter) before each prediction step in order to take
+    # rotations of planes into account.
+    transition_matrix = np.tile(np.eye(4), (n_duts - 1, 1, 1))
+    transition_matrix[:, 0, 2] = z_diff
+    transition_matrix[:, 1, 3] = z_diff
+
+    # express transition covariance matrices, according to http://web-docs.gsi.de/~ikisel/reco/Methods/CovarianceMatrices-NIMA329-1993.pdf
+    transition_covariance = np.zeros((n_duts - 1, 4, 4))
+    transition_covariance[:, 0, 0] = (z_diff)**2 * theta[sel]**2
+    transition_covariance[:, 1, 1] = (z_diff)**2 * theta[sel]**2
+    transition_covariance[:, 2, 0] = -(z_diff) * theta[sel]**2
+    transition_covariance[:, 3, 1] = -(z_diff) * theta[sel]**2
+    transition_covariance[:, 0, 2] = -(z_diff) * theta[sel]**2
+    transition_covariance[:, 1, 3] = -(z_diff) * theta[sel]**2
+    transition_covariance[:, 2, 2] = theta[sel]**2
+    transition_covariance[:, 3, 3] = theta[sel]**2
+
+    # express observation matrix, only observe x and y position
+    observation_matrix = np.zeros((n_duts, 4, 4))
+    observation_matrix[:, 0, 0] = 1.
+    observation_matrix[:, 1, 1] = 1.
+
+    transition_matrix = np.broadcast_to(transition_matrix, (chunk_size, n_duts - 1, 4, 4))
+    transition_covariance = np.broadcast_to(transition_covariance, (chunk_size, n_duts - 1, 4, 4))
+    observation_matrix = np.broadcast_to(observation_matrix, (chunk_size, n_duts, 4, 4))
+
+    # express transition and observation offset matrices
+    transition_offset = np.broadcast_to(np.zeros((n_duts - 1, 4)), (chunk_size, n_duts - 1, 4))
+    observation_offset = np.broadcast_to(np.zeros((n_duts, 4)), (chunk_size, n_duts, 4))
+
+    # cluster hit position error
+    x_err = track_hits[:, :, 3]
+    y_err = track_hits[:, :, 4]
+
+    # express observation covariance matrices
+    # Take cluster hit position error as measurement error for duts which have a hit.
+    # For those who have no hit, need no error, since the should not be included in fit via fit selection
+    has_hit = ~np.isnan(x_err)
+    observation_covariance = np.zeros((chunk_size, n_duts, 4, 4))
+    observation_covariance[:, :, 0, 0] = np.where(has_hit, np.square(x_err), 0.)
+    observation_covariance[:, :, 1, 1] = np.where(has_hit, np.square(y_err), 0.)
+
+    # express initial state. Contains (x_pos, y_pos, slope_x, slope_y).
+    initial_state_mean = np.zeros((chunk_size, 4))
+
+    # express initial state covariance matrices: x and y pos have initial error of pixel resolution and x and y slopes have large error
+    initial_state_covariance = np.zeros((chunk_size, 4, 4))
+    # error on initial slope is roughly divergence of beam (5 mrad). Error on initial x-y position depends on fit selection
+    initial_state_covariance[:, 2, 2] = np.square(5e-3)
+    initial_state_covariance[:, 3, 3] = np.square(5e-3)
+
+    if dut_selection[0] in dut_fit_selection:  # first dut is in fit selection
+        # If first dut is used in track building, take first dut hit as initial value and
+        # its corresponding cluster position error as the error on the measurement.
+        initial_state_mean[:, 0:2] = track_hits[:, 0, 0:2]
+        initial_state_covariance[:, 0, 0] = np.square(x_err[:, 0])
+        initial_state_covariance[:, 1, 1] = np.square(y_err[:, 0])
+    else:  # first dut is not in fit selction
+        # Take hit from first dut which is in fit selection. Cannot take hit from first dut,
+        # since do not want to pass measurement to kalman filter (unbiased).
+        # Due to the fact that this hit position can be very off through multiple scattering,
+        # take whole sensor as error (this error must be very large).
+        initial_state_mean[:, 0:2] = track_hits[:, dut_fit_selection[0], 0:2]
+        initial_state_covariance[:, 0, 0] = np.square(n_pixels * pixel_size)[dut_fit_selection[0], 0]
+        initial_state_covariance[:, 1, 1] = np.square(n_pixels * pixel_size)[dut_fit_selection[0], 1]
 
     # run kalman filter
     track_estimate_chunks, chi2, x_err, y_err = _kalman_fit_3d(track_hits[:, :, 0:2], alignment, dut_fit_selection,